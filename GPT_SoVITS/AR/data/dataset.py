@@ -14,6 +14,7 @@ from torch.utils.data import DataLoader, Dataset
 version = os.environ.get("version", None)
 
 from text import cleaned_text_to_sequence
+from AR.data.token_store import PHONE_LEN, SEM_LEN, TokenStore
 
 # from config import exp_dir
 
@@ -54,11 +55,15 @@ class Text2SemanticDataset(Dataset):
     ) -> None:
         super().__init__()
 
-        self.semantic_data = pd.read_csv(
-            semantic_path,
-            delimiter="\t",
-            encoding="utf-8",
-        )
+        # 4-pack-s1-tokens.py打包过且未过期时, 直接mmap读取token store, 跳过tsv解析
+        exp_dir = os.path.dirname(phoneme_path)
+        self.store = TokenStore.open(exp_dir, version, [phoneme_path, semantic_path, "%s/3-bert" % exp_dir])
+        if self.store is None:
+            self.semantic_data = pd.read_csv(
+                semantic_path,
+                delimiter="\t",
+                encoding="utf-8",
+            )
         # get dict
         self.path2 = phoneme_path  # "%s/2-name2text.txt"%exp_dir#phoneme_path
         self.path3 = "%s/3-bert" % (
@@ -70,14 +75,15 @@ class Text2SemanticDataset(Dataset):
         assert os.path.exists(self.path2)
         assert os.path.exists(self.path6)
         self.phoneme_data = {}
-        with open(self.path2, "r", encoding="utf8") as f:
-            lines = f.read().strip("\n").split("\n")
+        if self.store is None:
+            with open(self.path2, "r", encoding="utf8") as f:
+                lines = f.read().strip("\n").split("\n")
 
-        for line in lines:
-            tmp = line.split("\t")
-            if len(tmp) != 4:
-                continue
-            self.phoneme_data[tmp[0]] = [tmp[1], tmp[2], tmp[3]]
+            for line in lines:
+                tmp = line.split("\t")
+                if len(tmp) != 4:
+                    continue
+                self.phoneme_data[tmp[0]] = [tmp[1], tmp[2], tmp[3]]
 
         # self.phoneme_data = np.load(phoneme_path, allow_pickle=True).item()
         # pad for semantic tokens
@@ -93,21 +99,26 @@ class Text2SemanticDataset(Dataset):
         self.min_ps_ratio = min_ps_ratio
         self.max_ps_ratio = max_ps_ratio
 
-        if max_sample is not None:
+        if max_sample is not None and self.store is None:
             self.semantic_data = self.semantic_data[:max_sample]
 
         # {idx: (semantic, phoneme)}
         # semantic list, phoneme list
         self.semantic_phoneme = []
         self.item_names = []
+        # token store中的行号, 与item_names一一对应
+        self.rows = None
 
         self.inited = False
 
         if not self.inited:
             # 调用初始化函数
-            self.init_batch()
+            if self.store is not None:
+                self.init_batch_from_store(max_sample)
+            else:
+                self.init_batch()
+                del self.semantic_data
             self.inited = True
-            del self.semantic_data
             del self.phoneme_data
         # self.tokenizer = AutoTokenizer.from_pretrained("hfl/chinese-roberta-wwm-ext-large")
         # self.tokenizer = AutoTokenizer.from_pretrained("/data/docker/liujing04/bert-vits2/Bert-VITS2-master20231106/bert/chinese-roberta-wwm-ext-large")
@@ -205,13 +216,60 @@ class Text2SemanticDataset(Dataset):
         # 345410 for LibriTTS
         print("dataset.__len__():", self.__len__())
 
+    def init_batch_from_store(self, max_sample: int = None):
+        # 与init_batch相同的过滤规则, 只是在长度索引上一次性向量化完成
+        index = self.store.index if max_sample is None else self.store.index[:max_sample]
+        print("semantic_data_len:", len(index))
+        semantic_lens = index[:, SEM_LEN]
+        phoneme_lens = index[:, PHONE_LEN]
+        bigger = semantic_lens > self.max_sec * self.hz
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ps_ratio = phoneme_lens / (semantic_lens / self.hz)
+        deleted_ps = ~bigger & (
+            (phoneme_lens > self.max_sec * self.hz / 2.5)
+            | (ps_ratio > self.max_ps_ratio)
+            | (ps_ratio < self.min_ps_ratio)
+        )
+        rows = np.nonzero(~bigger & ~deleted_ps)[0]
+        num_deleted_bigger = int(bigger.sum())
+        num_deleted_ps = int(deleted_ps.sum())
+
+        min_num = 100  # 20直接不补#30补了也不存ckpt
+        leng = len(rows)
+        if leng < min_num:
+            rows = np.tile(rows, max(2, int(min_num / leng)))
+        self.rows = rows
+        self.item_names = [self.store.names[row] for row in rows]
+        if num_deleted_bigger > 0:
+            print(
+                f"deleted {num_deleted_bigger} audios who's duration are bigger than {self.max_sec} seconds",
+            )
+        if num_deleted_ps > 0:
+            print(
+                f"deleted {num_deleted_ps} audios who's phoneme/sec are bigger than {self.max_ps_ratio} or smaller than {self.min_ps_ratio}",
+            )
+        print("dataset.__len__():", self.__len__())
+
     def __get_item_names__(self) -> List[str]:
         return self.item_names
 
     def __len__(self) -> int:
-        return len(self.semantic_phoneme)
+        return len(self.item_names)
 
     def __getitem__(self, idx: int) -> Dict:
+        if self.store is not None:
+            row = self.rows[idx]
+            semantic_ids = self.store.semantic(row)
+            phoneme_ids = self.store.phoneme(row)
+            bert_feature = self.store.bert(row)
+            return {
+                "idx": idx,
+                "phoneme_ids": phoneme_ids,
+                "phoneme_ids_len": len(phoneme_ids),
+                "semantic_ids": semantic_ids,
+                "semantic_ids_len": len(semantic_ids),
+                "bert_feature": bert_feature,
+            }
         semantic_ids, phoneme_ids = self.semantic_phoneme[idx]
         item_name = self.item_names[idx]
         phoneme_ids_len = len(phoneme_ids)
@@ -239,6 +297,8 @@ class Text2SemanticDataset(Dataset):
         }
 
     def get_sample_length(self, idx: int):
+        if self.store is not None:
+            return 1.0 * self.store.index[self.rows[idx], SEM_LEN] / self.hz
         semantic_ids = self.semantic_phoneme[idx][0]
         sec = 1.0 * len(semantic_ids) / self.hz
         return sec
@@ -0,0 +1,138 @@
+# packed token store for Text2SemanticDataset:
+# semantic/phoneme ids as int16 and bert features as fp16 in flat files, plus an int64 offset index,
+# so that the dataset starts without parsing the tsv and reads every item through mmap.
+import json
+import os
+import shutil
+from typing import List, Optional
+
+import numpy as np
+import torch
+
+TOKEN_STORE_DIR = "9-s1-tokens"
+BERT_DIM = 1024
+# columns of index.npy
+SEM_OFFSET, SEM_LEN, PHONE_OFFSET, PHONE_LEN, BERT_OFFSET = range(5)
+
+
+def source_signature(paths: List[str]) -> List[List[int]]:
+    """
+    (size, mtime) of the text files and (file count, total size, latest mtime) of the directories (3-bert)
+    the store was built from, used to detect a stale store.
+    """
+    signature = []
+    for path in paths:
+        if os.path.isdir(path):
+            count = size = mtime = 0
+            for entry in os.scandir(path):
+                stat = entry.stat()
+                count += 1
+                size += stat.st_size
+                mtime = max(mtime, int(stat.st_mtime))
+            signature.append([count, size, mtime])
+        elif os.path.exists(path):
+            signature.append([os.path.getsize(path), int(os.path.getmtime(path))])
+        else:
+            signature.append([])
+    return signature
+
+
+class TokenStoreWriter:
+    def __init__(self, root: str, meta: dict):
+        self.root = root
+        self.meta = meta
+        os.makedirs(root, exist_ok=True)
+        self.files = {
+            name: open(os.path.join(root, "%s.bin.tmp" % name), "wb") for name in ("semantic", "phoneme", "bert")
+        }
+        self.offsets = {"semantic": 0, "phoneme": 0, "bert": 0}
+        self.names = []
+        self.index = []
+
+    def _write(self, name: str, array: np.ndarray) -> int:
+        offset = self.offsets[name]
+        self.files[name].write(np.ascontiguousarray(array).tobytes())
+        self.offsets[name] += array.size
+        return offset
+
+    def add(self, item_name: str, semantic_ids: List[int], phoneme_ids: List[int], bert: Optional[torch.Tensor]):
+        semantic_ids = np.asarray(semantic_ids, dtype=np.int16)
+        phoneme_ids = np.asarray(phoneme_ids, dtype=np.int16)
+        bert_offset = -1
+        if bert is not None:
+            assert tuple(bert.shape) == (BERT_DIM, len(phoneme_ids)), (item_name, bert.shape)
+            bert_offset = self._write("bert", bert.detach().cpu().half().numpy())
+        self.index.append(
+            [
+                self._write("semantic", semantic_ids),
+                len(semantic_ids),
+                self._write("phoneme", phoneme_ids),
+                len(phoneme_ids),
+                bert_offset,
+            ]
+        )
+        self.names.append(item_name)
+
+    def close(self):
+        for name, f in self.files.items():
+            f.close()
+            shutil.move(os.path.join(self.root, "%s.bin.tmp" % name), os.path.join(self.root, "%s.bin" % name))
+        np.save(os.path.join(self.root, "index.npy"), np.asarray(self.index, dtype=np.int64).reshape(-1, 5))
+        with open(os.path.join(self.root, "names.txt"), "w", encoding="utf8") as f:
+            f.write("\n".join(self.names))
+        ### meta最后写, 作为store完整的标志
+        with open(os.path.join(self.root, "meta.json"), "w", encoding="utf8") as f:
+            json.dump(self.meta, f, ensure_ascii=False)
+
+
+class TokenStore:
+    def __init__(self, root: str):
+        self.root = root
+        with open(os.path.join(root, "meta.json"), "r", encoding="utf8") as f:
+            self.meta = json.load(f)
+        self.index: np.ndarray = np.load(os.path.join(root, "index.npy"))
+        with open(os.path.join(root, "names.txt"), "r", encoding="utf8") as f:
+            self.names: List[str] = f.read().split("\n") if len(self.index) > 0 else []
+        self._maps = {}
+
+    @classmethod
+    def open(cls, exp_dir: str, version: str, sources: List[str]) -> Optional["TokenStore"]:
+        root = "%s/%s" % (exp_dir, TOKEN_STORE_DIR)
+        if not os.path.exists(os.path.join(root, "meta.json")):
+            return None
+        store = cls(root)
+        if store.meta.get("version") != version or store.meta.get("sources") != source_signature(sources):
+            print("token store %s is stale (version or source files changed), ignored" % root)
+            return None
+        print("using token store:", root)
+        return store
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_maps"] = {}
+        return state
+
+    def _map(self, name: str, dtype) -> np.memmap:
+        mm = self._maps.get(name)
+        if mm is None:
+            mm = np.memmap(os.path.join(self.root, "%s.bin" % name), dtype=dtype, mode="c")
+            self._maps[name] = mm
+        return mm
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def semantic(self, row: int) -> np.ndarray:
+        offset, length = self.index[row, SEM_OFFSET], self.index[row, SEM_LEN]
+        return self._map("semantic", np.int16)[offset : offset + length]
+
+    def phoneme(self, row: int) -> np.ndarray:
+        offset, length = self.index[row, PHONE_OFFSET], self.index[row, PHONE_LEN]
+        return self._map("phoneme", np.int16)[offset : offset + length]
+
+    def bert(self, row: int) -> Optional[torch.Tensor]:
+        offset, length = self.index[row, BERT_OFFSET], self.index[row, PHONE_LEN]
+        if offset < 0:
+            return None
+        bert = self._map("bert", np.float16)[offset : offset + BERT_DIM * length]
+        return torch.from_numpy(bert.reshape(BERT_DIM, length))
@@ -0,0 +1,96 @@
+### T2S prompt pass(prefill)的重复对缓存: 同一(参考音频+参考文本, 句子)再次出现时直接复用各层K/V;
+### 不同句子之间不能复用参考部分, 见PrefillCache
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import torch
+
+
+def prefill_key(
+    x: torch.Tensor, bert_feature: torch.Tensor, prompts: Optional[torch.Tensor], dtype: torch.dtype
+) -> str:
+    """
+    Digest of everything the prompt pass depends on: phoneme ids (prompt + sentence), prompt semantic tokens,
+    the model dtype and a summary of the phone-level bert feature.
+    The bert feature matters: homophones share phoneme ids but not bert features. It is summarized on its device
+    (sum and sum of squares over the channels of every phone), so only 2 floats per phone are copied to the host
+    instead of the whole (1024, T) feature.
+    """
+    feature = bert_feature.detach().float()
+    summary = torch.stack([feature.sum(-2), feature.square().sum(-2)])
+    h = hashlib.blake2b(digest_size=20)
+    h.update(str(dtype).encode())
+    h.update(x.detach().to(device="cpu", dtype=torch.int64).numpy().tobytes())
+    h.update(summary.cpu().numpy().tobytes())
+    if prompts is not None:
+        h.update(b"|")
+        h.update(prompts.detach().to(device="cpu", dtype=torch.int64).numpy().tobytes())
+    return h.hexdigest()
+
+
+class PrefillCache:
+    """
+    Repeated-pair cache: LRU cache of prompt pass results (last position logits, per-layer k/v) for
+    (reference, sentence) pairs seen before, bounded by the total size of the cached tensors.
+
+    It does not reuse the reference across different sentences: in the layout the model is trained on, the
+    reference text attends bidirectionally to the sentence text, and the reference semantic tokens come after
+    the sentence and attend to it, so no part of the k/v is independent of the sentence.
+    Cached tensors are shared with the caller and must not be modified in place
+    (decode_next_token concatenates, the static/graph caches copy).
+    """
+
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def entry_bytes(logits: torch.Tensor, k_cache: List[torch.Tensor], v_cache: List[torch.Tensor]) -> int:
+        return sum(t.numel() * t.element_size() for t in [logits] + k_cache + v_cache)
+
+    def get(self, key: str) -> Optional[Tuple[torch.Tensor, List[torch.Tensor], List[torch.Tensor]]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            logits, k_cache, v_cache, _ = entry
+            return logits, list(k_cache), list(v_cache)
+
+    def put(self, key: str, logits: torch.Tensor, k_cache: List[torch.Tensor], v_cache: List[torch.Tensor]):
+        ### process_prompt返回的k/v是qkv输出的切片, clone后只保留k/v本身的显存
+        logits = logits.clone()
+        k_cache = [k.clone() for k in k_cache]
+        v_cache = [v.clone() for v in v_cache]
+        nbytes = self.entry_bytes(logits, k_cache, v_cache)
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = (logits, k_cache, v_cache, nbytes)
+            self.current_bytes += nbytes
+            while self.current_bytes > self.max_bytes:
+                _, (_, _, _, _nbytes) = self._entries.popitem(last=False)
+                self.current_bytes -= _nbytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "bytes": self.current_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
@@ -0,0 +1,193 @@
+### T2S逐token解码的整步捕获: embedding + 位置编码 + 全部block + predict layer + 采样
+### 只用于CUDA: 录制成CUDA Graph后每步只replay一次; 其他设备上torch.compile无法追踪TorchScript的T2SBlock,
+### 由调用方退回decode_next_token_static
+import threading
+from collections import OrderedDict
+from typing import List, Optional
+
+import torch
+
+from AR.models.utils import sample_batched
+
+MAX_CACHED_GRAPHS = 4
+# 保护各模型的decode_graphs字典(查找、捕获、淘汰)
+_graphs_lock = threading.Lock()
+
+
+class T2SDecodeGraph:
+    """
+    One captured decode step with static input/output buffers.
+
+    All per-step state lives in tensors owned by this object (kv cache of fixed `capacity`, last token,
+    write position, presence mask), and the step updates them in place, so that replaying it needs no
+    python-side tensor bookkeeping. Sampling parameters are baked in at capture time, as python scalars,
+    so the captured step does no host to device copies. CUDA only.
+    The buffers belong to one sequence at a time: `lock` is held from `acquire_decode_graph` to `release`.
+    """
+
+    def __init__(
+        self,
+        model,
+        batch_size: int,
+        capacity: int,
+        dtype: torch.dtype,
+        device: torch.device,
+        top_k: int,
+        top_p: float,
+        temperature: float,
+        repetition_penalty: float,
+    ):
+        self.model = model
+        self.capacity = capacity
+        self.top_k = top_k
+        self.top_p = top_p
+        self.temperature = temperature
+        self.repetition_penalty = repetition_penalty
+
+        self.k_cache: List[torch.Tensor] = []
+        self.v_cache: List[torch.Tensor] = []
+        for _ in range(model.num_layers):
+            self.k_cache.append(torch.zeros((batch_size, capacity, model.model_dim), dtype=dtype, device=device))
+            self.v_cache.append(torch.zeros((batch_size, capacity, model.model_dim), dtype=dtype, device=device))
+        self.y_last = torch.zeros((batch_size, 1), dtype=torch.long, device=device)
+        self.kv_pos = torch.zeros((1,), dtype=torch.long, device=device)
+        self.pe_pos = torch.zeros((1,), dtype=torch.long, device=device)
+        self.presence_mask = torch.zeros((batch_size, model.vocab_size), dtype=torch.bool, device=device)
+        self.eos_bias = torch.zeros((1, model.vocab_size), dtype=dtype, device=device)
+        self.positions = torch.arange(capacity, device=device).view(1, 1, 1, capacity)
+
+        position = model.ar_audio_position
+        position.extend_pe(torch.zeros((1, capacity), dtype=dtype, device=device))
+        self.pe = position.pe[0].to(dtype=dtype, device=device).clone()
+
+        assert device.type == "cuda", "T2SDecodeGraph needs a CUDA device"
+        self.lock = threading.Lock()
+        self.graph = None
+        self._capture()
+
+    def _step(self):
+        model = self.model
+        position = model.ar_audio_position
+        y_emb = model.ar_audio_embedding(self.y_last)
+        xy_pos = y_emb * position.x_scale + position.alpha * self.pe.index_select(0, self.pe_pos).unsqueeze(0)
+        attn_mask = self.positions > self.kv_pos  # True = masked, hides the unused tail of the cache
+        xy_dec = model.t2s_transformer.decode_next_token_graph(
+            xy_pos, self.k_cache, self.v_cache, self.kv_pos, attn_mask
+        )
+        logits = model.ar_predict_layer(xy_dec[:, -1]) + self.eos_bias
+
+        samples, tokens = sample_batched(
+            logits,
+            self.presence_mask,
+            top_k=self.top_k,
+            top_p=self.top_p,
+            repetition_penalty=self.repetition_penalty,
+            temperature=self.temperature,
+        )
+        self.presence_mask.scatter_(1, samples.long(), True)
+        self.y_last.copy_(samples)
+        self.kv_pos.add_(1)
+        self.pe_pos.add_(1)
+        return samples, tokens
+
+    @torch.no_grad()
+    def _capture(self):
+        ### 先在旁路stream上预热(cuBLAS workspace等), 再录制; 预热写入的缓存内容由load覆盖
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(3):
+                self._step()
+        torch.cuda.current_stream().wait_stream(stream)
+
+        self.graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(self.graph):
+            self.samples, self.tokens = self._step()
+
+    def load(
+        self,
+        k_cache: List[torch.Tensor],
+        v_cache: List[torch.Tensor],
+        y_last: torch.Tensor,
+        pe_pos: int,
+        presence_mask: torch.Tensor,
+    ):
+        """
+        Start a new sequence from the kv cache of process_prompt (kv_len columns) and its first sampled token.
+        The next step writes at column kv_len and uses audio position pe_pos.
+        """
+        kv_len = k_cache[0].shape[1]
+        for buf, k in zip(self.k_cache, k_cache):
+            buf[:, :kv_len].copy_(k)
+        for buf, v in zip(self.v_cache, v_cache):
+            buf[:, :kv_len].copy_(v)
+        self.y_last.copy_(y_last)
+        self.kv_pos.fill_(kv_len)
+        self.pe_pos.fill_(pe_pos)
+        self.presence_mask.copy_(presence_mask)
+        self.allow_eos(True)
+
+    def allow_eos(self, allow: bool):
+        ### 等价于原循环里的logits[:, :-1]: 前几步不允许采样到EOS
+        self.eos_bias[:, self.model.EOS] = 0 if allow else -float("Inf")
+
+    def step(self):
+        """
+        Returns:
+            samples (B, 1) int, greedy tokens (B,). Both are static buffers, overwritten by the next step.
+        """
+        self.graph.replay()
+        return self.samples, self.tokens
+
+    def release(self):
+        self.lock.release()
+
+
+def acquire_decode_graph(
+    model,
+    batch_size: int,
+    min_capacity: int,
+    dtype: torch.dtype,
+    device: torch.device,
+    top_k: int,
+    top_p: float,
+    temperature: float,
+    repetition_penalty: float,
+) -> Optional[T2SDecodeGraph]:
+    """
+    Captured step for these shapes and sampling parameters, reused across requests.
+    The capacity is rounded up to a multiple of 512 so that different prompt lengths share a graph.
+    The graph is returned locked for the caller's whole sequence, call `graph.release()` when done;
+    returns None while another sequence is replaying it, the caller then decodes without a graph.
+    """
+    capacity = (min_capacity + 511) // 512 * 512
+    ### 权重地址也放进key: 模型换精度/设备后旧graph里记录的地址已失效
+    key = (
+        batch_size,
+        capacity,
+        dtype,
+        str(device),
+        top_k,
+        top_p,
+        temperature,
+        repetition_penalty,
+        model.ar_predict_layer.weight.data_ptr(),
+    )
+    graphs: OrderedDict = model.decode_graphs
+    with _graphs_lock:
+        if key in graphs:
+            graphs.move_to_end(key)
+            graph = graphs[key]
+            return graph if graph.lock.acquire(blocking=False) else None
+        graph = T2SDecodeGraph(
+            model, batch_size, capacity, dtype, device, top_k, top_p, temperature, repetition_penalty
+        )
+        graph.lock.acquire()
+        graphs[key] = graph
+        ### 正在replay的graph不淘汰, 全部在用时暂时超出上限
+        for old_key in list(graphs.keys())[:-1]:
+            if len(graphs) <= MAX_CACHED_GRAPHS:
+                break
+            if not graphs[old_key].lock.locked():
+                del graphs[old_key]
+    return graph
@@ -1,6 +1,7 @@
 # modified from https://github.com/yangdongchao/SoundStorm/blob/master/soundstorm/s1/AR/models/t2s_model.py
 # reference: https://github.com/lifeiteng/vall-e
 import math
+from collections import OrderedDict
 from typing import List, Optional
 
 import torch
@@ -10,13 +11,16 @@ from torch.nn import functional as F
 from torchmetrics.classification import MulticlassAccuracy
 from tqdm import tqdm
 
+from AR.models.prefill_cache import PrefillCache, prefill_key
+from AR.models.t2s_graph import acquire_decode_graph
 from AR.models.utils import (
     dpo_loss,
     get_batch_logps,
     make_pad_mask,
     make_pad_mask_left,
+    make_presence_mask,
     make_reject_y,
-    sample,
+    sample_batched,
     topk_sampling,
 )
 from AR.modules.embedding import SinePositionalEmbedding, TokenEmbedding
@@ -71,6 +75,13 @@ def scaled_dot_product_attention(
     return attn_weight @ value
 
 
+def int8_linear(x: torch.Tensor, w: torch.Tensor, b: torch.Tensor, packed) -> torch.Tensor:
+    ### packed为int8动态量化的预打包权重时走量化矩阵乘(cpu_fast, 见TTS_infer_pack/cpu_fast.py), 否则即F.linear
+    if packed is None:
+        return F.linear(x, w, b)
+    return torch.ops.quantized.linear_dynamic(x, packed, True)
+
+
 @torch.jit.script
 class T2SMLP:
     def __init__(self, w1, b1, w2, b2):
@@ -79,9 +90,17 @@ class T2SMLP:
         self.w2 = w2
         self.b2 = b2
 
+    @torch.jit.ignore
+    def linear1(self, x: torch.Tensor) -> torch.Tensor:
+        return int8_linear(x, self.w1, self.b1, getattr(self, "w1_int8", None))
+
+    @torch.jit.ignore
+    def linear2(self, x: torch.Tensor) -> torch.Tensor:
+        return int8_linear(x, self.w2, self.b2, getattr(self, "w2_int8", None))
+
     def forward(self, x):
-        x = F.relu(F.linear(x, self.w1, self.b1))
-        x = F.linear(x, self.w2, self.b2)
+        x = F.relu(self.linear1(x))
+        x = self.linear2(x)
         return x
 
 
@@ -119,6 +138,14 @@ class T2SBlock:
 
         self.false = torch.tensor(False, dtype=torch.bool)
 
+    @torch.jit.ignore
+    def qkv(self, x: torch.Tensor) -> torch.Tensor:
+        return int8_linear(x, self.qkv_w, self.qkv_b, getattr(self, "qkv_int8", None))
+
+    @torch.jit.ignore
+    def out_proj(self, x: torch.Tensor) -> torch.Tensor:
+        return int8_linear(x, self.out_w, self.out_b, getattr(self, "out_int8", None))
+
     @torch.jit.ignore
     def to_mask(
         self,
@@ -140,7 +167,7 @@ class T2SBlock:
         padding_mask: Optional[torch.Tensor] = None,
         torch_sdpa: bool = True,
     ):
-        q, k, v = F.linear(self.to_mask(x, padding_mask), self.qkv_w, self.qkv_b).chunk(3, dim=-1)
+        q, k, v = self.qkv(self.to_mask(x, padding_mask)).chunk(3, dim=-1)
 
         batch_size = q.shape[0]
         q_len = q.shape[1]
@@ -160,7 +187,7 @@ class T2SBlock:
             attn = scaled_dot_product_attention(q, k, v, attn_mask)
 
         attn = attn.transpose(1, 2).reshape(batch_size, q_len, -1)
-        attn = F.linear(self.to_mask(attn, padding_mask), self.out_w, self.out_b)
+        attn = self.out_proj(self.to_mask(attn, padding_mask))
 
         x = x + attn
         x = F.layer_norm(x, [self.hidden_dim], self.norm_w1, self.norm_b1, self.norm_eps1)
@@ -182,7 +209,7 @@ class T2SBlock:
         attn_mask: torch.Tensor = None,
         torch_sdpa: bool = True,
     ):
-        q, k, v = F.linear(x, self.qkv_w, self.qkv_b).chunk(3, dim=-1)
+        q, k, v = self.qkv(x).chunk(3, dim=-1)
 
         k_cache = torch.cat([k_cache, k], dim=1)
         v_cache = torch.cat([v_cache, v], dim=1)
@@ -201,7 +228,7 @@ class T2SBlock:
             attn = scaled_dot_product_attention(q, k, v, attn_mask)
 
         attn = attn.transpose(1, 2).reshape(batch_size, q_len, -1)
-        attn = F.linear(attn, self.out_w, self.out_b)
+        attn = self.out_proj(attn)
 
         x = x + attn
         x = F.layer_norm(
@@ -221,6 +248,111 @@ class T2SBlock:
         )
         return x, k_cache, v_cache
 
+    def decode_next_token_static(
+        self,
+        x: torch.Tensor,
+        k_cache: torch.Tensor,
+        v_cache: torch.Tensor,
+        kv_len: int,
+        attn_mask: Optional[torch.Tensor] = None,
+        torch_sdpa: bool = True,
+    ):
+        """
+        Same as decode_next_token, but k_cache/v_cache are preallocated (B, capacity, D) buffers.
+        The new k/v are written in place at position kv_len and attention only reads the first kv_len + 1 columns.
+        """
+        q, k, v = self.qkv(x).chunk(3, dim=-1)
+
+        k_cache.narrow(1, kv_len, 1).copy_(k)
+        v_cache.narrow(1, kv_len, 1).copy_(v)
+
+        batch_size = q.shape[0]
+        q_len = q.shape[1]
+        kv_len = kv_len + 1
+
+        q = q.view(batch_size, q_len, self.num_heads, -1).transpose(1, 2)
+        k = k_cache.narrow(1, 0, kv_len).view(batch_size, kv_len, self.num_heads, -1).transpose(1, 2)
+        v = v_cache.narrow(1, 0, kv_len).view(batch_size, kv_len, self.num_heads, -1).transpose(1, 2)
+
+        if torch_sdpa:
+            attn = F.scaled_dot_product_attention(q, k, v, (~attn_mask) if attn_mask is not None else None)
+        else:
+            attn = scaled_dot_product_attention(q, k, v, attn_mask)
+
+        attn = attn.transpose(1, 2).reshape(batch_size, q_len, -1)
+        attn = self.out_proj(attn)
+
+        x = x + attn
+        x = F.layer_norm(
+            x,
+            [self.hidden_dim],
+            self.norm_w1,
+            self.norm_b1,
+            self.norm_eps1,
+        )
+        x = x + self.mlp.forward(x)
+        x = F.layer_norm(
+            x,
+            [self.hidden_dim],
+            self.norm_w2,
+            self.norm_b2,
+            self.norm_eps2,
+        )
+        return x
+
+    def decode_next_token_graph(
+        self,
+        x: torch.Tensor,
+        k_cache: torch.Tensor,
+        v_cache: torch.Tensor,
+        kv_pos: torch.Tensor,
+        attn_mask: torch.Tensor,
+        torch_sdpa: bool = True,
+    ):
+        """
+        Shape-static variant of decode_next_token_static for graph capture / torch.compile:
+        the write position kv_pos is a (1,) tensor instead of a python int, and attention always
+        reads the whole (B, capacity, D) cache, with attn_mask (B, 1, 1, capacity) (True = masked) hiding the unused tail.
+        """
+        q, k, v = self.qkv(x).chunk(3, dim=-1)
+
+        k_cache.index_copy_(1, kv_pos, k)
+        v_cache.index_copy_(1, kv_pos, v)
+
+        batch_size = q.shape[0]
+        q_len = q.shape[1]
+        kv_len = k_cache.shape[1]
+
+        q = q.view(batch_size, q_len, self.num_heads, -1).transpose(1, 2)
+        k = k_cache.view(batch_size, kv_len, self.num_heads, -1).transpose(1, 2)
+        v = v_cache.view(batch_size, kv_len, self.num_heads, -1).transpose(1, 2)
+
+        if torch_sdpa:
+            attn = F.scaled_dot_product_attention(q, k, v, ~attn_mask)
+        else:
+            attn = scaled_dot_product_attention(q, k, v, attn_mask)
+
+        attn = attn.transpose(1, 2).reshape(batch_size, q_len, -1)
+        attn = self.out_proj(attn)
+
+        x = x + attn
+        x = F.layer_norm(
+            x,
+            [self.hidden_dim],
+            self.norm_w1,
+            self.norm_b1,
+            self.norm_eps1,
+        )
+        x = x + self.mlp.forward(x)
+        x = F.layer_norm(
+            x,
+            [self.hidden_dim],
+            self.norm_w2,
+            self.norm_b2,
+            self.norm_eps2,
+        )
+        return x
+
 
 @torch.jit.script
 class T2STransformer:
@@ -257,6 +389,32 @@ class T2STransformer:
             )
         return x, k_cache, v_cache
 
+    def decode_next_token_static(
+        self,
+        x: torch.Tensor,
+        k_cache: List[torch.Tensor],
+        v_cache: List[torch.Tensor],
+        kv_len: int,
+        attn_mask: Optional[torch.Tensor] = None,
+        torch_sdpa: bool = True,
+    ):
+        for i in range(self.num_blocks):
+            x = self.blocks[i].decode_next_token_static(x, k_cache[i], v_cache[i], kv_len, attn_mask, torch_sdpa)
+        return x
+
+    def decode_next_token_graph(
+        self,
+        x: torch.Tensor,
+        k_cache: List[torch.Tensor],
+        v_cache: List[torch.Tensor],
+        kv_pos: torch.Tensor,
+        attn_mask: torch.Tensor,
+        torch_sdpa: bool = True,
+    ):
+        for i in range(self.num_blocks):
+            x = self.blocks[i].decode_next_token_graph(x, k_cache[i], v_cache[i], kv_pos, attn_mask, torch_sdpa)
+        return x
+
 
 class Text2SemanticDecoder(nn.Module):
     def __init__(self, config, norm_first=False, top_k=3):
@@ -352,6 +510,10 @@ class Text2SemanticDecoder(nn.Module):
             blocks.append(block)
 
         self.t2s_transformer = T2STransformer(self.num_layers, blocks)
+        # 已捕获的解码step, 见AR.models.t2s_graph
+        self.decode_graphs = OrderedDict()
+        # 重复的(参考, 句子)复用prompt pass的结果, 由推理端按需设置
+        self.prefill_cache: Optional[PrefillCache] = None
 
     def make_input_data(self, x, x_lens, y, y_lens, bert_feature):
         x = self.ar_text_embedding(x)
@@ -581,6 +743,51 @@ class Text2SemanticDecoder(nn.Module):
         # 错位
         return targets[:, :-1], targets[:, 1:]
 
+    def alloc_static_kv_cache(self, k_cache: List[torch.Tensor], v_cache: List[torch.Tensor], capacity: int):
+        """
+        Copy the kv cache produced by process_prompt into fixed-capacity buffers,
+        so that decoding writes every new token in place instead of torch.cat-ing the whole cache.
+        """
+        kv_len = k_cache[0].shape[1]
+        static_k_cache: List[torch.Tensor] = []
+        static_v_cache: List[torch.Tensor] = []
+        for k, v in zip(k_cache, v_cache):
+            k_buf = k.new_zeros((k.shape[0], capacity, k.shape[2]))
+            v_buf = v.new_zeros((v.shape[0], capacity, v.shape[2]))
+            k_buf[:, :kv_len] = k
+            v_buf[:, :kv_len] = v
+            static_k_cache.append(k_buf)
+            static_v_cache.append(v_buf)
+        return static_k_cache, static_v_cache
+
+    def cached_prompt_pass(
+        self,
+        key: Optional[str],
+        xy_pos: torch.Tensor,
+        xy_attn_mask: torch.Tensor,
+        torch_sdpa: bool = True,
+    ):
+        """
+        process_prompt + predict layer on the last position, served from self.prefill_cache when key is not None.
+
+        Returns:
+            logits (B, vocab_size), k_cache, v_cache
+        """
+        if key is not None:
+            hit = self.prefill_cache.get(key)
+            if hit is not None:
+                return hit
+        xy_dec, k_cache, v_cache = self.t2s_transformer.process_prompt(xy_pos, xy_attn_mask, None, torch_sdpa)
+        logits = self.ar_predict_layer(xy_dec[:, -1])
+        if key is not None:
+            self.prefill_cache.put(key, logits, k_cache, v_cache)
+        return logits, k_cache, v_cache
+
+    def get_prefill_key(self, x: torch.Tensor, bert_feature: torch.Tensor, prompts: Optional[torch.Tensor]):
+        if self.prefill_cache is None:
+            return None
+        return prefill_key(x, bert_feature, prompts, self.ar_predict_layer.weight.dtype)
+
     def infer_panel_batch_infer(
         self,
         x: List[torch.LongTensor],  #####全部文本token
@@ -696,30 +903,55 @@ class Text2SemanticDecoder(nn.Module):
         # [PAD, PAD, PAD, 1, 2, 3,   4,   5,   6]]
 
         ###### decode #####
+        static_kv_cache = kwargs.get("static_kv_cache", False)
+        generator = kwargs.get("generator", None)
+        kv_len = src_len
+        presence_mask = make_presence_mask(y, self.vocab_size)
         y_list = [None] * y.shape[0]
         batch_idx_map = list(range(y.shape[0]))
         idx_list = [None] * y.shape[0]
         for idx in tqdm(range(1500)):
             if idx == 0:
                 xy_dec, k_cache, v_cache = self.t2s_transformer.process_prompt(xy_pos, attn_mask, None)
+            elif static_kv_cache:
+                xy_dec = self.t2s_transformer.decode_next_token_static(
+                    xy_pos, k_cache, v_cache, kv_len, attn_mask[..., : kv_len + 1]
+                )
+                kv_len += 1
             else:
                 xy_dec, k_cache, v_cache = self.t2s_transformer.decode_next_token(xy_pos, k_cache, v_cache, attn_mask)
             logits = self.ar_predict_layer(xy_dec[:, -1])
 
             if idx == 0:
-                attn_mask = F.pad(attn_mask[:, :, -1].unsqueeze(-2), (0, 1), value=False)
+                if static_kv_cache:
+                    ### 按early_stop_num预分配kv cache和mask, 之后每步原地写入
+                    capacity = src_len + (early_stop_num if early_stop_num != -1 else 1500) + 1
+                    k_cache, v_cache = self.alloc_static_kv_cache(k_cache, v_cache, capacity)
+                    prompt_attn_mask = attn_mask[:, :, -1].unsqueeze(-2)
+                    attn_mask = torch.zeros(
+                        (bsz, prompt_attn_mask.shape[1], 1, capacity), dtype=torch.bool, device=x.device
+                    )
+                    attn_mask[..., :src_len] = prompt_attn_mask
+                else:
+                    attn_mask = F.pad(attn_mask[:, :, -1].unsqueeze(-2), (0, 1), value=False)
                 logits = logits[:, :-1]
-            else:
+            elif not static_kv_cache:
                 attn_mask = F.pad(attn_mask, (0, 1), value=False)
 
-            samples = sample(
-                logits, y, top_k=top_k, top_p=top_p, repetition_penalty=repetition_penalty, temperature=temperature
-            )[0]
+            samples, tokens = sample_batched(
+                logits,
+                presence_mask,
+                top_k=top_k,
+                top_p=top_p,
+                repetition_penalty=repetition_penalty,
+                temperature=temperature,
+                generator=generator,
+            )
+            presence_mask.scatter_(1, samples.long(), True)
 
             y = torch.concat([y, samples], dim=1)
 
             ####### 移除batch中已经生成完毕的序列,进一步优化计算量
-            tokens = torch.argmax(logits, dim=-1)
             reserved_idx_of_batch_for_y = None
             if (self.EOS in samples[:, 0]) or (self.EOS in tokens):  ###如果生成到EOS，则停止
                 l1 = samples[:, 0] == self.EOS
@@ -739,6 +971,7 @@ class Text2SemanticDecoder(nn.Module):
             if reserved_idx_of_batch_for_y is not None:
                 # index = torch.LongTensor(batch_idx_map).to(y.device)
                 y = torch.index_select(y, dim=0, index=reserved_idx_of_batch_for_y)
+                presence_mask = torch.index_select(presence_mask, dim=0, index=reserved_idx_of_batch_for_y)
                 attn_mask = torch.index_select(attn_mask, dim=0, index=reserved_idx_of_batch_for_y)
                 if k_cache is not None:
                     for i in range(len(k_cache)):
@@ -825,6 +1058,52 @@ class Text2SemanticDecoder(nn.Module):
         repetition_penalty: float = 1.35,
         **kwargs,
     ):
+        for pred_semantic, _ in self.infer_panel_naive_stream(
+            x,
+            x_lens,
+            prompts,
+            bert_feature,
+            top_k,
+            top_p,
+            early_stop_num,
+            temperature,
+            repetition_penalty,
+            chunk_length=-1,
+            **kwargs,
+        ):
+            pass
+
+        if prompts is None:
+            return pred_semantic, 0
+        return torch.concat([prompts, pred_semantic.to(prompts.dtype)], dim=1), pred_semantic.shape[1]
+
+    def infer_panel_naive_stream(
+        self,
+        x: torch.LongTensor,  #####全部文本token
+        x_lens: torch.LongTensor,
+        prompts: torch.LongTensor,  ####参考音频token
+        bert_feature: torch.LongTensor,
+        top_k: int = -100,
+        top_p: int = 100,
+        early_stop_num: int = -1,
+        temperature: float = 1.0,
+        repetition_penalty: float = 1.35,
+        chunk_length: int = 24,
+        **kwargs,
+    ):
+        """
+        Same decoding as `infer_panel_naive` (batch size 1), but yields the semantic tokens
+        generated so far every `chunk_length` tokens, so the caller can start vocoding before EOS.
+        chunk_length=-1 only yields the final result.
+        decode_graph=True runs every step after the prompt as one captured CUDA graph (see AR.models.t2s_graph);
+        on other devices it falls back to static_kv_cache.
+        generator: torch.Generator to sample with; the captured graph samples from the global CUDA generator.
+
+        Yields:
+            pred_semantic (1, n): all tokens generated so far, without the prompt and the EOS token
+            is_final (bool)
+        """
+        key = self.get_prefill_key(x, bert_feature, prompts)
         x = self.ar_text_embedding(x)
         x = x + self.bert_proj(bert_feature.transpose(1, 2))
         x = self.ar_text_position(x)
@@ -876,47 +1155,103 @@ class Text2SemanticDecoder(nn.Module):
             .to(device=x.device, dtype=torch.bool)
         )
 
-        for idx in tqdm(range(1500)):
-            if xy_attn_mask is not None:
-                xy_dec, k_cache, v_cache = self.t2s_transformer.process_prompt(xy_pos, xy_attn_mask, None)
-            else:
-                xy_dec, k_cache, v_cache = self.t2s_transformer.decode_next_token(xy_pos, k_cache, v_cache)
-
-            logits = self.ar_predict_layer(xy_dec[:, -1])
-
-            if idx == 0:
-                xy_attn_mask = None
-            if idx < 11:  ###至少预测出10个token不然不给停止（0.4s）
-                logits = logits[:, :-1]
-
-            samples = sample(
-                logits, y, top_k=top_k, top_p=top_p, repetition_penalty=repetition_penalty, temperature=temperature
-            )[0]
-
-            y = torch.concat([y, samples], dim=1)
-
-            if early_stop_num != -1 and (y.shape[1] - prefix_len) > early_stop_num:
-                print("use early stop num:", early_stop_num)
-                stop = True
-
-            if torch.argmax(logits, dim=-1)[0] == self.EOS or samples[0, 0] == self.EOS:
-                stop = True
-            if stop:
-                if y.shape[1] == 0:
-                    y = torch.concat([y, torch.zeros_like(samples)], dim=1)
-                    print("bad zero prediction")
-                print(f"T2S Decoding EOS [{prefix_len} -> {y.shape[1]}]")
-                break
-
-            ####################### update next step ###################################
-            y_emb = self.ar_audio_embedding(y[:, -1:])
-            xy_pos = y_emb * self.ar_audio_position.x_scale + self.ar_audio_position.alpha * self.ar_audio_position.pe[
-                :, y_len + idx
-            ].to(dtype=y_emb.dtype, device=y_emb.device)
-
-        if ref_free:
-            return y[:, :-1], 0
-        return y[:, :-1], idx
+        decode_graph = kwargs.get("decode_graph", False)
+        static_kv_cache = kwargs.get("static_kv_cache", False)
+        if decode_graph and x.device.type != "cuda":
+            ### 整步捕获只支持CUDA, 其他设备退回预分配的静态kv cache
+            decode_graph = False
+            static_kv_cache = True
+        static_kv_cache = static_kv_cache and not decode_graph
+        generator = kwargs.get("generator", None)
+        graph = None
+        kv_len = src_len
+        presence_mask = make_presence_mask(y, self.vocab_size)
+        try:
+            for idx in tqdm(range(1500)):
+                if graph is not None:
+                    if idx == 11:
+                        graph.allow_eos(True)
+                    samples, tokens = graph.step()
+                else:
+                    if xy_attn_mask is not None:
+                        logits, k_cache, v_cache = self.cached_prompt_pass(key, xy_pos, xy_attn_mask)
+                    elif static_kv_cache:
+                        xy_dec = self.t2s_transformer.decode_next_token_static(xy_pos, k_cache, v_cache, kv_len, None)
+                        logits = self.ar_predict_layer(xy_dec[:, -1])
+                        kv_len += 1
+                    else:
+                        xy_dec, k_cache, v_cache = self.t2s_transformer.decode_next_token(xy_pos, k_cache, v_cache)
+                        logits = self.ar_predict_layer(xy_dec[:, -1])
+
+                    if idx == 0:
+                        xy_attn_mask = None
+                        capacity = src_len + (early_stop_num if early_stop_num != -1 else 1500) + 1
+                        if decode_graph:
+                            graph = acquire_decode_graph(
+                                self,
+                                bsz,
+                                capacity,
+                                k_cache[0].dtype,
+                                k_cache[0].device,
+                                top_k,
+                                top_p,
+                                temperature,
+                                repetition_penalty,
+                            )
+                            ### 同参数的graph正被其他请求replay, 本句退回静态kv cache
+                            static_kv_cache = graph is None
+                        if static_kv_cache:
+                            k_cache, v_cache = self.alloc_static_kv_cache(k_cache, v_cache, capacity)
+                    if idx < 11:  ###至少预测出10个token不然不给停止（0.4s）
+                        logits = logits[:, :-1]
+
+                    samples, tokens = sample_batched(
+                        logits,
+                        presence_mask,
+                        top_k=top_k,
+                        top_p=top_p,
+                        repetition_penalty=repetition_penalty,
+                        temperature=temperature,
+                        generator=generator,
+                    )
+                    presence_mask.scatter_(1, samples.long(), True)
+
+                    if idx == 0 and graph is not None:
+                        graph.load(k_cache, v_cache, samples, y_len, presence_mask)
+                        graph.allow_eos(False)
+                        k_cache = v_cache = None
+
+                y = torch.concat([y, samples], dim=1)
+
+                if early_stop_num != -1 and (y.shape[1] - prefix_len) > early_stop_num:
+                    print("use early stop num:", early_stop_num)
+                    stop = True
+
+                if tokens[0] == self.EOS or samples[0, 0] == self.EOS:
+                    stop = True
+                if stop:
+                    if y.shape[1] == 0:
+                        y = torch.concat([y, torch.zeros_like(samples)], dim=1)
+                        print("bad zero prediction")
+                    print(f"T2S Decoding EOS [{prefix_len} -> {y.shape[1]}]")
+                    break
+
+                if chunk_length > 0 and (idx + 1) % chunk_length == 0:
+                    yield y[:, prefix_len:], False
+
+                ####################### update next step ###################################
+                if graph is not None:
+                    continue
+                y_emb = self.ar_audio_embedding(y[:, -1:])
+                position = self.ar_audio_position
+                xy_pos = y_emb * position.x_scale + position.alpha * position.pe[:, y_len + idx].to(
+                    dtype=y_emb.dtype, device=y_emb.device
+                )
+
+            yield y[:, prefix_len:-1], True
+        finally:
+            if graph is not None:
+                graph.release()
 
     def infer_panel(
         self,
@@ -934,3 +1269,68 @@ class Text2SemanticDecoder(nn.Module):
         return self.infer_panel_naive(
             x, x_lens, prompts, bert_feature, top_k, top_p, early_stop_num, temperature, repetition_penalty, **kwargs
         )
+
+    def prefill_row(
+        self,
+        x: torch.LongTensor,  #####单条文本token (x_len,)
+        bert_feature: torch.Tensor,  #####(1024, x_len)
+        prompt: torch.LongTensor,  ####参考音频token (y_len,)
+        torch_sdpa: bool = True,
+    ):
+        """
+        Run the prompt (prefill) pass for a single row, without any padding.
+
+        Used by the continuous batching scheduler, which prefills every row on its own
+        and merges the resulting kv cache into the running decode batch.
+
+        Returns:
+            logits (1, vocab_size), k_cache (List[(1, x_len + y_len, D)]), v_cache
+        """
+        key = self.get_prefill_key(x, bert_feature, prompt)
+        x = self.ar_text_embedding(x.unsqueeze(0))
+        x = x + self.bert_proj(bert_feature.transpose(0, 1).unsqueeze(0))
+        x = self.ar_text_position(x)
+
+        y_emb = self.ar_audio_embedding(prompt.unsqueeze(0))
+        y_pos = self.ar_audio_position(y_emb)
+        xy_pos = torch.concat([x, y_pos], dim=1)
+
+        x_len = x.shape[1]
+        y_len = y_emb.shape[1]
+        x_attn_mask = F.pad(
+            torch.zeros((x_len, x_len), dtype=torch.bool, device=x.device),
+            (0, y_len),
+            value=True,
+        )
+        y_attn_mask = F.pad(
+            torch.triu(torch.ones(y_len, y_len, dtype=torch.bool, device=x.device), diagonal=1),
+            (x_len, 0),
+            value=False,
+        )
+        xy_attn_mask = torch.concat([x_attn_mask, y_attn_mask], dim=0).view(1, 1, x_len + y_len, x_len + y_len)
+
+        return self.cached_prompt_pass(key, xy_pos, xy_attn_mask, torch_sdpa)
+
+    def decode_rows(
+        self,
+        y_last: torch.LongTensor,  #####(B, 1) 每行最后一个token
+        positions: torch.LongTensor,  #####(B,) 每行最后一个token在y中的位置
+        k_cache: List[torch.Tensor],
+        v_cache: List[torch.Tensor],
+        attn_mask: torch.Tensor,  #####(B, 1, 1, S+1), True表示被mask
+        torch_sdpa: bool = True,
+    ):
+        """
+        Decode one token for rows that are at different positions of their own sequences.
+
+        Returns:
+            logits (B, vocab_size), k_cache, v_cache
+        """
+        y_emb = self.ar_audio_embedding(y_last)
+        pe = self.ar_audio_position.pe[0].to(dtype=y_emb.dtype, device=y_emb.device)
+        xy_pos = y_emb * self.ar_audio_position.x_scale + self.ar_audio_position.alpha * pe[positions].unsqueeze(1)
+        xy_dec, k_cache, v_cache = self.t2s_transformer.decode_next_token(
+            xy_pos, k_cache, v_cache, attn_mask, torch_sdpa
+        )
+        logits = self.ar_predict_layer(xy_dec[:, -1])
+        return logits, k_cache, v_cache
@@ -199,6 +199,111 @@ def sample(
     return idx_next, probs
 
 
+def make_presence_mask(previous_tokens: torch.Tensor, vocab_size: int) -> torch.Tensor:
+    """
+    (B, vocab_size) bool mask of the tokens that appear in `previous_tokens` (B, T).
+    Kept up to date during decoding with `mask.scatter_(1, samples.long(), True)`.
+    """
+    mask = torch.zeros((previous_tokens.shape[0], vocab_size), dtype=torch.bool, device=previous_tokens.device)
+    if previous_tokens.shape[1] > 0:
+        mask.scatter_(1, previous_tokens.long(), True)
+    return mask
+
+
+def _per_row(value, default, batch_size: int):
+    """
+    Python list of length `batch_size` from a scalar / sequence / tensor sampling parameter.
+    """
+    if isinstance(value, torch.Tensor):
+        value = value.tolist()
+    if not isinstance(value, (list, tuple)):
+        value = [value] * batch_size
+    return [default if v is None else v for v in value]
+
+
+def exponential_like(values: torch.Tensor, generator=None) -> torch.Tensor:
+    """
+    Exp(1) noise shaped like `values`. `generator` is None (the global generator), one torch.Generator,
+    or one generator per row (None entries use the global generator), so that rows of different requests
+    sharing a batch draw from their own generators.
+    """
+    if generator is None or isinstance(generator, torch.Generator):
+        return torch.empty_like(values).exponential_(1, generator=generator)
+    if len(set(id(g) for g in generator)) == 1:
+        return torch.empty_like(values).exponential_(1, generator=generator[0])
+    q = torch.empty_like(values)
+    for i, g in enumerate(generator):
+        q[i].exponential_(1, generator=g)
+    return q
+
+
+def sample_batched(
+    logits: torch.Tensor,
+    presence_mask: Optional[torch.Tensor] = None,
+    top_k=None,
+    top_p=None,
+    temperature=1.0,
+    repetition_penalty=1.0,
+    generator=None,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Draws from the same distribution as `sample`, restructured for the decode loop:
+    the repetition penalty comes from a presence mask instead of gathering/scattering the whole history,
+    top-k is applied first so that top-p only sorts the k candidates,
+    and softmax + multinomial are fused into one argmax over exponentially perturbed logits.
+
+    The sampling parameters are scalars or per-row sequences of length B,
+    so rows with different settings can share one batch; `generator` is passed to `exponential_like`.
+
+    Returns:
+        samples (B, 1) int, greedy tokens (B,) i.e. the argmax of the penalized logits
+    """
+    batch_size, vocab_size = logits.shape
+    device = logits.device
+
+    repetition_penalty = _per_row(repetition_penalty, 1.0, batch_size)
+    if presence_mask is not None and any(rp != 1.0 for rp in repetition_penalty):
+        if len(set(repetition_penalty)) == 1:
+            rp = repetition_penalty[0]
+        else:
+            rp = torch.tensor(repetition_penalty, dtype=logits.dtype, device=device).view(batch_size, 1)
+        penalized = torch.where(logits < 0, logits * rp, logits / rp)
+        logits = torch.where(presence_mask[:, :vocab_size], penalized, logits)
+
+    top_k = [vocab_size if k <= 0 else min(k, vocab_size) for k in _per_row(top_k, vocab_size, batch_size)]
+    k = max(top_k)
+    values, indices = torch.topk(logits, k, dim=-1)
+    keep = None
+    if min(top_k) < k:
+        keep = torch.arange(k, device=device).view(1, k) < torch.tensor(top_k, device=device).view(batch_size, 1)
+
+    top_p = _per_row(top_p, 1.0, batch_size)
+    if any(p < 1.0 for p in top_p):
+        ### 累计概率仍按完整词表归一化, 与先排序整个词表的结果一致
+        cum_probs = torch.cumsum(torch.exp(values - torch.logsumexp(logits, dim=-1, keepdim=True)), dim=-1)
+        if len(set(top_p)) == 1:
+            ### 与python标量比较, 不产生host到device的拷贝(CUDA Graph录制时不允许)
+            remove = cum_probs > top_p[0]
+        else:
+            remove = cum_probs > torch.tensor(top_p, dtype=cum_probs.dtype, device=device).view(batch_size, 1)
+        remove[:, 0] = False  # keep at least one option
+        keep = ~remove if keep is None else keep.logical_and(~remove)
+
+    temperature = [max(t, 1e-5) for t in _per_row(temperature, 1.0, batch_size)]
+    if len(set(temperature)) == 1:
+        values = values / temperature[0]
+    else:
+        values = values / torch.tensor(temperature, dtype=values.dtype, device=device).view(batch_size, 1)
+    if keep is not None:
+        values = values.masked_fill(~keep, -float("Inf"))
+
+    ### argmax(softmax(v) / q) == argmax(v - log(q)), q ~ Exp(1)
+    q = exponential_like(values, generator)
+    choice = torch.argmax(values - torch.log(q), dim=-1, keepdim=True)
+    samples = torch.gather(indices, dim=-1, index=choice).to(dtype=torch.int)
+    return samples, indices[:, 0]
+
+
 def dpo_loss(
     policy_chosen_logps: torch.FloatTensor,
     policy_rejected_logps: torch.FloatTensor,
@@ -0,0 +1,230 @@
+import os
+import sys
+import threading
+import traceback
+from collections import deque
+from typing import Callable, List, Optional
+
+now_dir = os.getcwd()
+sys.path.append(now_dir)
+
+import torch
+import torch.nn.functional as F
+
+
+class CFMRow:
+    """
+    One sentence of v3/v4 synthesis, denoised chunk by chunk.
+
+    Chunk k conditions on the tail of chunk k-1 (mel2 / fea_ref), so a row has at most one chunk in flight;
+    chunks of different rows are independent and can share a CFM batch.
+    model_key identifies the weights of `cfm` (default: the module itself), so that rows of different
+    TTS instances holding copies of the same weights can share a batch too.
+    generator: the request's torch.Generator for the initial noise of every chunk, None uses the global one.
+    """
+
+    def __init__(
+        self,
+        cfm,
+        fea_ref: torch.Tensor,
+        fea_todo: torch.Tensor,
+        mel2: torch.Tensor,
+        chunk_len: int,
+        sample_steps: int = 32,
+        solver: str = "euler",
+        schedule: str = "uniform",
+        model_key=None,
+        generator: torch.Generator = None,
+    ):
+        self.cfm = cfm
+        self.generator = generator
+        self.model_key = id(cfm) if model_key is None else model_key
+        self.fea_ref = fea_ref  ### (1, C, T_min) 上一块(首块为参考音频)末尾的特征
+        self.fea_todo = fea_todo  ### (1, C, N) 整句待合成的特征
+        self.mel2 = mel2  ### (1, mel, T_min) 上一块末尾的mel, 作为本块的prompt
+        self.chunk_len = chunk_len
+        self.sample_steps = sample_steps
+        self.solver = solver
+        self.schedule = schedule
+        self.T_min = mel2.shape[2]
+
+        self.idx: int = 0
+        self.chunk: torch.Tensor = None
+        self.results: List[torch.Tensor] = []
+
+        self.result: torch.Tensor = None
+        self.error: Optional[Exception] = None
+        self.cancelled: bool = False
+        self.done = threading.Event()
+
+    @property
+    def key(self):
+        ### 同一批次必须共用同一个模型与采样设置
+        return (self.model_key, self.sample_steps, self.solver, self.schedule, self.mel2.dtype)
+
+    def next_chunk(self) -> bool:
+        self.chunk = self.fea_todo[:, :, self.idx : self.idx + self.chunk_len]
+        self.idx += self.chunk_len
+        return self.chunk.shape[-1] > 0
+
+    def update(self, cfm_res: torch.Tensor) -> bool:
+        """Consume the denoised chunk; returns True when the row is finished."""
+        self.results.append(cfm_res)
+        self.mel2 = cfm_res[:, :, -self.T_min :]
+        self.fea_ref = self.chunk[:, :, -self.T_min :]
+        if self.next_chunk():
+            return False
+        self.finish()
+        return True
+
+    def finish(self):
+        if not self.results:
+            self.fail(ValueError("CFMRow has no features to synthesize"))
+            return
+        self.result = torch.cat(self.results, 2)
+        self.fea_ref = self.fea_todo = self.mel2 = self.chunk = None
+        self.results = []
+        self.done.set()
+
+    def fail(self, error: Exception):
+        self.error = error
+        self.done.set()
+
+
+class CFMScheduler:
+    """
+    Chunk-level batching for the v3/v4 CFM.
+
+    Rows submitted by any number of concurrent callers (sentences of one request, or of different requests)
+    are kept in flight together; every iteration takes the next chunk of up to `max_batch_size` rows and
+    denoises them in one padded `CFM.inference` call, with per-row x_lens and prompt lengths.
+    A row re-enters the next iteration as soon as its chunk is done, so long sentences do not hold back short ones.
+    """
+
+    def __init__(self, max_batch_size: int = 8, poll_interval: float = 0.05):
+        self.max_batch_size = max_batch_size
+        self.poll_interval = poll_interval
+
+        self._pending: deque = deque()
+        self._cond = threading.Condition()
+        self._shutdown = False
+        self._thread: threading.Thread = None
+
+        self.rows: List[CFMRow] = []
+
+    def start(self):
+        with self._cond:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._shutdown = False
+            self._thread = threading.Thread(target=self._loop, name="CFMScheduler", daemon=True)
+            self._thread.start()
+
+    def shutdown(self):
+        """
+        Stop accepting rows. Rows already submitted are synthesized to the end before the worker exits.
+        """
+        with self._cond:
+            self._shutdown = True
+            self._cond.notify_all()
+
+    def submit(self, rows: List[CFMRow]):
+        with self._cond:
+            if self._shutdown:
+                raise RuntimeError("CFMScheduler has been shut down")
+            self._pending.extend(rows)
+            self._cond.notify_all()
+        self.start()
+
+    def cancel(self, rows: List[CFMRow]):
+        for row in rows:
+            row.cancelled = True
+
+    def synthesize(self, rows: List[CFMRow], cancelled: Callable[[], bool] = None) -> List[torch.Tensor]:
+        """
+        Blocks the calling thread until all of its rows are denoised. Once `cancelled()` returns True
+        the rows are dropped before their next chunk and the call raises.
+        Returns the normalized mel of every row, i.e. what the serial chunk loop concatenates.
+        """
+        self.submit(rows)
+        for row in rows:
+            while not row.done.wait(self.poll_interval):
+                if cancelled is not None and not row.cancelled and cancelled():
+                    self.cancel(rows)
+
+        for row in rows:
+            if row.error is not None:
+                raise row.error
+        return [row.result for row in rows]
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self.rows:
+                    if self._shutdown:
+                        return
+                    self._cond.wait()
+                while self._pending:
+                    row = self._pending.popleft()
+                    if row.cancelled:
+                        row.fail(RuntimeError("CFM synthesis was cancelled"))
+                    elif row.next_chunk():
+                        self.rows.append(row)
+                    else:
+                        row.finish()
+
+            self.rows = [row for row in self.rows if not self._drop_cancelled(row)]
+            if not self.rows:
+                continue
+            ### 取最早进入的行所在的分组, 同组按进入顺序最多max_batch_size行
+            key = self.rows[0].key
+            batch = [row for row in self.rows if row.key == key][: self.max_batch_size]
+            try:
+                self._step(batch)
+            except Exception as e:
+                traceback.print_exc()
+                for row in batch:
+                    row.fail(e)
+                batch_ids = set(id(row) for row in batch)
+                self.rows = [row for row in self.rows if id(row) not in batch_ids]
+
+    def _drop_cancelled(self, row: CFMRow) -> bool:
+        if row.cancelled:
+            row.fail(RuntimeError("CFM synthesis was cancelled"))
+            return True
+        return False
+
+    @torch.inference_mode()
+    def _step(self, batch: List[CFMRow]):
+        ### 每行的输入为[上一块末尾T_min帧, 本块], 右侧padding到批内最长; 参考mel同样右侧padding, 按行给出长度
+        feas = [torch.cat([row.fea_ref, row.chunk], 2) for row in batch]
+        x_lens = [fea.shape[2] for fea in feas]
+        prompt_lens = [row.mel2.shape[2] for row in batch]
+        T = max(x_lens)
+        P = max(prompt_lens)
+        fea = torch.cat([F.pad(fea, (0, T - fea.shape[2])) for fea in feas], 0).transpose(2, 1)
+        prompt = torch.cat([F.pad(row.mel2, (0, P - row.mel2.shape[2])) for row in batch], 0)
+        device = fea.device
+
+        row0 = batch[0]
+        cfm_res = row0.cfm.inference(
+            fea,
+            torch.LongTensor(x_lens).to(device),
+            prompt,
+            row0.sample_steps,
+            inference_cfg_rate=0,
+            solver=row0.solver,
+            schedule=row0.schedule,
+            prompt_lens=torch.LongTensor(prompt_lens).to(device) if len(batch) > 1 else None,
+            generator=[row.generator for row in batch],
+        )
+
+        finished = set()
+        for i, row in enumerate(batch):
+            if row.update(cfm_res[i : i + 1, :, prompt_lens[i] : x_lens[i]]):
+                finished.add(id(row))
+        ### 本批的行移到队尾, 让其他分组/未参与本批的行轮到
+        batch_ids = set(id(row) for row in batch)
+        self.rows = [row for row in self.rows if id(row) not in batch_ids] + [
+            row for row in batch if id(row) not in finished
+        ]
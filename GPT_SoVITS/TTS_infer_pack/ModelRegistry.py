@@ -0,0 +1,185 @@
+import os
+import sys
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+now_dir = os.getcwd()
+sys.path.append(now_dir)
+
+import torch
+
+
+def module_nbytes(value: Any) -> int:
+    """
+    Bytes held by the parameters and buffers of every nn.Module found in `value`.
+    """
+    if isinstance(value, torch.nn.Module):
+        return sum(t.numel() * t.element_size() for t in value.parameters()) + sum(
+            t.numel() * t.element_size() for t in value.buffers()
+        )
+    if isinstance(value, dict):
+        return sum(module_nbytes(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(module_nbytes(v) for v in value)
+    return 0
+
+
+def release_entry(entry: Optional[Dict]):
+    ### 随模型常驻的T2S调度器在模型离开registry时关闭, 已提交的句子会解码完再退出
+    scheduler = None if entry is None else entry.get("scheduler")
+    if scheduler is not None:
+        scheduler.shutdown()
+
+
+class ModelLock:
+    """
+    Shared/exclusive lock around the active models of one TTS instance.
+
+    Requests hold it shared and run concurrently, on the active models or on models of their own;
+    activating other models for the instance, or resetting them after a failed request, holds it exclusively
+    once the requests in flight are done.
+    Waiting exclusive holders block new shared holders, so a model switch is not starved.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._shared = 0
+        self._exclusive = False
+        self._waiting = 0
+
+    @contextmanager
+    def shared(self):
+        with self._cond:
+            while self._exclusive or self._waiting > 0:
+                self._cond.wait()
+            self._shared += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._shared -= 1
+                self._cond.notify_all()
+
+    @contextmanager
+    def exclusive(self):
+        with self._cond:
+            self._waiting += 1
+            try:
+                while self._exclusive or self._shared > 0:
+                    self._cond.wait()
+            finally:
+                self._waiting -= 1
+            self._exclusive = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._exclusive = False
+                self._cond.notify_all()
+
+
+class ModelRegistry:
+    """
+    LRU registry of resident models, so that switching between fine-tuned voices does not reload them from disk.
+
+    Entries are plain dicts (the model plus whatever config is needed to activate it again),
+    keyed by (kind, name), e.g. ("t2s", weights_path), ("vits", weights_path), ("vocoder", version).
+    Models that are in use are passed as `pinned`, or held with `pin`/`unpin` while a request runs on them, and
+    are never evicted; the other entries are evicted least recently used first once the total size exceeds
+    `max_bytes`.
+    An entry may carry the "scheduler" of its model, which is shut down when the entry leaves the registry.
+    """
+
+    def __init__(self, max_bytes: int = 0):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[Tuple[str, str], Dict]" = OrderedDict()
+        self._sizes: Dict[Tuple[str, str], int] = {}
+        # 正在被使用的模型的引用计数, 计数大于0的条目不会被淘汰
+        self._pins: Dict[Tuple[str, str], int] = {}
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, kind: str, name: str) -> Optional[Dict]:
+        key = (kind, name)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, kind: str, name: str, entry: Dict, pinned: Iterable[Tuple[str, str]] = ()):
+        key = (kind, name)
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            self._sizes[key] = module_nbytes(entry)
+            self.trim(set(pinned) | {key})
+
+    def remove(self, kind: str, name: str) -> Optional[Dict]:
+        key = (kind, name)
+        with self._lock:
+            self._sizes.pop(key, None)
+            entry = self._entries.pop(key, None)
+        release_entry(entry)
+        return entry
+
+    def pin(self, kind: str, name: str):
+        key = (kind, name)
+        with self._lock:
+            self._pins[key] = self._pins.get(key, 0) + 1
+
+    def unpin(self, kind: str, name: str):
+        key = (kind, name)
+        with self._lock:
+            count = self._pins.get(key, 0) - 1
+            if count > 0:
+                self._pins[key] = count
+            else:
+                self._pins.pop(key, None)
+            self.trim()
+
+    def trim(self, pinned: Iterable[Tuple[str, str]] = ()):
+        """
+        Evict unpinned entries, least recently used first, until the registry fits in `max_bytes`.
+        """
+        pinned = set(pinned)
+        with self._lock:
+            for key in list(self._entries.keys()):
+                if sum(self._sizes.values()) <= self.max_bytes:
+                    break
+                if key in pinned or key in self._pins:
+                    continue
+                print(f"Evicting resident model {key[0]}: {key[1]}")
+                release_entry(self._entries.pop(key))
+                self._sizes.pop(key)
+                self.evictions += 1
+
+    def clear(self, keep: Iterable[Tuple[str, str]] = ()):
+        keep = set(keep)
+        with self._lock:
+            for key in list(self._entries.keys()):
+                if key not in keep:
+                    release_entry(self._entries.pop(key))
+                    self._sizes.pop(key)
+
+    def keys(self):
+        with self._lock:
+            return list(self._entries.keys())
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": sum(self._sizes.values()),
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
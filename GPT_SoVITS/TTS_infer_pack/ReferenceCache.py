@@ -0,0 +1,139 @@
+import hashlib
+import os
+import shutil
+import sys
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+now_dir = os.getcwd()
+sys.path.append(now_dir)
+
+import torch
+
+
+def _to_device(value: Any, device: torch.device) -> Any:
+    if isinstance(value, torch.Tensor):
+        return value.to(device)
+    if isinstance(value, tuple):
+        return tuple(_to_device(item, device) for item in value)
+    if isinstance(value, list):
+        return [_to_device(item, device) for item in value]
+    if isinstance(value, dict):
+        return {k: _to_device(v, device) for k, v in value.items()}
+    return value
+
+
+class ReferenceCache:
+    """
+    Multi-entry LRU cache for reference features, optionally backed by an on-disk store.
+
+    Entries are plain dicts of tensors/lists/ints/strs. In memory they live on `device`,
+    on disk they are saved with torch.save under `cache_dir/<namespace>/<key>.pt` and loaded with weights_only=True,
+    so a file placed in the cache directory cannot run code.
+    Keys are content hashes, so renaming or re-uploading the same reference audio still hits.
+    """
+
+    def __init__(self, cache_dir: Optional[str], max_entries: int = 64, device: torch.device = torch.device("cpu")):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.device = device
+        self._entries: "OrderedDict[str, Dict]" = OrderedDict()
+        self._file_hashes: Dict[tuple, str] = {}
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        if self.cache_dir not in [None, ""]:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def hash_text(*parts: str) -> str:
+        return hashlib.sha1("\x00".join(str(part) for part in parts).encode("utf-8")).hexdigest()
+
+    def hash_file(self, path: str, *parts: str) -> str:
+        """
+        Content hash of a file, salted with `parts` (e.g. model version / weights path).
+        The content hash itself is memoized by (path, size, mtime).
+        """
+        stat = os.stat(path)
+        file_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            content_hash = self._file_hashes.get(file_key)
+        if content_hash is None:
+            sha1 = hashlib.sha1()
+            with open(path, "rb") as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    sha1.update(block)
+            content_hash = sha1.hexdigest()
+            with self._lock:
+                self._file_hashes[file_key] = content_hash
+        return self.hash_text(content_hash, *parts)
+
+    def _disk_path(self, namespace: str, key: str) -> str:
+        return os.path.join(self.cache_dir, namespace, "%s.pt" % key)
+
+    def get(self, namespace: str, key: str) -> Optional[Dict]:
+        entry_key = "%s/%s" % (namespace, key)
+        with self._lock:
+            entry = self._entries.get(entry_key)
+            if entry is not None:
+                self._entries.move_to_end(entry_key)
+                self.hits += 1
+                return entry
+
+        if self.cache_dir not in [None, ""]:
+            path = self._disk_path(namespace, key)
+            if os.path.exists(path):
+                try:
+                    entry = torch.load(path, map_location="cpu", weights_only=True)
+                except Exception as e:
+                    print(f"Failed to load reference cache {path}: {e}")
+                    entry = None
+                if entry is not None:
+                    entry = _to_device(entry, self.device)
+                    with self._lock:
+                        self.disk_hits += 1
+                        self._put_memory(entry_key, entry)
+                    return entry
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, namespace: str, key: str, entry: Dict):
+        entry_key = "%s/%s" % (namespace, key)
+        with self._lock:
+            self._put_memory(entry_key, entry)
+
+        if self.cache_dir not in [None, ""]:
+            path = self._disk_path(namespace, key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            ##### torch.save doesn't support chinese path, 先写临时文件再移动, 同时保证写入是原子的
+            tmp_path = "%s.%s.tmp" % (path, threading.get_ident())
+            try:
+                torch.save(_to_device(entry, torch.device("cpu")), tmp_path)
+                shutil.move(tmp_path, path)
+            except Exception as e:
+                print(f"Failed to save reference cache {path}: {e}")
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+    def _put_memory(self, entry_key: str, entry: Dict):
+        self._entries[entry_key] = entry
+        self._entries.move_to_end(entry_key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+        }
@@ -0,0 +1,352 @@
+import os
+import sys
+import threading
+import traceback
+from collections import deque
+from typing import Callable, List, Optional
+
+now_dir = os.getcwd()
+sys.path.append(now_dir)
+
+import torch
+import torch.nn.functional as F
+
+from AR.models.t2s_model import Text2SemanticDecoder
+from AR.models.utils import make_presence_mask, sample_batched
+
+
+class T2SRow:
+    """
+    One sentence waiting for / being decoded by the scheduler.
+    Every row carries its own prompt (reference semantic tokens), so rows of different requests
+    can share the same decode batch.
+    """
+
+    def __init__(
+        self,
+        phones: torch.LongTensor,
+        bert_feature: torch.Tensor,
+        prompt: torch.LongTensor,
+        top_k: int = 5,
+        top_p: float = 1.0,
+        temperature: float = 1.0,
+        repetition_penalty: float = 1.35,
+        early_stop_num: int = -1,
+        generator: torch.Generator = None,
+    ):
+        self.phones = phones
+        self.bert_feature = bert_feature
+        self.prompt = prompt
+        self.prompt_len: int = prompt.shape[0]
+        self.top_k = top_k
+        self.top_p = top_p
+        self.temperature = temperature
+        self.repetition_penalty = repetition_penalty
+        self.early_stop_num = early_stop_num
+        self.generator = generator  ### 所属请求的随机数生成器, None时使用全局生成器
+
+        self.y: torch.LongTensor = None
+        self.kv_len: int = 0
+        self.step: int = 0
+
+        self.result: torch.LongTensor = None
+        self.idx: int = None
+        self.error: Optional[Exception] = None
+        self.cancelled: bool = False
+        self.done = threading.Event()
+
+    def finish(self, idx: int):
+        self.idx = idx
+        self.result = self.y[:-1]
+        self.phones = self.bert_feature = None
+        self.done.set()
+
+    def fail(self, error: Exception):
+        self.error = error
+        self.done.set()
+
+
+class T2SScheduler:
+    """
+    Continuous (in-flight) batching for T2S decoding.
+
+    Sentences submitted by any number of concurrent callers are merged into one decode batch.
+    Rows join the batch as soon as they are prefilled and leave it as soon as they hit EOS,
+    so the batch is refilled at token granularity instead of waiting for the slowest sentence.
+
+    The kv cache of the batch is left padded: row i only attends to its last `kv_len` columns.
+    """
+
+    def __init__(
+        self,
+        t2s_model: Text2SemanticDecoder,
+        max_batch_size: int = 16,
+        max_steps: int = 1500,
+        poll_interval: float = 0.05,
+    ):
+        self.t2s_model = t2s_model
+        self.max_batch_size = max_batch_size
+        self.max_steps = max_steps
+        self.poll_interval = poll_interval
+        self.EOS = t2s_model.EOS
+
+        self._pending: deque = deque()
+        self._cond = threading.Condition()
+        self._shutdown = False
+        self._thread: threading.Thread = None
+
+        self.rows: List[T2SRow] = []
+        self.k_cache: List[torch.Tensor] = None
+        self.v_cache: List[torch.Tensor] = None
+        self.pad_mask: torch.Tensor = None  ### (B, S), True表示padding
+        self.presence_mask: torch.Tensor = None  ### (B, vocab_size), 已生成过的token, 用于重复惩罚
+
+    def start(self):
+        with self._cond:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._shutdown = False
+            self._thread = threading.Thread(target=self._loop, name="T2SScheduler", daemon=True)
+            self._thread.start()
+
+    def shutdown(self):
+        """
+        Stop accepting rows. Rows already submitted are decoded to the end before the worker exits.
+        """
+        with self._cond:
+            self._shutdown = True
+            self._cond.notify_all()
+
+    def submit(self, rows: List[T2SRow]):
+        with self._cond:
+            if self._shutdown:
+                raise RuntimeError("T2SScheduler has been shut down")
+            self._pending.extend(rows)
+            self._cond.notify_all()
+        self.start()
+
+    def cancel(self, rows: List[T2SRow]):
+        for row in rows:
+            row.cancelled = True
+
+    def infer_panel(
+        self,
+        x: List[torch.LongTensor],  #####全部文本token
+        x_lens: torch.LongTensor,
+        prompts: torch.LongTensor,  ####参考音频token
+        bert_feature: List[torch.Tensor],
+        top_k: int = -100,
+        top_p: int = 100,
+        early_stop_num: int = -1,
+        temperature: float = 1.0,
+        repetition_penalty: float = 1.35,
+        cancelled: Callable[[], bool] = None,
+        generator: torch.Generator = None,
+        **kwargs,
+    ):
+        """
+        Drop-in replacement of `Text2SemanticDecoder.infer_panel_batch_infer`.
+        Blocks the calling thread until all of its rows are decoded. Once `cancelled()` returns True
+        the rows of this call are dropped from the batch and the call raises.
+        """
+        if prompts is None:
+            return self.t2s_model.infer_panel_naive_batched(
+                x,
+                x_lens,
+                prompts,
+                bert_feature,
+                top_k=top_k,
+                top_p=top_p,
+                early_stop_num=early_stop_num,
+                temperature=temperature,
+                repetition_penalty=repetition_penalty,
+                generator=generator,
+                **kwargs,
+            )
+
+        rows = [
+            T2SRow(
+                x[i],
+                bert_feature[i],
+                prompts[i],
+                top_k=top_k,
+                top_p=top_p,
+                temperature=temperature,
+                repetition_penalty=repetition_penalty,
+                early_stop_num=early_stop_num,
+                generator=generator,
+            )
+            for i in range(len(x))
+        ]
+        self.submit(rows)
+        for row in rows:
+            while not row.done.wait(self.poll_interval):
+                if cancelled is not None and not row.cancelled and cancelled():
+                    self.cancel(rows)
+
+        for row in rows:
+            if row.error is not None:
+                raise row.error
+        return [row.result for row in rows], [row.idx for row in rows]
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self.rows:
+                    if self._shutdown:
+                        return
+                    self._cond.wait()
+                new_rows = []
+                while self._pending and len(self.rows) + len(new_rows) < self.max_batch_size:
+                    new_rows.append(self._pending.popleft())
+
+            try:
+                with torch.no_grad():
+                    for row in new_rows:
+                        self._admit(row)
+                    if self.rows:
+                        self._step()
+            except Exception as e:
+                traceback.print_exc()
+                for row in self.rows + new_rows:
+                    if not row.done.is_set():
+                        row.fail(e)
+                self._reset()
+
+    def _reset(self):
+        self.rows = []
+        self.k_cache = None
+        self.v_cache = None
+        self.pad_mask = None
+        self.presence_mask = None
+
+    def _admit(self, row: T2SRow):
+        if row.cancelled:
+            row.fail(RuntimeError("T2S decoding was cancelled"))
+            return
+
+        logits, k_cache, v_cache = self.t2s_model.prefill_row(row.phones, row.bert_feature, row.prompt)
+        row.y = row.prompt
+        row.kv_len = k_cache[0].shape[1]
+        presence_mask = make_presence_mask(row.prompt.unsqueeze(0), self.t2s_model.vocab_size)
+        ### 第一步不允许生成EOS
+        logits = logits[:, :-1]
+        samples, tokens = self._sample(logits, [row], presence_mask)
+        if self._update_row(row, samples[0], samples[0, 0].item(), tokens[0].item()):
+            return
+
+        self._merge(row, k_cache, v_cache, presence_mask)
+
+    def _merge(
+        self,
+        row: T2SRow,
+        k_cache: List[torch.Tensor],
+        v_cache: List[torch.Tensor],
+        presence_mask: torch.Tensor,
+    ):
+        row_mask = torch.zeros((1, row.kv_len), dtype=torch.bool, device=k_cache[0].device)
+        if not self.rows:
+            self.rows = [row]
+            self.k_cache = k_cache
+            self.v_cache = v_cache
+            self.pad_mask = row_mask
+            self.presence_mask = presence_mask
+            return
+
+        batch_len = self.pad_mask.shape[1]
+        target_len = max(batch_len, row.kv_len)
+        if target_len > batch_len:
+            pad = target_len - batch_len
+            self.k_cache = [F.pad(k, (0, 0, pad, 0), value=0) for k in self.k_cache]
+            self.v_cache = [F.pad(v, (0, 0, pad, 0), value=0) for v in self.v_cache]
+            self.pad_mask = F.pad(self.pad_mask, (pad, 0), value=True)
+        if target_len > row.kv_len:
+            pad = target_len - row.kv_len
+            k_cache = [F.pad(k, (0, 0, pad, 0), value=0) for k in k_cache]
+            v_cache = [F.pad(v, (0, 0, pad, 0), value=0) for v in v_cache]
+            row_mask = F.pad(row_mask, (pad, 0), value=True)
+
+        self.rows.append(row)
+        self.k_cache = [torch.cat([k, k_], dim=0) for k, k_ in zip(self.k_cache, k_cache)]
+        self.v_cache = [torch.cat([v, v_], dim=0) for v, v_ in zip(self.v_cache, v_cache)]
+        self.pad_mask = torch.cat([self.pad_mask, row_mask], dim=0)
+        self.presence_mask = torch.cat([self.presence_mask, presence_mask], dim=0)
+
+    def _step(self):
+        device = self.pad_mask.device
+        y_last = torch.stack([row.y[-1:] for row in self.rows], dim=0)
+        positions = torch.LongTensor([row.y.shape[0] - 1 for row in self.rows]).to(device)
+        self.pad_mask = F.pad(self.pad_mask, (0, 1), value=False)
+        attn_mask = self.pad_mask.view(len(self.rows), 1, 1, -1)
+
+        logits, self.k_cache, self.v_cache = self.t2s_model.decode_rows(
+            y_last, positions, self.k_cache, self.v_cache, attn_mask
+        )
+        samples, tokens = self._sample(logits, self.rows, self.presence_mask)
+        samples_list = samples[:, 0].tolist()
+        tokens_list = tokens.tolist()
+
+        reserved = []
+        for i, row in enumerate(self.rows):
+            row.kv_len += 1
+            row.step += 1
+            if not self._update_row(row, samples[i], samples_list[i], tokens_list[i]):
+                reserved.append(i)
+
+        if len(reserved) == len(self.rows):
+            return
+        if len(reserved) == 0:
+            self._reset()
+            return
+
+        ####### 移除batch中已经生成完毕的序列, 并裁掉所有行共有的左侧padding
+        self.rows = [self.rows[i] for i in reserved]
+        index = torch.LongTensor(reserved).to(device)
+        trim = self.pad_mask.shape[1] - max(row.kv_len for row in self.rows)
+        self.pad_mask = torch.index_select(self.pad_mask, 0, index)[:, trim:]
+        self.presence_mask = torch.index_select(self.presence_mask, 0, index)
+        for i in range(len(self.k_cache)):
+            self.k_cache[i] = torch.index_select(self.k_cache[i], 0, index)[:, trim:]
+            self.v_cache[i] = torch.index_select(self.v_cache[i], 0, index)[:, trim:]
+
+    def _sample(self, logits: torch.Tensor, rows: List[T2SRow], presence_mask: torch.Tensor):
+        """
+        Sample the next token of every row with its own sampling parameters, and mark it in `presence_mask`.
+
+        Returns:
+            samples (B, 1), the greedy tokens (B,) after repetition penalty
+        """
+        samples, tokens = sample_batched(
+            logits,
+            presence_mask,
+            top_k=[row.top_k for row in rows],
+            top_p=[row.top_p for row in rows],
+            temperature=[row.temperature for row in rows],
+            repetition_penalty=[row.repetition_penalty for row in rows],
+            generator=[row.generator for row in rows],
+        )
+        presence_mask.scatter_(1, samples.long(), True)
+        return samples.long(), tokens
+
+    def _update_row(self, row: T2SRow, sample_: torch.Tensor, sample_id: int, token_id: int) -> bool:
+        """
+        Append the sampled token to the row. Returns True when the row is finished.
+        """
+        row.y = torch.concat([row.y, sample_.to(row.y.dtype)], dim=0)
+
+        if row.cancelled:
+            row.fail(RuntimeError("T2S decoding was cancelled"))
+            return True
+
+        if sample_id == self.EOS or token_id == self.EOS:
+            row.finish(row.step)
+            return True
+
+        if (row.early_stop_num != -1 and (row.y.shape[0] - row.prompt_len) > row.early_stop_num) or (
+            row.step == self.max_steps - 1
+        ):
+            print("use early stop num:", row.early_stop_num)
+            row.finish(row.step)
+            return True
+
+        return False
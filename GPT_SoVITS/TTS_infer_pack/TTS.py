@@ -1,11 +1,18 @@
 import gc
 import math
 import os
+import queue
 import random
 import sys
+import threading
 import time
 import traceback
-from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from copy import copy, deepcopy
+
+# 模块导入耗时(torch/transformers等), 计入启动报告
+_import_t0 = time.perf_counter()
 
 import torchaudio
 from tqdm import tqdm
@@ -22,20 +29,35 @@ import torch
 import torch_musa
 import torch.nn.functional as F
 import yaml
+from AR.models.prefill_cache import PrefillCache
 from AR.models.t2s_lightning_module import Text2SemanticLightningModule
 from BigVGAN.bigvgan import BigVGAN
 from feature_extractor.cnhubert import CNHubert
 from module.mel_processing import mel_spectrogram_torch, spectrogram_torch
 from module.models import SynthesizerTrn, SynthesizerTrnV3, Generator
 from peft import LoraConfig, get_peft_model
-from process_ckpt import get_sovits_version_from_path_fast, load_sovits_new
+from process_ckpt import (
+    get_sovits_version_from_path_fast,
+    is_mmap_checkpoint,
+    load_gpt_weights,
+    load_sovits_new,
+    load_state_dict_mmap,
+)
 from transformers import AutoModelForMaskedLM, AutoTokenizer
 
 from tools.audio_sr import AP_BWE
 from tools.i18n.i18n import I18nAuto, scan_language_list
 from TTS_infer_pack.text_segmentation_method import splits
 from TTS_infer_pack.TextPreprocessor import TextPreprocessor
+from TTS_infer_pack.T2SScheduler import T2SScheduler
+from TTS_infer_pack.CFMScheduler import CFMRow, CFMScheduler
+from TTS_infer_pack.ReferenceCache import ReferenceCache
+from TTS_infer_pack.ModelRegistry import ModelLock, ModelRegistry
+from TTS_infer_pack import cpu_fast
 from sv import SV
+from text.cleaner import load_language_module
+
+IMPORT_SECONDS = time.perf_counter() - _import_t0
 
 resample_transform_dict = {}
 
@@ -115,6 +137,88 @@ def speed_change(input_audio: np.ndarray, speed: float, sr: int):
     return processed_audio
 
 
+class _StageError:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+_STAGE_END = object()
+
+
+def run_stages(items, stages: list, queue_size: int = 2, threaded: bool = True):
+    """
+    Apply `stages` to every item in order and yield the results of the last stage.
+    A stage returning None drops the item.
+
+    With `threaded`, every stage runs in its own worker thread and consecutive stages are
+    connected by bounded queues, so stage k works on item n+1 while the consumer still handles item n.
+    Exceptions raised in a stage are re-raised in the consumer.
+    Closing the generator stops the workers.
+    """
+    if not threaded:
+        for item in items:
+            for stage in stages:
+                item = stage(item)
+                if item is None:
+                    break
+            if item is not None:
+                yield item
+        return
+
+    cancel = threading.Event()
+    queues = [queue.Queue(maxsize=max(1, queue_size)) for _ in stages]
+
+    def put(q: queue.Queue, value) -> bool:
+        while not cancel.is_set():
+            try:
+                q.put(value, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def drain(q: queue.Queue):
+        while not cancel.is_set():
+            try:
+                value = q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if value is _STAGE_END:
+                return
+            if isinstance(value, _StageError):
+                raise value.error
+            yield value
+
+    def worker(i: int):
+        source = items if i == 0 else drain(queues[i - 1])
+        try:
+            ### no_grad等状态是线程局部的, 工作线程中需要重新设置
+            with torch.no_grad():
+                for item in source:
+                    if cancel.is_set():
+                        return
+                    item = stages[i](item)
+                    if item is not None and not put(queues[i], item):
+                        return
+        except BaseException as e:
+            put(queues[i], _StageError(e))
+            return
+        put(queues[i], _STAGE_END)
+
+    threads = [
+        threading.Thread(target=worker, args=(i,), name="TTSStage-%d" % i, daemon=True) for i in range(len(stages))
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        yield from drain(queues[-1])
+    finally:
+        cancel.set()
+        ### 等待工作线程退出, 避免其在模型被重置/释放后继续使用
+        for thread in threads:
+            thread.join()
+
+
 class DictToAttrRecursive(dict):
     def __init__(self, input_dict):
         super().__init__(input_dict)
@@ -218,6 +322,38 @@ def set_seed(seed: int):
     return seed
 
 
+class RequestContext:
+    """
+    Per-request state of `TTS.run`: the stop flag, the random generator seeded with the request's seed,
+    and the weights of the models that failed during the request.
+    """
+
+    def __init__(self):
+        self.stopped = threading.Event()
+        self.generator: torch.Generator = None
+        self.failed_models: list = []
+
+    def stop(self):
+        self.stopped.set()
+
+    def is_stopped(self) -> bool:
+        return self.stopped.is_set()
+
+    def set_seed(self, seed: int, device) -> int:
+        seed = int(seed)
+        seed = seed if seed != -1 else random.randint(0, 2**32 - 1)
+        print(f"Set seed to {seed}")
+        try:
+            self.generator = torch.Generator(device=device)
+        except RuntimeError:
+            ### 不支持独立生成器的设备使用全局生成器, 此时结果不随seed复现
+            print(f"torch.Generator is not supported on {device}, sampling with the global generator")
+            self.generator = None
+        else:
+            self.generator.manual_seed(seed)
+        return seed
+
+
 class TTS_Config:
     default_configs = {
         "v1": {
@@ -353,7 +489,47 @@ class TTS_Config:
         self.vits_weights_path = self.configs.get("vits_weights_path", None)
         self.bert_base_path = self.configs.get("bert_base_path", None)
         self.cnhuhbert_base_path = self.configs.get("cnhuhbert_base_path", None)
+        # 参考音频/参考文本特征缓存, ref_cache_dir为空时只在内存中缓存
+        self.ref_cache_dir: str = self.configs.get("ref_cache_dir", None)
+        self.ref_cache_size: int = self.configs.get("ref_cache_size", 64)
+        # 重复句子的音素+BERT特征缓存上限(MB), 0表示关闭
+        self.text_cache_max_mb: float = self.configs.get("text_cache_max_mb", 256)
+        # 一次BERT前向最多处理的句子数
+        self.bert_batch_size: int = self.configs.get("bert_batch_size", 16)
         self.languages = self.v1_languages if self.version == "v1" else self.v2_languages
+        # 连续批处理: 将多个并发请求的句子合并到同一个T2S解码批次中
+        self.continuous_batching: bool = self.configs.get("continuous_batching", False)
+        self.max_batch_size: int = self.configs.get("max_batch_size", 16)
+        # T2S解码使用按early_stop_num预分配的kv cache, 每步原地写入
+        self.static_kv_cache: bool = self.configs.get("static_kv_cache", False)
+        # 逐token解码时把整个单步(embedding到采样)捕获为CUDA Graph(其他设备退回static_kv_cache), 只作用于非并行推理
+        self.t2s_decode_graph: bool = self.configs.get("t2s_decode_graph", False)
+        # 重复的(参考音频, 句子)复用T2S prompt pass的各层K/V, 显存上限(MB), 0表示关闭
+        self.t2s_prefill_cache_mb: float = self.configs.get("t2s_prefill_cache_mb", 0)
+        # v3/v4的CFM采样器: euler/midpoint/heun/rk4, 时间步: uniform/sway; 可用GPT_SoVITS/cfm_benchmark.py比较速度与质量
+        self.cfm_solver: str = self.configs.get("cfm_solver", "euler")
+        self.cfm_schedule: str = self.configs.get("cfm_schedule", "uniform")
+        # v3/v4逐块合成时, 把并发的各句子/各请求当前待合成的块合并到同一次CFM推理中
+        self.cfm_batching: bool = self.configs.get("cfm_batching", False)
+        self.cfm_max_batch_size: int = self.configs.get("cfm_max_batch_size", 8)
+        # return_fragment模式下, 文本前端与T2S在后台线程中提前处理后续分段, 与当前分段的音频合成重叠
+        self.fragment_pipeline: bool = self.configs.get("fragment_pipeline", True)
+        self.fragment_queue_size: int = self.configs.get("fragment_queue_size", 2)
+        # 常驻显存/内存的GPT/SoVITS/声码器模型总大小上限(MB), 超出时按LRU淘汰; 0表示只保留当前使用的模型
+        self.model_cache_max_mb: float = self.configs.get("model_cache_max_mb", 0)
+        # 启动时T2S/SoVITS/BERT/CNHuBERT在线程池中并行加载
+        self.parallel_model_loading: bool = self.configs.get("parallel_model_loading", True)
+        # 启动后在后台预先导入的语言前端, 如["zh", "en"]; 不在列表中的语言在第一次用到时才导入
+        self.preload_text_frontends: list = self.configs.get("preload_text_frontends", [])
+        # 设备配置: default / cpu_fast(纯CPU节点: T2S、BERT与SoVITS文本编码器的线性层int8动态量化, 并设置线程数)
+        self.device_profile: str = self.configs.get("device_profile", "default")
+        # cpu_fast的intra-op线程数, 0表示按进程可用的CPU数
+        self.cpu_threads: int = self.configs.get("cpu_threads", 0)
+        # cpu_fast量化后与fp32输出的相对误差容差, 超出时该模型保持fp32
+        self.int8_tolerance: float = self.configs.get("int8_tolerance", 0.05)
+        if self.device_profile == "cpu_fast":
+            self.device = torch.device("cpu")
+            self.is_half = False
 
         self.use_vocoder: bool = False
 
@@ -411,6 +587,27 @@ class TTS_Config:
             "vits_weights_path": self.vits_weights_path,
             "bert_base_path": self.bert_base_path,
             "cnhuhbert_base_path": self.cnhuhbert_base_path,
+            "continuous_batching": self.continuous_batching,
+            "max_batch_size": self.max_batch_size,
+            "static_kv_cache": self.static_kv_cache,
+            "t2s_decode_graph": self.t2s_decode_graph,
+            "t2s_prefill_cache_mb": self.t2s_prefill_cache_mb,
+            "cfm_solver": self.cfm_solver,
+            "cfm_schedule": self.cfm_schedule,
+            "cfm_batching": self.cfm_batching,
+            "cfm_max_batch_size": self.cfm_max_batch_size,
+            "ref_cache_dir": self.ref_cache_dir,
+            "ref_cache_size": self.ref_cache_size,
+            "text_cache_max_mb": self.text_cache_max_mb,
+            "bert_batch_size": self.bert_batch_size,
+            "fragment_pipeline": self.fragment_pipeline,
+            "fragment_queue_size": self.fragment_queue_size,
+            "model_cache_max_mb": self.model_cache_max_mb,
+            "parallel_model_loading": self.parallel_model_loading,
+            "preload_text_frontends": self.preload_text_frontends,
+            "device_profile": self.device_profile,
+            "cpu_threads": self.cpu_threads,
+            "int8_tolerance": self.int8_tolerance,
         }
         return self.config
 
@@ -438,6 +635,9 @@ class TTS_Config:
 
 class TTS:
     def __init__(self, configs: Union[dict, str, TTS_Config]):
+        t0 = time.perf_counter()
+        # 各组件最近一次加载耗时(秒), 启动结束时打印
+        self.load_times: dict = {"imports": IMPORT_SECONDS}
         if isinstance(configs, TTS_Config):
             self.configs = configs
         else:
@@ -451,8 +651,16 @@ class TTS:
                 self.configs.is_half = False
         except ImportError:
             pass
+        self.use_cpu_fast: bool = self.configs.device_profile == "cpu_fast"
+        if self.use_cpu_fast:
+            print(f"cpu_fast profile: {cpu_fast.configure_threads(self.configs.cpu_threads)} threads")
 
         self.t2s_model: Text2SemanticLightningModule = None
+        self.t2s_scheduler: T2SScheduler = None
+        self.cfm_scheduler: CFMScheduler = None
+        if self.configs.cfm_batching:
+            print(f"CFM chunk batching enabled, max_batch_size: {self.configs.cfm_max_batch_size}")
+            self.cfm_scheduler = CFMScheduler(max_batch_size=self.configs.cfm_max_batch_size)
         self.vits_model: Union[SynthesizerTrn, SynthesizerTrnV3] = None
         self.bert_tokenizer: AutoTokenizer = None
         self.bert_model: AutoModelForMaskedLM = None
@@ -470,10 +678,23 @@ class TTS:
             "overlapped_len": None,
         }
 
+        self.ref_cache: ReferenceCache = ReferenceCache(
+            self.configs.ref_cache_dir, self.configs.ref_cache_size, self.configs.device
+        )
+        self.model_registry: ModelRegistry = ModelRegistry(int(self.configs.model_cache_max_mb * 1024 * 1024))
+        self.model_lock: ModelLock = ModelLock()
+        # 同一模型只由一个线程加载; 本实例正在使用的模型 kind -> registry key, 被pin住不会被淘汰
+        self.model_load_lock = threading.Lock()
+        self._pinned_models: dict = {}
+
         self._init_models()
 
         self.text_preprocessor: TextPreprocessor = TextPreprocessor(
-            self.bert_model, self.bert_tokenizer, self.configs.device
+            self.bert_model,
+            self.bert_tokenizer,
+            self.configs.device,
+            cache_max_bytes=int(self.configs.text_cache_max_mb * 1024 * 1024),
+            bert_batch_size=self.configs.bert_batch_size,
         )
 
         self.prompt_cache: dict = {
@@ -487,19 +708,78 @@ class TTS:
             "norm_text": None,
             "aux_ref_audio_paths": [],
         }
+        self.prompt_lock = threading.RLock()
 
-        self.stop_flag: bool = False
+        # 正在运行的请求, stop()会停止全部请求
+        self._contexts: set = set()
+        self._contexts_lock = threading.Lock()
+        if torch.cuda.is_available():
+            # 开启后会影响精度
+            torch.backends.cuda.matmul.allow_tf32 = False
+            torch.backends.cudnn.allow_tf32 = False
         self.precision: torch.dtype = torch.float16 if self.configs.is_half else torch.float32
 
+        self.load_times["total"] = time.perf_counter() - t0
+        self.print_startup_report()
+        self._preload_text_frontends()
+
+    def _timed(self, name: str, fn, *args, **kwargs):
+        t0 = time.perf_counter()
+        result = fn(*args, **kwargs)
+        self.load_times[name] = time.perf_counter() - t0
+        return result
+
+    def print_startup_report(self):
+        print("TTS startup".center(50, "-"))
+        for name, seconds in self.load_times.items():
+            print(f"{name.ljust(20)}: {seconds:.2f}s")
+        print("-" * 50)
+
     def _init_models(
         self,
     ):
-        self.init_t2s_weights(self.configs.t2s_weights_path)
-        self.init_vits_weights(self.configs.vits_weights_path)
-        self.init_bert_weights(self.configs.bert_base_path)
-        self.init_cnhuhbert_weights(self.configs.cnhuhbert_base_path)
+        if not self.configs.parallel_model_loading:
+            self._timed("t2s", self.init_t2s_weights, self.configs.t2s_weights_path)
+            self._timed("vits", self.init_vits_weights, self.configs.vits_weights_path)
+            self._timed("bert", self.init_bert_weights, self.configs.bert_base_path)
+            self._timed("cnhubert", self.init_cnhuhbert_weights, self.configs.cnhuhbert_base_path)
+            return
+
+        ### 四个模型互不依赖, 并行加载以重叠磁盘读取、反序列化与拷贝到设备;
+        ### 写configs、初始化声码器/SV等激活步骤仍在主线程按原顺序执行
+        with ThreadPoolExecutor(max_workers=4, thread_name_prefix="tts_init") as pool:
+            t2s_future = pool.submit(self._timed, "t2s", self._load_t2s_weights, self.configs.t2s_weights_path)
+            vits_future = pool.submit(self._timed, "vits", self._load_vits_weights, self.configs.vits_weights_path)
+            bert_future = pool.submit(self._timed, "bert", self.init_bert_weights, self.configs.bert_base_path)
+            cnhubert_future = pool.submit(
+                self._timed, "cnhubert", self.init_cnhuhbert_weights, self.configs.cnhuhbert_base_path
+            )
+            t2s_entry = t2s_future.result()
+            vits_entry = vits_future.result()
+            bert_future.result()
+            cnhubert_future.result()
+        self.init_t2s_weights(self.configs.t2s_weights_path, entry=t2s_entry)
+        self.init_vits_weights(self.configs.vits_weights_path, entry=vits_entry)
         # self.enable_half_precision(self.configs.is_half)
 
+    def _preload_text_frontends(self):
+        languages = [lang for lang in self.configs.preload_text_frontends if lang in self.configs.languages]
+        if len(languages) == 0:
+            return
+
+        def preload():
+            for language in languages:
+                try:
+                    self._timed(f"frontend_{language}", load_language_module, language, self.configs.version)
+                except Exception:
+                    traceback.print_exc()
+            loaded = [lang for lang in languages if f"frontend_{lang}" in self.load_times]
+            times = ", ".join(f"{lang} {self.load_times[f'frontend_{lang}']:.2f}s" for lang in loaded)
+            print(f"Text frontends preloaded: {times}")
+
+        ### 在后台导入; 请求线程若同时导入同一模块会在import锁上等待, 不会重复初始化
+        threading.Thread(target=preload, name="tts_frontend_preload", daemon=True).start()
+
     def init_cnhuhbert_weights(self, base_path: str):
         print(f"Loading CNHuBERT weights from {base_path}")
         self.cnhuhbert_model = CNHubert(base_path)
@@ -532,12 +812,29 @@ class TTS:
         except ImportError:
             if self.configs.is_half and str(self.configs.device) != "cpu":
                 self.bert_model = self.bert_model.half()
+        if self.use_cpu_fast:
+            self.bert_model = cpu_fast.quantize_bert(self.bert_model, self.bert_tokenizer, self.configs.int8_tolerance)
 
-    def init_vits_weights(self, weights_path: str):
+    def init_vits_weights(self, weights_path: str, entry: dict = None):
+        entry = self._get_model_entry("vits", "VITS", weights_path, self._load_vits_weights, entry)
+
+        model_changed = self.vits_model is not entry["vits_model"]
         self.configs.vits_weights_path = weights_path
+        for key, value in entry["configs"].items():
+            setattr(self.configs, key, value)
+        self.configs.update_version(entry["version"])
+        self.configs.use_vocoder = entry["version"] in {"v3", "v4"}
+        self.is_v2pro = entry["version"] in {"v2Pro", "v2ProPlus"}
+        if self.is_v2pro:
+            self._timed("sv", self.init_sv_model)
+        if self.configs.use_vocoder:
+            self._timed("vocoder", self.init_vocoder, entry["version"])
+        self.vits_model = entry["vits_model"]
+        if model_changed:
+            self._refresh_prompt_cache()
+
+    def _load_vits_weights(self, weights_path: str) -> dict:
         version, model_version, if_lora_v3 = get_sovits_version_from_path_fast(weights_path)
-        if "Pro" in model_version:
-            self.init_sv_model()
         path_sovits = self.configs.default_configs[model_version]["vits_weights_path"]
 
         if if_lora_v3 == True and os.path.exists(path_sovits) == False:
@@ -564,47 +861,44 @@ class TTS:
         else:
             hps["model"]["version"] = model_version
 
-        self.configs.filter_length = hps["data"]["filter_length"]
-        self.configs.segment_size = hps["train"]["segment_size"]
-        self.configs.sampling_rate = hps["data"]["sampling_rate"]
-        self.configs.hop_length = hps["data"]["hop_length"]
-        self.configs.win_length = hps["data"]["win_length"]
-        self.configs.n_speakers = hps["data"]["n_speakers"]
-        self.configs.semantic_frame_rate = hps["model"]["semantic_frame_rate"]
+        vits_configs = {
+            "filter_length": hps["data"]["filter_length"],
+            "segment_size": hps["train"]["segment_size"],
+            "sampling_rate": hps["data"]["sampling_rate"],
+            "hop_length": hps["data"]["hop_length"],
+            "win_length": hps["data"]["win_length"],
+            "n_speakers": hps["data"]["n_speakers"],
+            "semantic_frame_rate": hps["model"]["semantic_frame_rate"],
+        }
         kwargs = hps["model"]
-        # print(f"self.configs.sampling_rate:{self.configs.sampling_rate}")
-
-        self.configs.update_version(model_version)
 
         # print(f"model_version:{model_version}")
         # print(f'hps["model"]["version"]:{hps["model"]["version"]}')
         if model_version not in v3v4set:
             vits_model = SynthesizerTrn(
-                self.configs.filter_length // 2 + 1,
-                self.configs.segment_size // self.configs.hop_length,
-                n_speakers=self.configs.n_speakers,
+                vits_configs["filter_length"] // 2 + 1,
+                vits_configs["segment_size"] // vits_configs["hop_length"],
+                n_speakers=vits_configs["n_speakers"],
                 **kwargs,
             )
-            self.configs.use_vocoder = False
         else:
             kwargs["version"] = model_version
             vits_model = SynthesizerTrnV3(
-                self.configs.filter_length // 2 + 1,
-                self.configs.segment_size // self.configs.hop_length,
-                n_speakers=self.configs.n_speakers,
+                vits_configs["filter_length"] // 2 + 1,
+                vits_configs["segment_size"] // vits_configs["hop_length"],
+                n_speakers=vits_configs["n_speakers"],
                 **kwargs,
             )
-            self.configs.use_vocoder = True
-            self.init_vocoder(model_version)
             if "pretrained" not in weights_path and hasattr(vits_model, "enc_q"):
                 del vits_model.enc_q
 
-        self.is_v2pro = model_version in {"v2Pro", "v2ProPlus"}
-
         if if_lora_v3 == False:
-            print(
-                f"Loading VITS weights from {weights_path}. {vits_model.load_state_dict(dict_s2['weight'], strict=False)}"
-            )
+            if is_mmap_checkpoint(weights_path):
+                # 内存映射权重直接作为模型参数, 不再拷贝进初始化出来的参数
+                load_info = load_state_dict_mmap(vits_model, dict_s2["weight"], strict=False)
+            else:
+                load_info = vits_model.load_state_dict(dict_s2["weight"], strict=False)
+            print(f"Loading VITS weights from {weights_path}. {load_info}")
         else:
             print(
                 f"Loading VITS pretrained weights from {weights_path}. {vits_model.load_state_dict(load_sovits_new(path_sovits)['weight'], strict=False)}"
@@ -626,49 +920,128 @@ class TTS:
         vits_model = vits_model.to(self.configs.device)
         vits_model = vits_model.eval()
 
-        self.vits_model = vits_model
         # 检查是否为MUSA设备，如果是则不使用半精度
         try:
             import torch_musa
             if torch_musa.is_available() and "musa" in str(self.configs.device):
                 print("MUSA设备检测到，VITS模型使用全精度")
             elif self.configs.is_half and str(self.configs.device) != "cpu":
-                self.vits_model = self.vits_model.half()
+                vits_model = vits_model.half()
         except ImportError:
             if self.configs.is_half and str(self.configs.device) != "cpu":
-                self.vits_model = self.vits_model.half()
+                vits_model = vits_model.half()
+        if self.use_cpu_fast:
+            cpu_fast.quantize_text_encoder(vits_model, self.configs.int8_tolerance)
+
+        return {"vits_model": vits_model, "version": model_version, "configs": vits_configs}
+
+    def init_t2s_weights(self, weights_path: str, save: bool = True, entry: dict = None):
+        entry = self._get_model_entry("t2s", "Text2Semantic", weights_path, self._load_t2s_weights, entry)
 
-    def init_t2s_weights(self, weights_path: str):
-        print(f"Loading Text2Semantic weights from {weights_path}")
         self.configs.t2s_weights_path = weights_path
-        self.configs.save_configs()
+        if save:
+            self.configs.save_configs()
         self.configs.hz = 50
-        dict_s1 = torch.load(weights_path, map_location=self.configs.device, weights_only=False)
+        self.configs.max_sec = entry["max_sec"]
+        self.t2s_model = entry["t2s_model"]
+        if self.configs.t2s_prefill_cache_mb > 0 and self.t2s_model.model.prefill_cache is None:
+            self.t2s_model.model.prefill_cache = PrefillCache(int(self.configs.t2s_prefill_cache_mb * 1024 * 1024))
+        self.init_t2s_scheduler(entry)
+
+    def _load_t2s_weights(self, weights_path: str) -> dict:
+        print(f"Loading Text2Semantic weights from {weights_path}")
+        dict_s1 = load_gpt_weights(weights_path, map_location=self.configs.device)
         config = dict_s1["config"]
-        self.configs.max_sec = config["data"]["max_sec"]
         t2s_model = Text2SemanticLightningModule(config, "****", is_train=False)
+        # T2SBlock/T2SMLP持有h.layers里参数的引用, assign=True会让它们继续指向随机初始化的张量,
+        # 因此.safetensors也按原地拷贝加载
         t2s_model.load_state_dict(dict_s1["weight"])
         t2s_model = t2s_model.to(self.configs.device)
         t2s_model = t2s_model.eval()
-        self.t2s_model = t2s_model
         # 检查是否为MUSA设备，如果是则不使用半精度
         try:
             import torch_musa
             if torch_musa.is_available() and "musa" in str(self.configs.device):
                 print("MUSA设备检测到，Text2Semantic模型使用全精度")
             elif self.configs.is_half and str(self.configs.device) != "cpu":
-                self.t2s_model = self.t2s_model.half()
+                t2s_model = t2s_model.half()
         except ImportError:
             if self.configs.is_half and str(self.configs.device) != "cpu":
-                self.t2s_model = self.t2s_model.half()
+                t2s_model = t2s_model.half()
+        if self.use_cpu_fast:
+            cpu_fast.quantize_t2s(t2s_model.model, self.configs.int8_tolerance)
+        return {"t2s_model": t2s_model, "max_sec": config["data"]["max_sec"]}
+
+    def _get_model_entry(self, kind: str, label: str, weights_path: str, load, entry: dict = None) -> dict:
+        ### 已常驻的模型直接取用, 否则加载; 取到的模型被本实例pin住, 直到切换到其他模型
+        with self.model_load_lock:
+            if entry is None:
+                entry = self.model_registry.get(kind, weights_path)
+                if entry is None:
+                    entry = load(weights_path)
+                else:
+                    print(f"Using resident {label} weights {weights_path}")
+            self._pin_model(kind, weights_path)
+            self.model_registry.put(kind, weights_path, entry, self._resident_model_keys())
+        return entry
+
+    def _pin_model(self, kind: str, name: str):
+        key = (kind, name)
+        previous = self._pinned_models.get(kind)
+        if previous == key:
+            return
+        self.model_registry.pin(kind, name)
+        self._pinned_models[kind] = key
+        if previous is not None:
+            self.model_registry.unpin(*previous)
+
+    def _unpin_models(self):
+        for kind in list(self._pinned_models.keys()):
+            self.model_registry.unpin(*self._pinned_models.pop(kind))
+
+    def _resident_model_keys(self) -> list:
+        keys = [("t2s", self.configs.t2s_weights_path), ("vits", self.configs.vits_weights_path)]
+        if self.configs.use_vocoder:
+            keys.append(("vocoder", self.configs.version))
+        return keys
+
+    def _refresh_prompt_cache(self):
+        ### 参考音频/参考文本特征依赖于SoVITS模型及其版本, 切换模型后重新获取(命中ReferenceCache时不会重新提取)
+        if getattr(self, "prompt_cache", None) is None:
+            return
+        with self.prompt_lock:
+            self.prompt_cache["prompt_text"] = None
+            self.prompt_cache["aux_ref_audio_paths"] = []
+            self.prompt_cache["refer_spec"] = []
+            ref_audio_path = self.prompt_cache["ref_audio_path"]
+            if ref_audio_path is not None:
+                self.set_ref_audio(ref_audio_path)
+
+    def init_t2s_scheduler(self, entry: dict):
+        ### 每个T2S模型一个调度器, 随模型常驻在model_registry中; 切换模型不会关闭其他模型的调度器
+        self.t2s_scheduler = None
+        if not self.configs.continuous_batching:
+            return
+        if entry.get("scheduler") is None:
+            print(f"T2S continuous batching enabled, max_batch_size: {self.configs.max_batch_size}")
+            entry["scheduler"] = T2SScheduler(entry["t2s_model"].model, max_batch_size=self.configs.max_batch_size)
+        self.t2s_scheduler = entry["scheduler"]
 
     def init_vocoder(self, version: str):
+        entry = self.model_registry.get("vocoder", version)
+        if entry is not None:
+            self.vocoder = entry["vocoder"]
+            self.vocoder_configs.update(entry["vocoder_configs"])
+            self._pin_model("vocoder", version)
+            return
+
         if version == "v3":
             if self.vocoder is not None and self.vocoder.__class__.__name__ == "BigVGAN":
                 return
             if self.vocoder is not None:
-                self.vocoder.cpu()
-                del self.vocoder
+                # 旧的声码器由model_registry按LRU淘汰
+                self.vocoder = None
+                self.model_registry.trim(self._resident_model_keys())
                 self.empty_cache()
 
             self.vocoder = BigVGAN.from_pretrained(
@@ -688,8 +1061,9 @@ class TTS:
             if self.vocoder is not None and self.vocoder.__class__.__name__ == "Generator":
                 return
             if self.vocoder is not None:
-                self.vocoder.cpu()
-                del self.vocoder
+                # 旧的声码器由model_registry按LRU淘汰
+                self.vocoder = None
+                self.model_registry.trim(self._resident_model_keys())
                 self.empty_cache()
 
             self.vocoder = Generator(
@@ -733,6 +1107,13 @@ class TTS:
                 self.vocoder = self.vocoder.half().to(self.configs.device)
             else:
                 self.vocoder = self.vocoder.to(self.configs.device)
+        self._pin_model("vocoder", version)
+        self.model_registry.put(
+            "vocoder",
+            version,
+            {"vocoder": self.vocoder, "vocoder_configs": dict(self.vocoder_configs)},
+            self._resident_model_keys(),
+        )
 
     def init_sr_model(self):
         if self.sr_model is not None:
@@ -795,6 +1176,8 @@ class TTS:
                 self.cnhuhbert_model = self.cnhuhbert_model.float()
             if self.vocoder is not None:
                 self.vocoder = self.vocoder.float()
+        # 未在使用的常驻模型不随之转换精度, 直接释放, 下次使用时重新加载
+        self.model_registry.clear(keep=self._resident_model_keys())
 
     def set_device(self, device: torch.device, save: bool = True):
         """
@@ -802,11 +1185,16 @@ class TTS:
         Args:
             device: torch.device, the device to use for all models.
         """
+        if self.use_cpu_fast and str(device) != "cpu":
+            print("cpu_fast profile: int8 quantized models only run on CPU, device unchanged.")
+            return
         self.configs.device = device
         if save:
             self.configs.save_configs()
         if self.t2s_model is not None:
             self.t2s_model = self.t2s_model.to(device)
+            if self.t2s_model.model.prefill_cache is not None:
+                self.t2s_model.model.prefill_cache.clear()
         if self.vits_model is not None:
             self.vits_model = self.vits_model.to(device)
         if self.bert_model is not None:
@@ -817,6 +1205,9 @@ class TTS:
             self.vocoder = self.vocoder.to(device)
         if self.sr_model is not None:
             self.sr_model = self.sr_model.to(device)
+        self.model_registry.clear(keep=self._resident_model_keys())
+        self.ref_cache.device = device
+        self.ref_cache.clear()
 
     def set_ref_audio(self, ref_audio_path: str):
         """
@@ -825,13 +1216,20 @@ class TTS:
         Args:
             ref_audio_path: str, the path of the reference audio.
         """
-        self._set_prompt_semantic(ref_audio_path)
-        self._set_ref_spec(ref_audio_path)
-        self._set_ref_audio_path(ref_audio_path)
+        with self.prompt_lock:
+            self._set_prompt_semantic(ref_audio_path)
+            self._set_ref_spec(ref_audio_path)
+            self._set_ref_audio_path(ref_audio_path)
 
     def _set_ref_audio_path(self, ref_audio_path):
         self.prompt_cache["ref_audio_path"] = ref_audio_path
 
+    def _snapshot_prompt_cache(self) -> dict:
+        prompt_cache = dict(self.prompt_cache)
+        prompt_cache["refer_spec"] = list(self.prompt_cache["refer_spec"])
+        prompt_cache["aux_ref_audio_paths"] = list(self.prompt_cache["aux_ref_audio_paths"])
+        return prompt_cache
+
     def _set_ref_spec(self, ref_audio_path):
         spec_audio = self._get_ref_spec(ref_audio_path)
         if self.prompt_cache["refer_spec"] in [[], None]:
@@ -839,11 +1237,26 @@ class TTS:
         else:
             self.prompt_cache["refer_spec"][0] = spec_audio
 
+    def _ref_audio_cache_key(self, ref_audio_path: str, *parts: str) -> str:
+        # 参考音频特征依赖于SoVITS模型(量化器、采样率、v2Pro的sv分支)和精度
+        return self.ref_cache.hash_file(
+            ref_audio_path, self.configs.version, self.configs.vits_weights_path, str(self.precision), *parts
+        )
+
     def _get_ref_spec(self, ref_audio_path):
+        key = self._ref_audio_cache_key(ref_audio_path)
+        entry = self.ref_cache.get("ref_spec", key)
+        if entry is None:
+            entry = self._extract_ref_spec(ref_audio_path)
+            self.ref_cache.put("ref_spec", key, entry)
+        self.prompt_cache["raw_audio"] = entry["raw_audio"]
+        self.prompt_cache["raw_sr"] = entry["raw_sr"]
+        ### key一并返回, 供_get_ge按参考音频内容缓存ge
+        return entry["spec"], entry["audio"], entry["sv_emb"], key
+
+    def _extract_ref_spec(self, ref_audio_path) -> dict:
         raw_audio, raw_sr = torchaudio.load(ref_audio_path)
         raw_audio = raw_audio.to(self.configs.device).float()
-        self.prompt_cache["raw_audio"] = raw_audio
-        self.prompt_cache["raw_sr"] = raw_sr
 
         if raw_sr != self.configs.sampling_rate:
             audio = raw_audio.to(self.configs.device)
@@ -868,15 +1281,60 @@ class TTS:
         )
         if self.configs.is_half:
             spec = spec.half()
+        sv_emb = None
         if self.is_v2pro == True:
             audio = resample(audio, self.configs.sampling_rate, 16000, self.configs.device)
             if self.configs.is_half:
                 audio = audio.half()
+            sv_emb = self.sv_model.compute_embedding3(audio)
         else:
             audio = None
-        return spec, audio
+        return {"raw_audio": raw_audio, "raw_sr": raw_sr, "spec": spec, "audio": audio, "sv_emb": sv_emb}
+
+    def _get_ge(self, prompt_cache: dict) -> torch.Tensor:
+        """
+        SoVITS的说话人全局条件ge(ref_enc, v2Pro还有sv embedding投影, 多个参考时取平均)只取决于参考音频组和SoVITS模型,
+        按参考音频组的内容hash存在ref_cache中, 每组参考只计算一次, 之后的句子、请求以及切换回来的参考直接复用
+        """
+        entries = [
+            entry if isinstance(entry, tuple) else (entry, None, None, None) for entry in prompt_cache["refer_spec"]
+        ]
+        specs = [spec for spec, _, _, _ in entries]
+        ref_keys = [ref_key for _, _, _, ref_key in entries]
+        ### 每个参考的key已包含内容hash、模型版本、SoVITS权重路径和精度; 外部直接设置的spec没有key, 不缓存
+        key = None
+        if None not in ref_keys:
+            key = self.ref_cache.hash_text(self.configs.use_vocoder, *ref_keys)
+            cached = self.ref_cache.get("ge", key)
+            if cached is not None:
+                return cached["ge"]
+
+        refer_audio_spec = [spec.to(dtype=self.precision, device=self.configs.device) for spec in specs]
+        if self.configs.use_vocoder:
+            ge = self.vits_model.get_ge(refer_audio_spec[0])
+        else:
+            sv_emb = None
+            if self.is_v2pro:
+                ### sv embedding一般已随参考音频特征一起缓存, 这里只补算缺失的
+                sv_emb = [
+                    ref_sv_emb if ref_sv_emb is not None else self.sv_model.compute_embedding3(audio_tensor)
+                    for _, audio_tensor, ref_sv_emb, _ in entries
+                ]
+            ge = self.vits_model.get_ge(refer_audio_spec, sv_emb)
+        if key is not None:
+            self.ref_cache.put("ge", key, {"ge": ge})
+        return ge
 
     def _set_prompt_semantic(self, ref_wav_path: str):
+        # prompt_semantic还依赖于CNHuBERT模型
+        key = self._ref_audio_cache_key(ref_wav_path, self.configs.cnhuhbert_base_path)
+        entry = self.ref_cache.get("prompt_semantic", key)
+        if entry is None:
+            entry = {"prompt_semantic": self._extract_prompt_semantic(ref_wav_path)}
+            self.ref_cache.put("prompt_semantic", key, entry)
+        self.prompt_cache["prompt_semantic"] = entry["prompt_semantic"]
+
+    def _extract_prompt_semantic(self, ref_wav_path: str) -> torch.Tensor:
         zero_wav = np.zeros(
             int(self.configs.sampling_rate * 0.3),
             dtype=np.float16 if self.configs.is_half else np.float32,
@@ -900,7 +1358,18 @@ class TTS:
             codes = self.vits_model.extract_latent(hubert_feature)
 
             prompt_semantic = codes[0, 0].to(self.configs.device)
-            self.prompt_cache["prompt_semantic"] = prompt_semantic
+        return prompt_semantic
+
+    def _get_prompt_text_features(self, prompt_text: str, prompt_lang: str):
+        key = self.ref_cache.hash_text(prompt_text, prompt_lang, self.configs.version, self.configs.bert_base_path)
+        entry = self.ref_cache.get("prompt_text", key)
+        if entry is None:
+            phones, bert_features, norm_text = self.text_preprocessor.segment_and_extract_feature_for_text(
+                prompt_text, prompt_lang, self.configs.version
+            )
+            entry = {"phones": phones, "bert_features": bert_features, "norm_text": norm_text}
+            self.ref_cache.put("prompt_text", key, entry)
+        return entry["phones"], entry["bert_features"], entry["norm_text"]
 
     def batch_sequences(self, sequences: List[torch.Tensor], axis: int = 0, pad_value: int = 0, max_length: int = None):
         seq = sequences[0]
@@ -1060,12 +1529,13 @@ class TTS:
         self,
     ):
         """
-        Stop the inference process.
+        Stop the inference process of every running request.
         """
-        self.stop_flag = True
+        with self._contexts_lock:
+            for context in self._contexts:
+                context.stop()
 
-    @torch.no_grad()
-    def run(self, inputs: dict):
+    def run(self, inputs: dict, context: RequestContext = None):
         """
         Text to speech inference.
 
@@ -1093,12 +1563,109 @@ class TTS:
                     "repetition_penalty": 1.35    # float. repetition penalty for T2S model.
                     "sample_steps": 32,           # int. number of sampling steps for VITS model V3.
                     "super_sampling": False,       # bool. whether to use super-sampling for audio when using VITS model V3.
+                    "token_streaming": False,     # bool. vocode semantic tokens while T2S is still decoding, implies return_fragment.
+                    "min_chunk_length": 16,       # int. number of semantic tokens per chunk in token streaming mode.
+                    "overlap_length": 2,          # int. number of semantic tokens shared by adjacent chunks in token streaming mode.
+                    "t2s_weights_path": None,     # str.(optional) GPT weights to use for this request, kept resident by model_registry.
+                    "vits_weights_path": None,    # str.(optional) SoVITS weights to use for this request, kept resident by model_registry.
                 }
+            context (RequestContext): (optional) stops only this request with context.stop().
         returns:
             Tuple[int, np.ndarray]: sampling rate and audio data.
         """
+        context = RequestContext() if context is None else context
+        with self._contexts_lock:
+            self._contexts.add(context)
+        try:
+            with self._request_models(
+                inputs.get("t2s_weights_path", None), inputs.get("vits_weights_path", None)
+            ) as tts:
+                yield from tts._run(inputs, context)
+        except Exception:
+            ### 推理出错后重置模型, 否则会导致显存释放不完全; 等其他请求结束后再重置, 不影响正在推理的请求
+            for t2s_weights_path, vits_weights_path in context.failed_models:
+                self._reset_models(t2s_weights_path, vits_weights_path)
+            raise
+        finally:
+            with self._contexts_lock:
+                self._contexts.discard(context)
+
+    def set_active_models(self, t2s_weights_path: str = None, vits_weights_path: str = None):
+        """
+        Activate other GPT/SoVITS weights for every later request, once the requests in flight are done.
+        """
+        with self.model_lock.exclusive():
+            if t2s_weights_path not in [None, ""]:
+                self.init_t2s_weights(t2s_weights_path)
+            if vits_weights_path not in [None, ""]:
+                self.init_vits_weights(vits_weights_path)
+
+    def _reset_models(self, t2s_weights_path: str, vits_weights_path: str):
+        with self.model_lock.exclusive():
+            self.model_registry.remove("t2s", t2s_weights_path)
+            self.model_registry.remove("vits", vits_weights_path)
+            ### 出错的是本实例的模型时重新加载; 其他模型下次被请求时再加载
+            if t2s_weights_path == self.configs.t2s_weights_path:
+                self.t2s_model = None
+                self.init_t2s_weights(t2s_weights_path, save=False)
+            if vits_weights_path == self.configs.vits_weights_path:
+                self.vits_model = None
+                self.init_vits_weights(vits_weights_path)
+
+    def _request_view(self) -> "TTS":
+        """
+        Shallow copy of the instance for one request on other GPT/SoVITS weights. It shares the BERT/CNHuBERT
+        models, the caches and the model registry, but activates its models on its own configs and prompt cache.
+        """
+        view = copy(self)
+        view.configs = copy(self.configs)
+        view.vocoder_configs = dict(self.vocoder_configs)
+        with self.prompt_lock:
+            view.prompt_cache = self._snapshot_prompt_cache()
+        view.prompt_lock = threading.RLock()
+        view._pinned_models = {}
+        return view
+
+    @contextmanager
+    def _request_models(self, t2s_weights_path: str = None, vits_weights_path: str = None):
+        """
+        Yields the TTS a request runs on. Requests on the active models share the instance; a request that picks
+        other GPT/SoVITS weights runs on a request view with those models, concurrently with the other requests,
+        and the models of the instance are left untouched.
+        """
+        t2s_weights_path = None if t2s_weights_path in [None, ""] else t2s_weights_path
+        vits_weights_path = None if vits_weights_path in [None, ""] else vits_weights_path
+        with self.model_lock.shared():
+            if t2s_weights_path in [None, self.configs.t2s_weights_path] and vits_weights_path in [
+                None,
+                self.configs.vits_weights_path,
+            ]:
+                yield self
+                return
+
+            view = self._request_view()
+            try:
+                ###### 按请求使用其他GPT/SoVITS模型, 已常驻的模型直接取用, 不重新加载 ########
+                if t2s_weights_path is not None and t2s_weights_path != self.configs.t2s_weights_path:
+                    view.init_t2s_weights(t2s_weights_path, save=False)
+                if vits_weights_path is not None and vits_weights_path != self.configs.vits_weights_path:
+                    view.init_vits_weights(vits_weights_path)
+                yield view
+            finally:
+                view._unpin_models()
+                ### 与音色无关的SV/超分模型由实例保留, 之后的请求不再重复加载
+                if self.sv_model is None:
+                    self.sv_model = view.sv_model
+                if self.sr_model is None and not view.sr_model_not_exist:
+                    self.sr_model = view.sr_model
+
+    @torch.no_grad()
+    def _run(self, inputs: dict, context: RequestContext):
+        """
+        Text to speech inference on the active models, see `run` for the inputs.
+        If inference fails, the weights paths of the models are appended to `context.failed_models`.
+        """
         ########## variables initialization ###########
-        self.stop_flag: bool = False
         text: str = inputs.get("text", "")
         text_lang: str = inputs.get("text_lang", "")
         ref_audio_path: str = inputs.get("ref_audio_path", "")
@@ -1117,18 +1684,34 @@ class TTS:
         fragment_interval = inputs.get("fragment_interval", 0.3)
         seed = inputs.get("seed", -1)
         seed = -1 if seed in ["", None] else seed
-        actual_seed = set_seed(seed)
+        actual_seed = context.set_seed(seed, self.configs.device)
+        generator = context.generator
         parallel_infer = inputs.get("parallel_infer", True)
         repetition_penalty = inputs.get("repetition_penalty", 1.35)
         sample_steps = inputs.get("sample_steps", 32)
         super_sampling = inputs.get("super_sampling", False)
+        token_streaming = inputs.get("token_streaming", False)
+        min_chunk_length = max(1, int(inputs.get("min_chunk_length", 16)))
+        overlap_length = max(0, int(inputs.get("overlap_length", 2)))
 
         if parallel_infer:
             print(i18n("并行推理模式已开启"))
-            self.t2s_model.model.infer_panel = self.t2s_model.model.infer_panel_batch_infer
+            if self.t2s_scheduler is not None:
+                infer_panel = self.t2s_scheduler.infer_panel
+            else:
+                infer_panel = self.t2s_model.model.infer_panel_batch_infer
         else:
             print(i18n("并行推理模式已关闭"))
-            self.t2s_model.model.infer_panel = self.t2s_model.model.infer_panel_naive_batched
+            infer_panel = self.t2s_model.model.infer_panel_naive_batched
+
+        if token_streaming:
+            print(i18n("逐token流式合成模式已开启"))
+            return_fragment = True
+            ### 每句单独解码, 逐块合成
+            batch_size = 1
+            if super_sampling:
+                super_sampling = False
+                print(i18n("流式合成模式不支持超采样，已自动关闭超采样"))
 
         if return_fragment:
             print(i18n("分段返回模式已开启"))
@@ -1171,41 +1754,43 @@ class TTS:
 
         ###### setting reference audio and prompt text preprocessing ########
         t0 = time.perf_counter()
-        if (ref_audio_path is not None) and (
-            ref_audio_path != self.prompt_cache["ref_audio_path"]
-            or (self.is_v2pro and self.prompt_cache["refer_spec"][0][1] is None)
-        ):
-            if not os.path.exists(ref_audio_path):
-                raise ValueError(f"{ref_audio_path} not exists")
-            self.set_ref_audio(ref_audio_path)
-
-        aux_ref_audio_paths = aux_ref_audio_paths if aux_ref_audio_paths is not None else []
-        paths = set(aux_ref_audio_paths) & set(self.prompt_cache["aux_ref_audio_paths"])
-        if not (len(list(paths)) == len(aux_ref_audio_paths) == len(self.prompt_cache["aux_ref_audio_paths"])):
-            self.prompt_cache["aux_ref_audio_paths"] = aux_ref_audio_paths
-            self.prompt_cache["refer_spec"] = [self.prompt_cache["refer_spec"][0]]
-            for path in aux_ref_audio_paths:
-                if path in [None, ""]:
-                    continue
-                if not os.path.exists(path):
-                    print(i18n("音频文件不存在，跳过："), path)
-                    continue
-                self.prompt_cache["refer_spec"].append(self._get_ref_spec(path))
-
-        if not no_prompt_text:
-            prompt_text = prompt_text.strip("\n")
-            if prompt_text[-1] not in splits:
-                prompt_text += "。" if prompt_lang != "en" else "."
-            print(i18n("实际输入的参考文本:"), prompt_text)
-            if self.prompt_cache["prompt_text"] != prompt_text:
-                phones, bert_features, norm_text = self.text_preprocessor.segment_and_extract_feature_for_text(
-                    prompt_text, prompt_lang, self.configs.version
-                )
-                self.prompt_cache["prompt_text"] = prompt_text
-                self.prompt_cache["prompt_lang"] = prompt_lang
-                self.prompt_cache["phones"] = phones
-                self.prompt_cache["bert_features"] = bert_features
-                self.prompt_cache["norm_text"] = norm_text
+        with self.prompt_lock:
+            if (ref_audio_path is not None) and (
+                ref_audio_path != self.prompt_cache["ref_audio_path"]
+                or (self.is_v2pro and self.prompt_cache["refer_spec"][0][1] is None)
+            ):
+                if not os.path.exists(ref_audio_path):
+                    raise ValueError(f"{ref_audio_path} not exists")
+                self.set_ref_audio(ref_audio_path)
+
+            aux_ref_audio_paths = aux_ref_audio_paths if aux_ref_audio_paths is not None else []
+            paths = set(aux_ref_audio_paths) & set(self.prompt_cache["aux_ref_audio_paths"])
+            if not (len(list(paths)) == len(aux_ref_audio_paths) == len(self.prompt_cache["aux_ref_audio_paths"])):
+                self.prompt_cache["aux_ref_audio_paths"] = aux_ref_audio_paths
+                self.prompt_cache["refer_spec"] = [self.prompt_cache["refer_spec"][0]]
+                for path in aux_ref_audio_paths:
+                    if path in [None, ""]:
+                        continue
+                    if not os.path.exists(path):
+                        print(i18n("音频文件不存在，跳过："), path)
+                        continue
+                    self.prompt_cache["refer_spec"].append(self._get_ref_spec(path))
+
+            if not no_prompt_text:
+                prompt_text = prompt_text.strip("\n")
+                if prompt_text[-1] not in splits:
+                    prompt_text += "。" if prompt_lang != "en" else "."
+                print(i18n("实际输入的参考文本:"), prompt_text)
+                if self.prompt_cache["prompt_text"] != prompt_text or self.prompt_cache["prompt_lang"] != prompt_lang:
+                    phones, bert_features, norm_text = self._get_prompt_text_features(prompt_text, prompt_lang)
+                    self.prompt_cache["prompt_text"] = prompt_text
+                    self.prompt_cache["prompt_lang"] = prompt_lang
+                    self.prompt_cache["phones"] = phones
+                    self.prompt_cache["bert_features"] = bert_features
+                    self.prompt_cache["norm_text"] = norm_text
+
+            # 每个请求使用自己的prompt快照, 避免并发请求切换参考音频时互相覆盖
+            prompt_cache = self._snapshot_prompt_cache()
 
         ###### text preprocessing ########
         t1 = time.perf_counter()
@@ -1219,7 +1804,7 @@ class TTS:
             batch_index_list: list = None
             data, batch_index_list = self.to_batch(
                 data,
-                prompt_data=self.prompt_cache if not no_prompt_text else None,
+                prompt_data=prompt_cache if not no_prompt_text else None,
                 batch_size=batch_size,
                 threshold=batch_threshold,
                 split_bucket=split_bucket,
@@ -1238,10 +1823,9 @@ class TTS:
             def make_batch(batch_texts):
                 batch_data = []
                 print(f"############ {i18n('提取文本Bert特征')} ############")
-                for text in tqdm(batch_texts):
-                    phones, bert_features, norm_text = self.text_preprocessor.segment_and_extract_feature_for_text(
-                        text, text_lang, self.configs.version
-                    )
+                for phones, bert_features, norm_text in self.text_preprocessor.extract_features_batch(
+                    batch_texts, text_lang, self.configs.version
+                ):
                     if phones is None:
                         continue
                     res = {
@@ -1254,7 +1838,7 @@ class TTS:
                     return None
                 batch, _ = self.to_batch(
                     batch_data,
-                    prompt_data=self.prompt_cache if not no_prompt_text else None,
+                    prompt_data=prompt_cache if not no_prompt_text else None,
                     batch_size=batch_size,
                     threshold=batch_threshold,
                     split_bucket=False,
@@ -1264,6 +1848,7 @@ class TTS:
                 return batch[0]
 
         t2 = time.perf_counter()
+        items = None
         try:
             print("############ 推理 ############")
             ###### inference ######
@@ -1271,16 +1856,9 @@ class TTS:
             t_45 = 0.0
             audio = []
             output_sr = self.configs.sampling_rate if not self.configs.use_vocoder else self.vocoder_configs["sr"]
-            for item in data:
-                t3 = time.perf_counter()
-                if return_fragment:
-                    item = make_batch(item)
-                    if item is None:
-                        continue
 
-                batch_phones: List[torch.LongTensor] = item["phones"]
-                # batch_phones:torch.LongTensor = item["phones"]
-                batch_phones_len: torch.LongTensor = item["phones_len"]
+            def predict_semantic(item: dict):
+                t3 = time.perf_counter()
                 all_phoneme_ids: torch.LongTensor = item["all_phones"]
                 all_phoneme_lens: torch.LongTensor = item["all_phones_len"]
                 all_bert_features: torch.LongTensor = item["all_bert_features"]
@@ -1292,11 +1870,11 @@ class TTS:
                     prompt = None
                 else:
                     prompt = (
-                        self.prompt_cache["prompt_semantic"].expand(len(all_phoneme_ids), -1).to(self.configs.device)
+                        prompt_cache["prompt_semantic"].expand(len(all_phoneme_ids), -1).to(self.configs.device)
                     )
 
                 print(f"############ {i18n('预测语义Token')} ############")
-                pred_semantic_list, idx_list = self.t2s_model.model.infer_panel(
+                pred_semantic_list, idx_list = infer_panel(
                     all_phoneme_ids,
                     all_phoneme_lens,
                     prompt,
@@ -1308,85 +1886,70 @@ class TTS:
                     early_stop_num=self.configs.hz * self.configs.max_sec,
                     max_len=max_len,
                     repetition_penalty=repetition_penalty,
+                    static_kv_cache=self.configs.static_kv_cache,
+                    decode_graph=self.configs.t2s_decode_graph,
+                    cancelled=context.is_stopped,
+                    generator=generator,
                 )
-                t4 = time.perf_counter()
-                t_34 += t4 - t3
+                item["pred_semantic_list"] = pred_semantic_list
+                item["idx_list"] = idx_list
+                item["t2s_time"] = time.perf_counter() - t3
+                return item
 
-                refer_audio_spec = []
-                if self.is_v2pro:
-                    sv_emb = []
-                for spec, audio_tensor in self.prompt_cache["refer_spec"]:
-                    spec = spec.to(dtype=self.precision, device=self.configs.device)
-                    refer_audio_spec.append(spec)
-                    if self.is_v2pro:
-                        sv_emb.append(self.sv_model.compute_embedding3(audio_tensor))
+            def synthesize(item: dict):
+                batch_phones: List[torch.LongTensor] = item["phones"]
+                pred_semantic_list = item["pred_semantic_list"]
+                idx_list = item["idx_list"]
 
                 batch_audio_fragment = []
 
-                # ## vits并行推理 method 1
-                # pred_semantic_list = [item[-idx:] for item, idx in zip(pred_semantic_list, idx_list)]
-                # pred_semantic_len = torch.LongTensor([item.shape[0] for item in pred_semantic_list]).to(self.configs.device)
-                # pred_semantic = self.batch_sequences(pred_semantic_list, axis=0, pad_value=0).unsqueeze(0)
-                # max_len = 0
-                # for i in range(0, len(batch_phones)):
-                #     max_len = max(max_len, batch_phones[i].shape[-1])
-                # batch_phones = self.batch_sequences(batch_phones, axis=0, pad_value=0, max_length=max_len)
-                # batch_phones = batch_phones.to(self.configs.device)
-                # batch_audio_fragment = (self.vits_model.batched_decode(
-                #         pred_semantic, pred_semantic_len, batch_phones, batch_phones_len,refer_audio_spec
-                #     ))
                 print(f"############ {i18n('合成音频')} ############")
                 if not self.configs.use_vocoder:
-                    if speed_factor == 1.0:
-                        print(f"{i18n('并行合成中')}...")
-                        # ## vits并行推理 method 2
-                        pred_semantic_list = [item[-idx:] for item, idx in zip(pred_semantic_list, idx_list)]
-                        upsample_rate = math.prod(self.vits_model.upsample_rates)
-                        audio_frag_idx = [
-                            pred_semantic_list[i].shape[0] * 2 * upsample_rate
-                            for i in range(0, len(pred_semantic_list))
-                        ]
-                        audio_frag_end_idx = [sum(audio_frag_idx[: i + 1]) for i in range(0, len(audio_frag_idx))]
-                        all_pred_semantic = (
-                            torch.cat(pred_semantic_list).unsqueeze(0).unsqueeze(0).to(self.configs.device)
-                        )
-                        _batch_phones = torch.cat(batch_phones).unsqueeze(0).to(self.configs.device)
-                        if self.is_v2pro != True:
-                            _batch_audio_fragment = self.vits_model.decode(
-                                all_pred_semantic, _batch_phones, refer_audio_spec, speed=speed_factor
-                            ).detach()[0, 0, :]
-                        else:
-                            _batch_audio_fragment = self.vits_model.decode(
-                                all_pred_semantic, _batch_phones, refer_audio_spec, speed=speed_factor, sv_emb=sv_emb
-                            ).detach()[0, 0, :]
-                        audio_frag_end_idx.insert(0, 0)
-                        batch_audio_fragment = [
-                            _batch_audio_fragment[audio_frag_end_idx[i - 1] : audio_frag_end_idx[i]]
-                            for i in range(1, len(audio_frag_end_idx))
-                        ]
-                    else:
-                        # ## vits串行推理
-                        for i, idx in enumerate(tqdm(idx_list)):
-                            phones = batch_phones[i].unsqueeze(0).to(self.configs.device)
-                            _pred_semantic = (
-                                pred_semantic_list[i][-idx:].unsqueeze(0).unsqueeze(0)
-                            )  # .unsqueeze(0)#mq要多unsqueeze一次
-                            if self.is_v2pro != True:
-                                audio_fragment = self.vits_model.decode(
-                                    _pred_semantic, phones, refer_audio_spec, speed=speed_factor
-                                ).detach()[0, 0, :]
-                            else:
-                                audio_fragment = self.vits_model.decode(
-                                    _pred_semantic, phones, refer_audio_spec, speed=speed_factor, sv_emb=sv_emb
-                                ).detach()[0, 0, :]
-                            batch_audio_fragment.append(audio_fragment)  ###试试重建不带上prompt部分
+                    # ## vits并行推理: 各句padding成一个batch, 按各自长度mask, 一次前向合成, 输出按各自长度裁剪
+                    print(f"{i18n('并行合成中')}...")
+                    device = self.configs.device
+                    pred_semantic_list = [item[-idx:] for item, idx in zip(pred_semantic_list, idx_list)]
+                    pred_semantic_len = torch.LongTensor([item.shape[0] for item in pred_semantic_list]).to(device)
+                    pred_semantic = self.batch_sequences(pred_semantic_list, axis=0, pad_value=0).unsqueeze(0).to(device)
+                    batch_phones_len = torch.LongTensor([item.shape[-1] for item in batch_phones]).to(device)
+                    _batch_phones = self.batch_sequences(batch_phones, axis=0, pad_value=0).to(device)
+                    audio_fragments = self.vits_model.batched_decode(
+                        pred_semantic,
+                        pred_semantic_len,
+                        _batch_phones,
+                        batch_phones_len,
+                        None,
+                        speed=speed_factor,
+                        ge=self._get_ge(prompt_cache),
+                        generator=generator,
+                    )
+                    batch_audio_fragment = [audio_fragment.detach()[0, 0, :] for audio_fragment in audio_fragments]
                 else:
                     if parallel_infer:
                         print(f"{i18n('并行合成中')}...")
                         audio_fragments = self.using_vocoder_synthesis_batched_infer(
-                            idx_list, pred_semantic_list, batch_phones, speed=speed_factor, sample_steps=sample_steps
+                            idx_list,
+                            pred_semantic_list,
+                            batch_phones,
+                            speed=speed_factor,
+                            sample_steps=sample_steps,
+                            prompt_cache=prompt_cache,
+                            generator=generator,
                         )
                         batch_audio_fragment.extend(audio_fragments)
+                    elif self.cfm_scheduler is not None:
+                        ### 整批句子一起提交, 各句的第k块与其他并发请求的块合并推理
+                        rows = []
+                        for i, idx in enumerate(idx_list):
+                            phones = batch_phones[i].unsqueeze(0).to(self.configs.device)
+                            _pred_semantic = pred_semantic_list[i][-idx:].unsqueeze(0).unsqueeze(0)
+                            rows.append(
+                                self._make_cfm_row(
+                                    _pred_semantic, phones, speed_factor, sample_steps, prompt_cache, generator
+                                )
+                            )
+                        for cfm_res in self.cfm_scheduler.synthesize(rows, cancelled=context.is_stopped):
+                            batch_audio_fragment.append(self._vocode(cfm_res))
                     else:
                         for i, idx in enumerate(tqdm(idx_list)):
                             phones = batch_phones[i].unsqueeze(0).to(self.configs.device)
@@ -1394,14 +1957,124 @@ class TTS:
                                 pred_semantic_list[i][-idx:].unsqueeze(0).unsqueeze(0)
                             )  # .unsqueeze(0)#mq要多unsqueeze一次
                             audio_fragment = self.using_vocoder_synthesis(
-                                _pred_semantic, phones, speed=speed_factor, sample_steps=sample_steps
+                                _pred_semantic,
+                                phones,
+                                speed=speed_factor,
+                                sample_steps=sample_steps,
+                                prompt_cache=prompt_cache,
+                                generator=generator,
                             )
                             batch_audio_fragment.append(audio_fragment)
 
+                return batch_audio_fragment
+
+            def stream_synthesize(item: dict):
+                ### T2S每生成min_chunk_length个token, 就把新增token连同overlap_length个token的上文一起合成,
+                ### 相邻两块用sola_algorithm平滑拼接; 每块末尾的重叠部分暂不返回, 等下一块到来后再拼接
+                print(i18n("前端处理后的文本(每句):"), item["norm_text"])
+                phones = item["phones"][0]
+                if no_prompt_text:
+                    prompt = None
+                else:
+                    prompt = prompt_cache["prompt_semantic"].unsqueeze(0).to(self.configs.device)
+                stream = self.t2s_model.model.infer_panel_naive_stream(
+                    item["all_phones"][0].unsqueeze(0),
+                    item["all_phones_len"][0],
+                    prompt,
+                    item["all_bert_features"][0].unsqueeze(0),
+                    top_k=top_k,
+                    top_p=top_p,
+                    temperature=temperature,
+                    early_stop_num=self.configs.hz * self.configs.max_sec,
+                    repetition_penalty=repetition_penalty,
+                    chunk_length=min_chunk_length,
+                    static_kv_cache=self.configs.static_kv_cache,
+                    decode_graph=self.configs.t2s_decode_graph,
+                    generator=generator,
+                )
+
+                tokens_done = 0
+                tail = None
+                try:
+                    for pred_semantic, is_final in stream:
+                        n = pred_semantic.shape[1]
+                        if n <= tokens_done:
+                            if is_final and tail is not None:
+                                yield tail, True
+                            continue
+
+                        start = max(0, tokens_done - overlap_length)
+                        window = pred_semantic[0, start:n]
+                        audio_fragment = synthesize(
+                            {"phones": [phones], "pred_semantic_list": [window], "idx_list": [window.shape[0]]}
+                        )[0]
+                        samples_per_token = audio_fragment.shape[0] / window.shape[0]
+                        offset = int(round((tokens_done - start) * samples_per_token))
+
+                        if tail is None:
+                            audio_fragment = audio_fragment[offset:]
+                        else:
+                            overlap = min(offset, tail.shape[0])
+                            audio_fragment = audio_fragment[offset - overlap :]
+                            if overlap > 1:
+                                audio_fragment = self.sola_algorithm([tail, audio_fragment], overlap)
+                            else:
+                                audio_fragment = torch.cat([tail, audio_fragment], dim=0)
+                        tokens_done = n
+
+                        if is_final:
+                            yield audio_fragment, True
+                            return
+                        hold = min(int(round(overlap_length * samples_per_token)), audio_fragment.shape[0])
+                        tail = audio_fragment[audio_fragment.shape[0] - hold :]
+                        if audio_fragment.shape[0] > hold:
+                            yield audio_fragment[: audio_fragment.shape[0] - hold], False
+                finally:
+                    stream.close()
+
+            ### return_fragment模式下, 文本前端和T2S在工作线程中先行处理后续分段, 主线程只负责合成并返回当前分段
+            if token_streaming:
+                stages = [make_batch]
+            elif return_fragment:
+                stages = [make_batch, predict_semantic]
+            else:
+                stages = [predict_semantic]
+            items = run_stages(
+                data,
+                stages,
+                queue_size=self.configs.fragment_queue_size,
+                threaded=return_fragment and self.configs.fragment_pipeline,
+            )
+            for item in items:
+                if token_streaming:
+                    t4 = time.perf_counter()
+                    chunks = stream_synthesize(item)
+                    for audio_fragment, is_last in chunks:
+                        yield self.audio_postprocess(
+                            [[audio_fragment]],
+                            output_sr,
+                            None,
+                            speed_factor,
+                            False,
+                            fragment_interval if is_last else 0,
+                            False,
+                        )
+                        if context.is_stopped():
+                            break
+                    chunks.close()
+                    print("%.3f\t%.3f\t%.3f" % (t1 - t0, t2 - t1, time.perf_counter() - t4))
+                    if context.is_stopped():
+                        yield 16000, np.zeros(int(16000), dtype=np.int16)
+                        return
+                    continue
+
+                t4 = time.perf_counter()
+                batch_audio_fragment = synthesize(item)
                 t5 = time.perf_counter()
+                t_34 += item["t2s_time"]
                 t_45 += t5 - t4
                 if return_fragment:
-                    print("%.3f\t%.3f\t%.3f\t%.3f" % (t1 - t0, t2 - t1, t4 - t3, t5 - t4))
+                    print("%.3f\t%.3f\t%.3f\t%.3f" % (t1 - t0, t2 - t1, item["t2s_time"], t5 - t4))
                     yield self.audio_postprocess(
                         [batch_audio_fragment],
                         output_sr,
@@ -1414,7 +2087,7 @@ class TTS:
                 else:
                     audio.append(batch_audio_fragment)
 
-                if self.stop_flag:
+                if context.is_stopped():
                     yield 16000, np.zeros(int(16000), dtype=np.int16)
                     return
 
@@ -1435,17 +2108,19 @@ class TTS:
 
         except Exception as e:
             traceback.print_exc()
+            if items is not None:
+                items.close()
             # 必须返回一个空音频, 否则会导致显存不释放。
             yield 16000, np.zeros(int(16000), dtype=np.int16)
-            # 重置模型, 否则会导致显存释放不完全。
-            del self.t2s_model
-            del self.vits_model
-            self.t2s_model = None
-            self.vits_model = None
-            self.init_t2s_weights(self.configs.t2s_weights_path)
-            self.init_vits_weights(self.configs.vits_weights_path)
+            # 请求被停止时调度器中的行以异常结束, 与停止标志的处理一致, 不是模型出错
+            if context.is_stopped():
+                return
+            # 模型由run在其他请求结束后重置
+            context.failed_models.append((self.configs.t2s_weights_path, self.configs.vits_weights_path))
             raise e
         finally:
+            if items is not None:
+                items.close()
             self.empty_cache()
 
     def empty_cache(self):
@@ -1515,18 +2190,72 @@ class TTS:
         return sr, audio
 
     def using_vocoder_synthesis(
-        self, semantic_tokens: torch.Tensor, phones: torch.Tensor, speed: float = 1.0, sample_steps: int = 32
+        self,
+        semantic_tokens: torch.Tensor,
+        phones: torch.Tensor,
+        speed: float = 1.0,
+        sample_steps: int = 32,
+        prompt_cache: dict = None,
+        generator: torch.Generator = None,
     ):
-        prompt_semantic_tokens = self.prompt_cache["prompt_semantic"].unsqueeze(0).unsqueeze(0).to(self.configs.device)
-        prompt_phones = torch.LongTensor(self.prompt_cache["phones"]).unsqueeze(0).to(self.configs.device)
-        raw_entry = self.prompt_cache["refer_spec"][0]
+        row = self._make_cfm_row(semantic_tokens, phones, speed, sample_steps, prompt_cache, generator)
+        if self.cfm_scheduler is not None:
+            cfm_res = self.cfm_scheduler.synthesize([row])[0]
+        else:
+            done = not row.next_chunk()
+            while not done:
+                fea = torch.cat([row.fea_ref, row.chunk], 2).transpose(2, 1)
+                cfm_res = self.vits_model.cfm.inference(
+                    fea,
+                    torch.LongTensor([fea.size(1)]).to(fea.device),
+                    row.mel2,
+                    sample_steps,
+                    inference_cfg_rate=0,
+                    solver=self.configs.cfm_solver,
+                    schedule=self.configs.cfm_schedule,
+                    generator=generator,
+                )
+                done = row.update(cfm_res[:, :, row.mel2.shape[2] :])
+            if row.error is None and row.result is None:
+                row.finish()
+            if row.error is not None:
+                raise row.error
+            cfm_res = row.result
+        return self._vocode(cfm_res)
+
+    def _vocode(self, cfm_res: torch.Tensor) -> torch.Tensor:
+        cfm_res = denorm_spec(cfm_res)
+        with torch.inference_mode():
+            wav_gen = self.vocoder(cfm_res)
+            audio = wav_gen[0][0]  # .cpu().detach().numpy()
+        return audio
+
+    def _make_cfm_row(
+        self,
+        semantic_tokens: torch.Tensor,
+        phones: torch.Tensor,
+        speed: float,
+        sample_steps: int,
+        prompt_cache: dict = None,
+        generator: torch.Generator = None,
+    ) -> CFMRow:
+        """
+        Everything the chunk loop of one sentence needs: the reference tail (fea_ref, mel2),
+        the features to synthesize and the chunk length.
+        """
+        prompt_cache = self.prompt_cache if prompt_cache is None else prompt_cache
+        prompt_semantic_tokens = prompt_cache["prompt_semantic"].unsqueeze(0).unsqueeze(0).to(self.configs.device)
+        prompt_phones = torch.LongTensor(prompt_cache["phones"]).unsqueeze(0).to(self.configs.device)
+        raw_entry = prompt_cache["refer_spec"][0]
         if isinstance(raw_entry, tuple):
             raw_entry = raw_entry[0]
         refer_audio_spec = raw_entry.to(dtype=self.precision, device=self.configs.device)
 
-        fea_ref, ge = self.vits_model.decode_encp(prompt_semantic_tokens, prompt_phones, refer_audio_spec)
-        ref_audio: torch.Tensor = self.prompt_cache["raw_audio"]
-        ref_sr = self.prompt_cache["raw_sr"]
+        fea_ref, ge = self.vits_model.decode_encp(
+            prompt_semantic_tokens, prompt_phones, refer_audio_spec, self._get_ge(prompt_cache)
+        )
+        ref_audio: torch.Tensor = prompt_cache["raw_audio"]
+        ref_sr = prompt_cache["raw_sr"]
         ref_audio = ref_audio.to(self.configs.device).float()
         if ref_audio.shape[0] == 2:
             ref_audio = ref_audio.mean(0).unsqueeze(0)
@@ -1552,32 +2281,18 @@ class TTS:
         mel2 = mel2.to(self.precision)
         fea_todo, ge = self.vits_model.decode_encp(semantic_tokens, phones, refer_audio_spec, ge, speed)
 
-        cfm_resss = []
-        idx = 0
-        while 1:
-            fea_todo_chunk = fea_todo[:, :, idx : idx + chunk_len]
-            if fea_todo_chunk.shape[-1] == 0:
-                break
-            idx += chunk_len
-            fea = torch.cat([fea_ref, fea_todo_chunk], 2).transpose(2, 1)
-
-            cfm_res = self.vits_model.cfm.inference(
-                fea, torch.LongTensor([fea.size(1)]).to(fea.device), mel2, sample_steps, inference_cfg_rate=0
-            )
-            cfm_res = cfm_res[:, :, mel2.shape[2] :]
-
-            mel2 = cfm_res[:, :, -T_min:]
-            fea_ref = fea_todo_chunk[:, :, -T_min:]
-
-            cfm_resss.append(cfm_res)
-        cfm_res = torch.cat(cfm_resss, 2)
-        cfm_res = denorm_spec(cfm_res)
-
-        with torch.inference_mode():
-            wav_gen = self.vocoder(cfm_res)
-            audio = wav_gen[0][0]  # .cpu().detach().numpy()
-
-        return audio
+        return CFMRow(
+            self.vits_model.cfm,
+            fea_ref,
+            fea_todo,
+            mel2,
+            chunk_len,
+            sample_steps=sample_steps,
+            solver=self.configs.cfm_solver,
+            schedule=self.configs.cfm_schedule,
+            model_key=(self.configs.vits_weights_path, str(self.configs.device)),
+            generator=generator,
+        )
 
     def using_vocoder_synthesis_batched_infer(
         self,
@@ -1586,17 +2301,22 @@ class TTS:
         batch_phones: List[torch.Tensor],
         speed: float = 1.0,
         sample_steps: int = 32,
+        prompt_cache: dict = None,
+        generator: torch.Generator = None,
     ) -> List[torch.Tensor]:
-        prompt_semantic_tokens = self.prompt_cache["prompt_semantic"].unsqueeze(0).unsqueeze(0).to(self.configs.device)
-        prompt_phones = torch.LongTensor(self.prompt_cache["phones"]).unsqueeze(0).to(self.configs.device)
-        raw_entry = self.prompt_cache["refer_spec"][0]
+        prompt_cache = self.prompt_cache if prompt_cache is None else prompt_cache
+        prompt_semantic_tokens = prompt_cache["prompt_semantic"].unsqueeze(0).unsqueeze(0).to(self.configs.device)
+        prompt_phones = torch.LongTensor(prompt_cache["phones"]).unsqueeze(0).to(self.configs.device)
+        raw_entry = prompt_cache["refer_spec"][0]
         if isinstance(raw_entry, tuple):
             raw_entry = raw_entry[0]
         refer_audio_spec = raw_entry.to(dtype=self.precision, device=self.configs.device)
 
-        fea_ref, ge = self.vits_model.decode_encp(prompt_semantic_tokens, prompt_phones, refer_audio_spec)
-        ref_audio: torch.Tensor = self.prompt_cache["raw_audio"]
-        ref_sr = self.prompt_cache["raw_sr"]
+        fea_ref, ge = self.vits_model.decode_encp(
+            prompt_semantic_tokens, prompt_phones, refer_audio_spec, self._get_ge(prompt_cache)
+        )
+        ref_audio: torch.Tensor = prompt_cache["raw_audio"]
+        ref_sr = prompt_cache["raw_sr"]
         ref_audio = ref_audio.to(self.configs.device).float()
         if ref_audio.shape[0] == 2:
             ref_audio = ref_audio.mean(0).unsqueeze(0)
@@ -1661,7 +2381,14 @@ class TTS:
         fea_ref = fea_ref.repeat(bs, 1, 1)
         fea = torch.cat([fea_ref, feat_chunks], 2).transpose(2, 1)
         pred_spec = self.vits_model.cfm.inference(
-            fea, torch.LongTensor([fea.size(1)]).to(fea.device), mel2, sample_steps, inference_cfg_rate=0
+            fea,
+            torch.LongTensor([fea.size(1)]).to(fea.device),
+            mel2,
+            sample_steps,
+            inference_cfg_rate=0,
+            solver=self.configs.cfm_solver,
+            schedule=self.configs.cfm_schedule,
+            generator=generator,
         )
         pred_spec = pred_spec[:, :, -chunk_len:]
         dd = pred_spec.shape[1]
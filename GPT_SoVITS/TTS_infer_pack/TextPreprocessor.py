@@ -1,8 +1,7 @@
 import os
 import sys
 import threading
-
-from tqdm import tqdm
+from collections import OrderedDict
 
 now_dir = os.getcwd()
 sys.path.append(now_dir)
@@ -10,8 +9,7 @@ sys.path.append(now_dir)
 import re
 import torch
 from text.LangSegmenter import LangSegmenter
-from text import chinese
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Tuple
 from text.cleaner import clean_text
 from text import cleaned_text_to_sequence
 from transformers import AutoModelForMaskedLM, AutoTokenizer
@@ -49,12 +47,77 @@ def merge_short_text_in_array(texts: str, threshold: int) -> list:
     return result
 
 
+class PhoneBertCache:
+    """
+    LRU cache of front-end results (phones, word2ph, norm_text, phone-level bert feature) per sentence,
+    bounded by the total size of the cached bert tensors.
+    """
+
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def entry_bytes(bert: torch.Tensor) -> int:
+        return bert.numel() * bert.element_size()
+
+    def get(self, key: tuple) -> Optional[tuple]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key: tuple, phones: list, word2ph: Optional[list], norm_text: str, bert: torch.Tensor):
+        nbytes = self.entry_bytes(bert)
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = (phones, word2ph, norm_text, bert)
+            self.current_bytes += nbytes
+            while self.current_bytes > self.max_bytes:
+                _, (_, _, _, _bert) = self._entries.popitem(last=False)
+                self.current_bytes -= self.entry_bytes(_bert)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "bytes": self.current_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
 class TextPreprocessor:
-    def __init__(self, bert_model: AutoModelForMaskedLM, tokenizer: AutoTokenizer, device: torch.device):
+    def __init__(
+        self,
+        bert_model: AutoModelForMaskedLM,
+        tokenizer: AutoTokenizer,
+        device: torch.device,
+        cache_max_bytes: int = 256 * 1024 * 1024,
+        bert_batch_size: int = 16,
+    ):
         self.bert_model = bert_model
         self.tokenizer = tokenizer
         self.device = device
+        self.bert_batch_size = bert_batch_size
         self.bert_lock = threading.RLock()
+        # cache_max_bytes <= 0 时关闭缓存
+        self.feature_cache: PhoneBertCache = PhoneBertCache(cache_max_bytes) if cache_max_bytes > 0 else None
 
     def preprocess(self, text: str, lang: str, text_split_method: str, version: str = "v2") -> List[Dict]:
         print(f"############ {i18n('切分文本')} ############")
@@ -62,8 +125,7 @@ class TextPreprocessor:
         texts = self.pre_seg_text(text, lang, text_split_method)
         result = []
         print(f"############ {i18n('提取文本Bert特征')} ############")
-        for text in tqdm(texts):
-            phones, bert_features, norm_text = self.segment_and_extract_feature_for_text(text, lang, version)
+        for phones, bert_features, norm_text in self.extract_features_batch(texts, lang, version):
             if phones is None or norm_text == "":
                 continue
             res = {
@@ -120,73 +182,191 @@ class TextPreprocessor:
         return self.get_phones_and_bert(text, language, version)
 
     def get_phones_and_bert(self, text: str, language: str, version: str, final: bool = False):
+        text = re.sub(r' {2,}', ' ', text)
+        if self.feature_cache is None:
+            return self._get_phones_and_bert(text, language, version, final)[:3]
+
+        key = (text, language, version, final)
+        entry = self.feature_cache.get(key)
+        if entry is None:
+            phones, bert, norm_text, word2ph = self._get_phones_and_bert(text, language, version, final)
+            self.feature_cache.put(key, phones, word2ph, norm_text, bert)
+            return phones, bert, norm_text
+        phones, word2ph, norm_text, bert = entry
+        return phones, bert, norm_text
+
+    def _get_phones_and_bert(self, text: str, language: str, version: str, final: bool = False):
         with self.bert_lock:
-            text = re.sub(r' {2,}', ' ', text)
-            textlist = []
-            langlist = []
-            if language == "all_zh":
-                for tmp in LangSegmenter.getTexts(text,"zh"):
-                    langlist.append(tmp["lang"])
-                    textlist.append(tmp["text"])
-            elif language == "all_yue":
-                for tmp in LangSegmenter.getTexts(text,"zh"):
-                    if tmp["lang"] == "zh":
-                        tmp["lang"] = "yue"
-                    langlist.append(tmp["lang"])
-                    textlist.append(tmp["text"])
-            elif language == "all_ja":
-                for tmp in LangSegmenter.getTexts(text,"ja"):
-                    langlist.append(tmp["lang"])
-                    textlist.append(tmp["text"])
-            elif language == "all_ko":
-                for tmp in LangSegmenter.getTexts(text,"ko"):
-                    langlist.append(tmp["lang"])
-                    textlist.append(tmp["text"])
-            elif language == "en":
-                langlist.append("en")
-                textlist.append(text)
-            elif language == "auto":
-                for tmp in LangSegmenter.getTexts(text):
-                    langlist.append(tmp["lang"])
-                    textlist.append(tmp["text"])
-            elif language == "auto_yue":
-                for tmp in LangSegmenter.getTexts(text):
-                    if tmp["lang"] == "zh":
-                        tmp["lang"] = "yue"
+            segments = self._clean_sentence(text, language, version, final)
+            bert_list = [
+                self.get_bert_inf(phones, word2ph, norm_text, lang) for phones, word2ph, norm_text, lang in segments
+            ]
+            return self._merge_segments(segments, bert_list)
+
+    def _segment_text(self, text: str, language: str) -> Tuple[List[str], List[str]]:
+        textlist = []
+        langlist = []
+        if language == "all_zh":
+            for tmp in LangSegmenter.getTexts(text,"zh"):
+                langlist.append(tmp["lang"])
+                textlist.append(tmp["text"])
+        elif language == "all_yue":
+            for tmp in LangSegmenter.getTexts(text,"zh"):
+                if tmp["lang"] == "zh":
+                    tmp["lang"] = "yue"
+                langlist.append(tmp["lang"])
+                textlist.append(tmp["text"])
+        elif language == "all_ja":
+            for tmp in LangSegmenter.getTexts(text,"ja"):
+                langlist.append(tmp["lang"])
+                textlist.append(tmp["text"])
+        elif language == "all_ko":
+            for tmp in LangSegmenter.getTexts(text,"ko"):
+                langlist.append(tmp["lang"])
+                textlist.append(tmp["text"])
+        elif language == "en":
+            langlist.append("en")
+            textlist.append(text)
+        elif language == "auto":
+            for tmp in LangSegmenter.getTexts(text):
+                langlist.append(tmp["lang"])
+                textlist.append(tmp["text"])
+        elif language == "auto_yue":
+            for tmp in LangSegmenter.getTexts(text):
+                if tmp["lang"] == "zh":
+                    tmp["lang"] = "yue"
+                langlist.append(tmp["lang"])
+                textlist.append(tmp["text"])
+        else:
+            for tmp in LangSegmenter.getTexts(text):
+                if langlist:
+                    if (tmp["lang"] == "en" and langlist[-1] == "en") or (tmp["lang"] != "en" and langlist[-1] != "en"):
+                        textlist[-1] += tmp["text"]
+                        continue
+                if tmp["lang"] == "en":
                     langlist.append(tmp["lang"])
-                    textlist.append(tmp["text"])
-            else:
-                for tmp in LangSegmenter.getTexts(text):
-                    if langlist:
-                        if (tmp["lang"] == "en" and langlist[-1] == "en") or (tmp["lang"] != "en" and langlist[-1] != "en"):
-                            textlist[-1] += tmp["text"]
-                            continue
-                    if tmp["lang"] == "en":
-                        langlist.append(tmp["lang"])
+                else:
+                    # 因无法区别中日韩文汉字,以用户输入为准
+                    langlist.append(language)
+                textlist.append(tmp["text"])
+        # print(textlist)
+        # print(langlist)
+        return textlist, langlist
+
+    def _clean_sentence(self, text: str, language: str, version: str, final: bool = False) -> List[tuple]:
+        """
+        Front end of one sentence without bert: returns [(phones, word2ph, norm_text, lang), ...] per language segment.
+        """
+        textlist, langlist = self._segment_text(text, language)
+        segments = []
+        for i in range(len(textlist)):
+            lang = langlist[i]
+            phones, word2ph, norm_text = self.clean_text_inf(textlist[i], lang, version)
+            segments.append((phones, word2ph, norm_text, lang))
+
+        if not final and sum(len(segment[0]) for segment in segments) < 6:
+            return self._clean_sentence("." + text, language, version, final=True)
+        return segments
+
+    def _merge_segments(self, segments: List[tuple], bert_list: List[torch.Tensor]):
+        bert = torch.cat(bert_list, dim=1)
+        phones = sum([segment[0] for segment in segments], [])
+        norm_text = "".join([segment[2] for segment in segments])
+        word2ph_list = [segment[1] for segment in segments]
+        word2ph = sum(word2ph_list, []) if None not in word2ph_list else None
+        return phones, bert, norm_text, word2ph
+
+    def extract_features_batch(self, texts: List[str], language: str, version: str) -> List[tuple]:
+        """
+        Same result as calling get_phones_and_bert for every text, but the bert features of all zh segments
+        are extracted with a few padded forwards instead of one forward per segment.
+
+        Returns:
+            [(phones, bert_features, norm_text), ...] in the order of texts.
+        """
+        results = [None] * len(texts)
+        todo = []
+        with self.bert_lock:
+            for idx, text in enumerate(texts):
+                text = re.sub(r" {2,}", " ", text)
+                key = (text, language, version, False)
+                entry = self.feature_cache.get(key) if self.feature_cache is not None else None
+                if entry is not None:
+                    phones, word2ph, norm_text, bert = entry
+                    results[idx] = (phones, bert, norm_text)
+                    continue
+                todo.append((idx, key))
+            self.g2pw_prefetch([key[0] for _, key in todo], language, version)
+            todo = [(idx, key, self._clean_sentence(key[0], language, version)) for idx, key in todo]
+
+            bert_segments = []
+            for _, _, segments in todo:
+                for phones, word2ph, norm_text, lang in segments:
+                    if lang.replace("all_", "") == "zh":
+                        bert_segments.append((norm_text, word2ph))
+            bert_features = self.get_bert_features(bert_segments)
+
+            pos = 0
+            for idx, key, segments in todo:
+                bert_list = []
+                for phones, word2ph, norm_text, lang in segments:
+                    if lang.replace("all_", "") == "zh":
+                        bert_list.append(bert_features[pos])
+                        pos += 1
                     else:
-                        # 因无法区别中日韩文汉字,以用户输入为准
-                        langlist.append(language)
-                    textlist.append(tmp["text"])
-            # print(textlist)
-            # print(langlist)
-            phones_list = []
-            bert_list = []
-            norm_text_list = []
-            for i in range(len(textlist)):
-                lang = langlist[i]
-                phones, word2ph, norm_text = self.clean_text_inf(textlist[i], lang, version)
-                bert = self.get_bert_inf(phones, word2ph, norm_text, lang)
-                phones_list.append(phones)
-                norm_text_list.append(norm_text)
-                bert_list.append(bert)
-            bert = torch.cat(bert_list, dim=1)
-            phones = sum(phones_list, [])
-            norm_text = "".join(norm_text_list)
-
-            if not final and len(phones) < 6:
-                return self.get_phones_and_bert("." + text, language, version, final=True)
+                        bert_list.append(self.get_bert_inf(phones, word2ph, norm_text, lang))
+                phones, bert, norm_text, word2ph = self._merge_segments(segments, bert_list)
+                if self.feature_cache is not None:
+                    self.feature_cache.put(key, phones, word2ph, norm_text, bert)
+                results[idx] = (phones, bert, norm_text)
+        return results
 
-            return phones, bert, norm_text
+    def g2pw_prefetch(self, texts: List[str], language: str, version: str):
+        """
+        Run g2pW once over the zh segments of all texts, so that the per-sentence front end below
+        only hits the polyphone cache instead of making one small onnx call per sentence.
+        """
+        if version == "v1":
+            # v1使用text.chinese, 不经过g2pW
+            return
+        zh_texts = []
+        for text in texts:
+            textlist, langlist = self._segment_text(text, language)
+            zh_texts.extend([t for t, lang in zip(textlist, langlist) if lang.replace("all_", "") == "zh"])
+        if len(zh_texts) > 1:
+            from text import chinese2
+
+            chinese2.g2pw_prefetch(zh_texts)
+
+    def get_bert_features(self, segments: List[Tuple[str, list]]) -> List[torch.Tensor]:
+        """
+        Batched get_bert_feature for [(norm_text, word2ph), ...]. Segments are sorted by length
+        and split into padded batches of at most bert_batch_size.
+        """
+        features = [None] * len(segments)
+        order = sorted(range(len(segments)), key=lambda i: len(segments[i][0]))
+        for start in range(0, len(order), self.bert_batch_size):
+            index = order[start : start + self.bert_batch_size]
+            texts = [segments[i][0] for i in index]
+            word2phs = [segments[i][1] for i in index]
+            for i, feature in zip(index, self.get_bert_feature_batch(texts, word2phs)):
+                features[i] = feature.to(self.device)
+        return features
+
+    def get_bert_feature_batch(self, texts: List[str], word2phs: List[list]) -> List[torch.Tensor]:
+        with torch.no_grad():
+            inputs = self.tokenizer(texts, return_tensors="pt", padding=True)
+            for i in inputs:
+                inputs[i] = inputs[i].to(self.device)
+            res = self.bert_model(**inputs, output_hidden_states=True)
+            res = torch.cat(res["hidden_states"][-3:-2], -1)
+        phone_level_features = []
+        for i, (text, word2ph) in enumerate(zip(texts, word2phs)):
+            assert len(word2ph) == len(text)
+            repeats = torch.tensor(word2ph, device=res.device)
+            phone_level_feature = torch.repeat_interleave(res[i, 1 : 1 + len(word2ph)], repeats, dim=0)
+            phone_level_features.append(phone_level_feature.T)
+        return phone_level_features
 
     def get_bert_feature(self, text: str, word2ph: list) -> torch.Tensor:
         with torch.no_grad():
@@ -196,11 +376,7 @@ class TextPreprocessor:
             res = self.bert_model(**inputs, output_hidden_states=True)
             res = torch.cat(res["hidden_states"][-3:-2], -1)[0].cpu()[1:-1]
         assert len(word2ph) == len(text)
-        phone_level_feature = []
-        for i in range(len(word2ph)):
-            repeat_feature = res[i].repeat(word2ph[i], 1)
-            phone_level_feature.append(repeat_feature)
-        phone_level_feature = torch.cat(phone_level_feature, dim=0)
+        phone_level_feature = torch.repeat_interleave(res, torch.tensor(word2ph), dim=0)
         return phone_level_feature.T
 
     def clean_text_inf(self, text: str, language: str, version: str = "v2"):
@@ -0,0 +1,146 @@
+### cpu_fast设备配置: 纯CPU节点上对T2S、BERT、SoVITS文本编码器的线性层做int8动态量化, 并设置线程数
+### 每个模型量化后用固定的探测输入与fp32输出比较, 相对误差超过容差则该模型保持fp32
+import os
+from typing import Callable
+
+import torch
+from torch import nn
+
+from module.attentions import MultiHeadAttention
+
+
+def configure_threads(num_threads: int = 0) -> int:
+    """
+    num_threads <= 0: one intra-op thread per cpu this process may run on (cgroup cpusets respected).
+    """
+    if num_threads <= 0:
+        if hasattr(os, "sched_getaffinity"):
+            num_threads = len(os.sched_getaffinity(0))
+        else:
+            num_threads = os.cpu_count() or 1
+    torch.set_num_threads(num_threads)
+    try:
+        # 推理是逐请求串行的算子流, inter-op并行收益很小, 只能在任何并行算子执行前设置
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass
+    engines = torch.backends.quantized.supported_engines
+    for engine in ["x86", "fbgemm", "qnnpack"]:
+        if engine in engines:
+            torch.backends.quantized.engine = engine
+            break
+    return num_threads
+
+
+def relative_error(reference: torch.Tensor, output: torch.Tensor) -> float:
+    reference = reference.float()
+    return ((output.float() - reference).norm() / reference.norm().clamp_min(1e-8)).item()
+
+
+def prepack(weight: torch.Tensor, bias: torch.Tensor):
+    ### 权重按输出通道对称量化到int8, 激活在每次矩阵乘时动态量化
+    weight = weight.detach().float()
+    scales = (weight.abs().amax(dim=1) / 127).clamp_min(1e-8).double()
+    zero_points = torch.zeros(weight.shape[0], dtype=torch.long)
+    qweight = torch.quantize_per_channel(weight, scales, zero_points, 0, torch.qint8)
+    return torch.ops.quantized.linear_prepack(qweight, None if bias is None else bias.detach().float())
+
+
+def check_parity(name: str, probe: Callable[[], torch.Tensor], quantize: Callable, revert: Callable, tolerance: float):
+    with torch.no_grad():
+        reference = probe()
+        quantize()
+        error = relative_error(reference, probe())
+    if error > tolerance:
+        revert()
+        print(f"cpu_fast: {name} int8 relative error {error:.4f} > {tolerance}, keeping fp32")
+        return False
+    print(f"cpu_fast: {name} quantized to int8, relative error {error:.4f}")
+    return True
+
+
+def quantize_t2s(model, tolerance: float) -> bool:
+    """model: Text2SemanticDecoder. Quantizes the qkv/out/mlp linears of every T2SBlock in place."""
+    blocks = model.t2s_transformer.blocks
+    generator = torch.Generator().manual_seed(0)
+    x = torch.randn((1, 64, model.model_dim), generator=generator)
+    attn_mask = torch.zeros((1, 1, 64, 64), dtype=torch.bool)
+
+    def probe():
+        return model.t2s_transformer.process_prompt(x, attn_mask)[0]
+
+    def quantize():
+        for block in blocks:
+            block.qkv_int8 = prepack(block.qkv_w, block.qkv_b)
+            block.out_int8 = prepack(block.out_w, block.out_b)
+            block.mlp.w1_int8 = prepack(block.mlp.w1, block.mlp.b1)
+            block.mlp.w2_int8 = prepack(block.mlp.w2, block.mlp.b2)
+
+    def revert():
+        for block in blocks:
+            del block.qkv_int8, block.out_int8, block.mlp.w1_int8, block.mlp.w2_int8
+
+    return check_parity("T2S", probe, quantize, revert, tolerance)
+
+
+def quantize_bert(bert_model: nn.Module, tokenizer, tolerance: float) -> nn.Module:
+    """Returns the quantized copy of the BERT model, or the model itself if the parity check fails."""
+    inputs = tokenizer("这是一个用于检查量化精度的句子, 包含数字123和English.", return_tensors="pt")
+    quantized = {}
+
+    def probe():
+        model = quantized.get("model", bert_model)
+        return model(**inputs, output_hidden_states=True)["hidden_states"][-3]
+
+    def quantize():
+        quantized["model"] = torch.ao.quantization.quantize_dynamic(bert_model, {nn.Linear}, dtype=torch.qint8)
+
+    def revert():
+        quantized.clear()
+
+    check_parity("BERT", probe, quantize, revert, tolerance)
+    return quantized.get("model", bert_model)
+
+
+class Conv1x1Int8(nn.Module):
+    """kernel_size=1的Conv1d等价于按通道的线性层, 以int8动态量化的线性层替代"""
+
+    def __init__(self, conv: nn.Conv1d):
+        super().__init__()
+        self.packed = prepack(conv.weight.squeeze(-1), conv.bias)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        x = torch.ops.quantized.linear_dynamic(x.transpose(1, 2).contiguous(), self.packed, True)
+        return x.transpose(1, 2)
+
+
+def quantize_text_encoder(vits_model: nn.Module, tolerance: float) -> bool:
+    """
+    Replaces the q/k/v/o 1x1 convolutions of every attention layer in the SoVITS text encoder (enc_p):
+    encoder_ssl, encoder_text, encoder2 and the MRTE cross attention.
+    The FFN convolutions have kernel_size 3 and stay fp32.
+    """
+    enc_p = vits_model.enc_p
+    attentions = [m for m in enc_p.modules() if isinstance(m, MultiHeadAttention)]
+    names = ["conv_q", "conv_k", "conv_v", "conv_o"]
+    originals = [{name: getattr(m, name) for name in names} for m in attentions]
+    ### 探测输入走完整的enc_p(ssl + 文本 + ge), 每个被量化的注意力层都参与比较
+    generator = torch.Generator().manual_seed(0)
+    ssl = torch.randn((1, enc_p.ssl_proj.in_channels, 64), generator=generator)
+    text = torch.randint(0, enc_p.text_embedding.num_embeddings, (1, 32), generator=generator)
+    ge = torch.randn((1, enc_p.mrte.cross_attention.channels, 1), generator=generator) * 0.1
+
+    def probe():
+        return enc_p(ssl, torch.LongTensor([64]), text, torch.LongTensor([32]), ge)[0]
+
+    def quantize():
+        for m, convs in zip(attentions, originals):
+            for name, conv in convs.items():
+                setattr(m, name, Conv1x1Int8(conv))
+
+    def revert():
+        for m, convs in zip(attentions, originals):
+            for name, conv in convs.items():
+                setattr(m, name, conv)
+
+    return check_parity("SoVITS text encoder", probe, quantize, revert, tolerance)
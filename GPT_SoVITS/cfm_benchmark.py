@@ -0,0 +1,145 @@
+"""
+v3/v4 CFM采样器的速度/质量对比
+
+同一段语义token在相同初始噪声下, 用不同的solver/schedule/步数合成音频,
+以"euler + uniform + 32步"的输出为基准, 报告mel L1距离(质量代理指标)、耗时与RTF, 供各部署自行选择延迟与质量的平衡点.
+
+` python GPT_SoVITS/cfm_benchmark.py -c GPT_SoVITS/configs/tts_infer.yaml --ref_audio ref.wav --prompt_text "..." --prompt_lang zh --text "..." --text_lang zh `
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+now_dir = os.getcwd()
+sys.path.append(now_dir)
+sys.path.append("%s/GPT_SoVITS" % (now_dir))
+
+import torch
+
+from GPT_SoVITS.TTS_infer_pack.TTS import TTS, TTS_Config, mel_fn, mel_fn_v4
+from module.models import CFM_SOLVERS
+
+parser = argparse.ArgumentParser(description="CFM solver benchmark for SoVITS v3/v4")
+parser.add_argument("-c", "--tts_config", type=str, default="GPT_SoVITS/configs/tts_infer.yaml", help="tts_infer路径")
+parser.add_argument("--ref_audio", type=str, required=True, help="参考音频")
+parser.add_argument("--prompt_text", type=str, required=True, help="参考文本")
+parser.add_argument("--prompt_lang", type=str, default="zh")
+parser.add_argument("--text", type=str, required=True, help="合成文本(整段作为一句)")
+parser.add_argument("--text_lang", type=str, default="zh")
+parser.add_argument("--solvers", type=str, default="euler,midpoint,heun,rk4")
+parser.add_argument("--schedules", type=str, default="uniform,sway")
+parser.add_argument("--steps", type=str, default="4,8,12,16,32", help="每个solver尝试的步数")
+parser.add_argument("--repeat", type=int, default=3, help="每个配置重复次数, 取耗时中位数")
+parser.add_argument("--seed", type=int, default=1234)
+parser.add_argument("--output", type=str, default="", help="结果另存为json")
+args = parser.parse_args()
+
+
+def synchronize(device):
+    if "cuda" in str(device):
+        torch.cuda.synchronize()
+    elif "musa" in str(device):
+        torch.musa.synchronize()
+
+
+def prepare(tts: TTS):
+    """参考音频/文本特征 + T2S, 返回(语义token, 目标文本phones)"""
+    tts.set_ref_audio(args.ref_audio)
+    phones1, bert1, _ = tts._get_prompt_text_features(args.prompt_text, args.prompt_lang)
+    tts.prompt_cache["prompt_text"] = args.prompt_text
+    tts.prompt_cache["prompt_lang"] = args.prompt_lang
+    tts.prompt_cache["phones"] = phones1
+    tts.prompt_cache["bert_features"] = bert1
+
+    phones2, bert2, _ = tts.text_preprocessor.segment_and_extract_feature_for_text(
+        args.text, args.text_lang, tts.configs.version
+    )
+    device = tts.configs.device
+    all_phones = torch.LongTensor(phones1 + phones2).to(device).unsqueeze(0)
+    bert = torch.cat([bert1, bert2], 1).to(device=device, dtype=tts.precision).unsqueeze(0)
+    prompt = tts.prompt_cache["prompt_semantic"].unsqueeze(0).to(device)
+    torch.manual_seed(args.seed)
+    with torch.no_grad():
+        pred_semantic, idx = tts.t2s_model.model.infer_panel_naive(
+            all_phones,
+            torch.LongTensor([all_phones.shape[-1]]).to(device),
+            prompt,
+            bert,
+            top_k=5,
+            top_p=1,
+            temperature=1,
+            early_stop_num=tts.configs.hz * tts.configs.max_sec,
+        )
+    semantic = pred_semantic[:, -idx:].unsqueeze(0)
+    return semantic, torch.LongTensor(phones2).to(device).unsqueeze(0)
+
+
+def synthesize(tts: TTS, semantic, phones, solver, schedule, steps):
+    tts.configs.cfm_solver = solver
+    tts.configs.cfm_schedule = schedule
+    times = []
+    for _ in range(args.repeat):
+        torch.manual_seed(args.seed)  # 各配置从同一初始噪声出发
+        synchronize(tts.configs.device)
+        t0 = time.perf_counter()
+        audio = tts.using_vocoder_synthesis(semantic, phones, sample_steps=steps, prompt_cache=tts.prompt_cache)
+        synchronize(tts.configs.device)
+        times.append(time.perf_counter() - t0)
+    times.sort()
+    return audio.float(), times[len(times) // 2]
+
+
+def main():
+    tts = TTS(TTS_Config(args.tts_config))
+    if not tts.configs.use_vocoder:
+        raise ValueError("CFM only exists in SoVITS v3/v4, current version: %s" % tts.configs.version)
+    sr = tts.vocoder_configs["sr"]
+    mel = mel_fn if tts.configs.version == "v3" else mel_fn_v4
+
+    semantic, phones = prepare(tts)
+    synthesize(tts, semantic, phones, "euler", "uniform", 4)  # warm up
+    ref_audio, ref_time = synthesize(tts, semantic, phones, "euler", "uniform", 32)
+    ref_mel = mel(ref_audio.view(1, -1))
+    audio_seconds = ref_audio.shape[-1] / sr
+
+    results = []
+    for solver in args.solvers.split(","):
+        assert solver in CFM_SOLVERS, solver
+        for schedule in args.schedules.split(","):
+            for steps in [int(n) for n in args.steps.split(",")]:
+                audio, elapsed = synthesize(tts, semantic, phones, solver, schedule, steps)
+                _mel = mel(audio.view(1, -1))
+                T = min(_mel.shape[-1], ref_mel.shape[-1])
+                results.append(
+                    {
+                        "solver": solver,
+                        "schedule": schedule,
+                        "steps": steps,
+                        "nfe": steps * CFM_SOLVERS[solver],
+                        "mel_l1": (_mel[..., :T] - ref_mel[..., :T]).abs().mean().item(),
+                        "seconds": elapsed,
+                        "rtf": elapsed / audio_seconds,
+                    }
+                )
+                print(
+                    "%-9s %-8s steps=%-3d nfe=%-3d mel_l1=%.4f time=%.3fs rtf=%.3f"
+                    % tuple(results[-1][k] for k in ["solver", "schedule", "steps", "nfe", "mel_l1", "seconds", "rtf"])
+                )
+
+    print("reference: euler uniform 32 steps, %.3fs for %.2fs of audio" % (ref_time, audio_seconds))
+    print("-" * 80)
+    for r in sorted(results, key=lambda r: r["seconds"]):
+        print(
+            "%-9s %-8s steps=%-3d mel_l1=%.4f time=%.3fs"
+            % (r["solver"], r["schedule"], r["steps"], r["mel_l1"], r["seconds"])
+        )
+    if args.output:
+        with open(args.output, "w", encoding="utf8") as f:
+            json.dump({"reference_seconds": ref_time, "audio_seconds": audio_seconds, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
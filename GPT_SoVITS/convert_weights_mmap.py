@@ -0,0 +1,97 @@
+"""
+GPT(.ckpt)/SoVITS(.pth)权重转换为内存映射格式(.safetensors)
+
+转换后的文件与原文件放在同一目录(或--output_dir), 可直接填入t2s_weights_path/vits_weights_path或在WebUI中选择.
+config/版本/lora_rank保存在文件头的JSON metadata中, 加载时不经过pickle, 张量直接映射进模型参数.
+
+` python GPT_SoVITS/convert_weights_mmap.py GPT_weights_v2Pro/xxx-e15.ckpt SoVITS_weights_v2Pro/xxx_e8_s160.pth `
+"""
+
+import argparse
+import os
+import sys
+import time
+
+now_dir = os.getcwd()
+sys.path.append(now_dir)
+sys.path.append("%s/GPT_SoVITS" % (now_dir))
+
+import torch
+
+from process_ckpt import (
+    MMAP_SUFFIX,
+    get_sovits_version_from_path_fast,
+    load_gpt_weights,
+    load_mmap_checkpoint,
+    load_sovits_new,
+    save_mmap_checkpoint,
+)
+
+dtypes = {"keep": None, "float16": torch.float16, "float32": torch.float32}
+
+parser = argparse.ArgumentParser(description="Convert GPT/SoVITS weights to the memory-mapped format")
+parser.add_argument("inputs", type=str, nargs="+", help="GPT .ckpt / SoVITS .pth 文件")
+parser.add_argument("--kind", type=str, default="auto", choices=["auto", "gpt", "sovits"], help="auto: 按扩展名判断")
+parser.add_argument("--output_dir", type=str, default="", help="默认与输入文件同目录")
+parser.add_argument(
+    "--dtype", type=str, default="keep", choices=list(dtypes.keys()), help="与推理精度一致时加载无需任何转换拷贝"
+)
+args = parser.parse_args()
+
+
+def get_kind(path: str) -> str:
+    if args.kind != "auto":
+        return args.kind
+    return "gpt" if path.endswith(".ckpt") else "sovits"
+
+
+def convert(path: str) -> str:
+    if get_kind(path) == "gpt":
+        ckpt = load_gpt_weights(path)
+        meta = {"kind": "gpt"}
+    else:
+        version, model_version, if_lora_v3 = get_sovits_version_from_path_fast(path)
+        ckpt = load_sovits_new(path)
+        meta = {"kind": "sovits", "version": version, "model_version": model_version, "if_lora_v3": if_lora_v3}
+
+    output_dir = args.output_dir or os.path.dirname(path)
+    output = os.path.join(output_dir, os.path.splitext(os.path.basename(path))[0] + MMAP_SUFFIX)
+    save_mmap_checkpoint(ckpt, output, meta, dtype=dtypes[args.dtype])
+    return output
+
+
+def check(path: str, output: str):
+    ### 重新读取, 确认所有张量逐元素一致
+    source = load_gpt_weights(path) if get_kind(path) == "gpt" else load_sovits_new(path)
+    converted = load_mmap_checkpoint(output)
+    assert source["weight"].keys() == converted["weight"].keys(), "weight keys differ"
+    for key, value in source["weight"].items():
+        other = converted["weight"][key]
+        assert value.shape == other.shape, key
+        ### 与save_mmap_checkpoint相同, 只转换浮点张量
+        if dtypes[args.dtype] is not None and value.is_floating_point():
+            value = value.to(dtypes[args.dtype])
+        assert torch.equal(value, other), key
+
+
+def main():
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+    for path in args.inputs:
+        t0 = time.perf_counter()
+        output = convert(path)
+        check(path, output)
+        print(
+            "%s -> %s (%.1fMB -> %.1fMB, %.2fs)"
+            % (
+                path,
+                output,
+                os.path.getsize(path) / 1024 / 1024,
+                os.path.getsize(output) / 1024 / 1024,
+                time.perf_counter() - t0,
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
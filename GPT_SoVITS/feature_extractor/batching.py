@@ -0,0 +1,64 @@
+### 数据集预处理用的批量特征提取: 按时长分桶, 桶内padding, 写出前按真实长度裁剪
+from typing import List
+
+import torch
+import torch.nn.functional as F
+
+
+def make_buckets(lengths: List[int], max_batch_length: int, max_batch_size: int = 64, max_pad_ratio: float = 0.1):
+    """
+    把下标按长度从长到短分桶, 保证:
+    1) 桶内 最长长度*条数 <= max_batch_length (显存上限);
+    2) 条数 <= max_batch_size;
+    3) 每条的padding不超过最长长度的max_pad_ratio.
+    超过max_batch_length的单条也会单独成桶.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+    buckets = []
+    bucket = []
+    for i in order:
+        if len(bucket) > 0:
+            max_len = lengths[bucket[0]]
+            if (
+                (len(bucket) + 1) * max_len > max_batch_length
+                or len(bucket) >= max_batch_size
+                or max_len - lengths[i] > max_len * max_pad_ratio
+            ):
+                buckets.append(bucket)
+                bucket = []
+        bucket.append(i)
+    if len(bucket) > 0:
+        buckets.append(bucket)
+    return buckets
+
+
+def pad_stack(tensors: List[torch.Tensor]) -> torch.Tensor:
+    """(..., T_i) -> (B, ..., max(T_i)), 末尾补0"""
+    max_len = max(t.shape[-1] for t in tensors)
+    return torch.stack([F.pad(t, (0, max_len - t.shape[-1])) for t in tensors])
+
+
+@torch.no_grad()
+def get_content_batched(hmodel, wavs16k: List[torch.Tensor]) -> List[torch.Tensor]:
+    """
+    CNHubert的批量版本, wavs16k为若干条(T_i,)的16k音频(已在目标device/dtype上),
+    返回每条(1, 768, frames_i)的ssl, frames_i与单条推理一致.
+    注意hubert-base的第一层卷积后是GroupNorm, padding会轻微改变统计量, 所以分桶时要限制padding比例.
+    """
+    lengths = torch.LongTensor([wav.shape[-1] for wav in wavs16k])
+    feats = hmodel.model(pad_stack(wavs16k))["last_hidden_state"].transpose(1, 2)
+    frames = hmodel.model._get_feat_extract_output_lengths(lengths).tolist()
+    return [feats[i : i + 1, :, : frames[i]] for i in range(len(wavs16k))]
+
+
+@torch.no_grad()
+def extract_latent_batched(vq_model, ssl_list: List[torch.Tensor]) -> List[torch.Tensor]:
+    """
+    vq_model.extract_latent的批量版本, ssl_list为若干条(1, 768, T_i),
+    返回每条(T_i')的语义token. ssl_proj的卷积窗口互不重叠且量化逐帧进行, 结果与逐条推理完全一致.
+    """
+    lengths = [ssl.shape[-1] for ssl in ssl_list]
+    codes = vq_model.extract_latent(pad_stack([ssl[0] for ssl in ssl_list]))  # (B, n_q, T')
+    kernel_size = vq_model.ssl_proj.kernel_size[0]
+    stride = vq_model.ssl_proj.stride[0]
+    return [codes[i, 0, : (length - kernel_size) // stride + 1] for i, length in enumerate(lengths)]
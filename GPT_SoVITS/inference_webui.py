@@ -249,15 +249,19 @@ if torch_musa.is_available():
 
 ###todo:put them to process_ckpt and modify my_save func (save sovits weights), gpt save weights use my_save in process_ckpt
 # symbol_version-model_version-if_lora_v3
-from process_ckpt import get_sovits_version_from_path_fast, load_sovits_new
+from process_ckpt import get_sovits_version_from_path_fast, load_gpt_weights, load_sovits_new
 
 v3v4set = {"v3", "v4"}
 
 
+ge_cache = {}  # 只保留当前参考音频组的ge, 见get_ge
+
+
 def change_sovits_weights(sovits_path, prompt_language=None, text_language=None):
     if "！" in sovits_path or "!" in sovits_path:
         sovits_path = name2sovits_path[sovits_path]
     global vq_model, hps, version, model_version, dict_language, if_lora_v3
+    ge_cache.clear()
     version, model_version, if_lora_v3 = get_sovits_version_from_path_fast(sovits_path)
     print(sovits_path, version, model_version, if_lora_v3)
     is_exist = is_exist_s2gv3 if model_version == "v3" else is_exist_s2gv4
@@ -408,7 +412,7 @@ def change_gpt_weights(gpt_path):
         gpt_path = name2gpt_path[gpt_path]
     global hz, max_sec, t2s_model, config
     hz = 50
-    dict_s1 = torch.load(gpt_path, map_location="cpu", weights_only=False)
+    dict_s1 = load_gpt_weights(gpt_path)
     config = dict_s1["config"]
     max_sec = config["data"]["max_sec"]
     t2s_model = Text2SemanticLightningModule(config, "****", is_train=False)
@@ -588,6 +592,43 @@ def get_spepc(hps, filename, dtype, device, is_v2pro=False):
     return spec, audio
 
 
+def get_ge(ref_wav_path, inp_refs, is_v2pro):
+    """
+    说话人全局条件ge只取决于参考音频组和SoVITS模型, 同一组参考只算一次(含sv embedding), 各句及后续请求直接复用
+    """
+    paths = [path.name for path in inp_refs] if inp_refs else []
+    key = (
+        id(vq_model),
+        str(dtype),
+        tuple((path, os.path.getmtime(path)) for path in [ref_wav_path] + paths if os.path.exists(path)),
+    )
+    if ge_cache.get("key") == key:
+        return ge_cache["ge"]
+
+    refers = []
+    sv_emb = [] if is_v2pro else None
+    if is_v2pro and sv_cn_model == None:
+        init_sv_cn()
+    for path in paths:
+        try:  #####这里加上提取sv的逻辑，要么一堆sv一堆refer，要么单个sv单个refer
+            refer, audio_tensor = get_spepc(hps, path, dtype, device, is_v2pro)
+            refers.append(refer)
+            if is_v2pro:
+                sv_emb.append(sv_cn_model.compute_embedding3(audio_tensor))
+        except:
+            traceback.print_exc()
+    if len(refers) == 0:
+        refer, audio_tensor = get_spepc(hps, ref_wav_path, dtype, device, is_v2pro)
+        refers = [refer]
+        if is_v2pro:
+            sv_emb = [sv_cn_model.compute_embedding3(audio_tensor)]
+    with torch.no_grad():
+        ge = vq_model.get_ge(refers, sv_emb)
+    ge_cache.clear()
+    ge_cache.update({"key": key, "ge": ge})
+    return ge
+
+
 def clean_text_inf(text, language, version):
     language = language.replace("all_", "")
     phones, word2ph, norm_text = clean_text(text, language, version)
@@ -938,33 +979,10 @@ def get_tts_wav(
         # print(23333,is_v2pro,model_version)
         ###v3不存在以下逻辑和inp_refs
         if model_version not in v3v4set:
-            refers = []
-            if is_v2pro:
-                sv_emb = []
-                if sv_cn_model == None:
-                    init_sv_cn()
-            if inp_refs:
-                for path in inp_refs:
-                    try:  #####这里加上提取sv的逻辑，要么一堆sv一堆refer，要么单个sv单个refer
-                        refer, audio_tensor = get_spepc(hps, path.name, dtype, device, is_v2pro)
-                        refers.append(refer)
-                        if is_v2pro:
-                            sv_emb.append(sv_cn_model.compute_embedding3(audio_tensor))
-                    except:
-                        traceback.print_exc()
-            if len(refers) == 0:
-                refers, audio_tensor = get_spepc(hps, ref_wav_path, dtype, device, is_v2pro)
-                refers = [refers]
-                if is_v2pro:
-                    sv_emb = [sv_cn_model.compute_embedding3(audio_tensor)]
-            if is_v2pro:
-                audio = vq_model.decode(
-                    pred_semantic, torch.LongTensor(phones2).to(device).unsqueeze(0), refers, speed=speed, sv_emb=sv_emb
-                )[0][0]
-            else:
-                audio = vq_model.decode(
-                    pred_semantic, torch.LongTensor(phones2).to(device).unsqueeze(0), refers, speed=speed
-                )[0][0]
+            ge = get_ge(ref_wav_path, inp_refs, is_v2pro)
+            audio = vq_model.decode(
+                pred_semantic, torch.LongTensor(phones2).to(device).unsqueeze(0), None, speed=speed, ge=ge
+            )[0][0]
         else:
             refer, audio_tensor = get_spepc(hps, ref_wav_path, dtype, device)
             phoneme_ids0 = torch.LongTensor(phones1).to(device).unsqueeze(0)
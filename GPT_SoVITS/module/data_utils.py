@@ -9,10 +9,46 @@ from module.mel_processing import spectrogram_torch, spec_to_mel_torch
 from text import cleaned_text_to_sequence
 import torch.nn.functional as F
 from tools.my_utils import load_audio
+from module.packed_shards import PackedShards
 
 version = os.environ.get("version", None)
 
 
+def load_wav(packed, filename, sampling_rate):
+    """
+    -1~1的float音频; 有打包的shard时直接从mmap读取int16, 否则走ffmpeg
+    """
+    if packed is not None:
+        wav = packed.get(os.path.basename(filename), "wav_%s" % sampling_rate)
+        if wav is not None:
+            return wav.float() / 32768
+    return torch.FloatTensor(load_audio(filename, sampling_rate))
+
+
+def load_feature(packed, field, dir, name):
+    if packed is not None:
+        value = packed.get(name, field)
+        if value is not None:
+            return value
+    return torch.load("%s/%s.pt" % (dir, name), map_location="cpu")
+
+
+def load_spec(packed, filename, audio_norm, filter_length, sampling_rate, hop_length, win_length):
+    params = [filter_length, sampling_rate, hop_length, win_length]
+    if packed is not None and packed.meta.get("spec") == params:
+        spec = packed.get(os.path.basename(filename), "spec")
+        if spec is not None:
+            return spec.float()
+    spec = spectrogram_torch(audio_norm, filter_length, sampling_rate, hop_length, win_length, center=False)
+    return torch.squeeze(spec, 0)
+
+
+def wav_nbytes(packed, path5, name, sampling_rate):
+    if packed is not None:
+        return packed.shape(name, "wav_%s" % sampling_rate)[-1] * 2
+    return os.path.getsize("%s/%s" % (path5, name))
+
+
 # ZeroDivisionError fixed by Tybost (https://github.com/RVC-Boss/GPT-SoVITS/issues/79)
 class TextAudioSpeakerLoader(torch.utils.data.Dataset):
     """
@@ -26,17 +62,27 @@ class TextAudioSpeakerLoader(torch.utils.data.Dataset):
         self.path2 = "%s/2-name2text.txt" % exp_dir
         self.path4 = "%s/4-cnhubert" % exp_dir
         self.path5 = "%s/5-wav32k" % exp_dir
+        self.packed = PackedShards.open(exp_dir)
         assert os.path.exists(self.path2)
-        assert os.path.exists(self.path4)
-        assert os.path.exists(self.path5)
+        if self.packed is None:
+            assert os.path.exists(self.path4)
+            assert os.path.exists(self.path5)
         self.is_v2Pro = version in {"v2Pro", "v2ProPlus"}
         if self.is_v2Pro:
             self.path7 = "%s/7-sv_cn" % exp_dir
-            assert os.path.exists(self.path7)
-        names4 = set([name[:-3] for name in list(os.listdir(self.path4))])  # 去除.pt后缀
-        names5 = set(os.listdir(self.path5))
+            if self.packed is None:
+                assert os.path.exists(self.path7)
+        if self.packed is not None:
+            names4 = self.packed.names("ssl")
+            names5 = self.packed.names("wav_%s" % hparams.sampling_rate)
+        else:
+            names4 = set([name[:-3] for name in list(os.listdir(self.path4))])  # 去除.pt后缀
+            names5 = set(os.listdir(self.path5))
         if self.is_v2Pro:
-            names6 = set([name[:-3] for name in list(os.listdir(self.path7))])  # 去除.pt后缀
+            if self.packed is not None:
+                names6 = self.packed.names("sv_emb")
+            else:
+                names6 = set([name[:-3] for name in list(os.listdir(self.path7))])  # 去除.pt后缀
         self.phoneme_data = {}
         with open(self.path2, "r", encoding="utf8") as f:
             lines = f.read().strip("\n").split("\n")
@@ -85,7 +131,7 @@ class TextAudioSpeakerLoader(torch.utils.data.Dataset):
                 skipped_phone += 1
                 continue
 
-            size = os.path.getsize("%s/%s" % (self.path5, audiopath))
+            size = wav_nbytes(self.packed, self.path5, audiopath, self.sampling_rate)
             duration = size / self.sampling_rate / 2
 
             if duration == 0:
@@ -112,13 +158,13 @@ class TextAudioSpeakerLoader(torch.utils.data.Dataset):
         try:
             spec, wav = self.get_audio("%s/%s" % (self.path5, audiopath))
             with torch.no_grad():
-                ssl = torch.load("%s/%s.pt" % (self.path4, audiopath), map_location="cpu")
+                ssl = load_feature(self.packed, "ssl", self.path4, audiopath)
                 if ssl.shape[-1] != spec.shape[-1]:
                     typee = ssl.dtype
                     ssl = F.pad(ssl.float(), (0, 1), mode="replicate").to(typee)
                 ssl.requires_grad = False
                 if self.is_v2Pro:
-                    sv_emb = torch.load("%s/%s.pt" % (self.path7, audiopath), map_location="cpu")
+                    sv_emb = load_feature(self.packed, "sv_emb", self.path7, audiopath)
         except:
             traceback.print_exc()
             spec = torch.zeros(1025, 100)
@@ -134,14 +180,12 @@ class TextAudioSpeakerLoader(torch.utils.data.Dataset):
             return (ssl, spec, wav, text)
 
     def get_audio(self, filename):
-        audio_array = load_audio(filename, self.sampling_rate)  # load_audio的方法是已经归一化到-1~1之间的，不用再/32768
-        audio = torch.FloatTensor(audio_array)  # /32768
+        audio = load_wav(self.packed, filename, self.sampling_rate)  # 已经归一化到-1~1之间的，不用再/32768
         audio_norm = audio
         audio_norm = audio_norm.unsqueeze(0)
-        spec = spectrogram_torch(
-            audio_norm, self.filter_length, self.sampling_rate, self.hop_length, self.win_length, center=False
+        spec = load_spec(
+            self.packed, filename, audio_norm, self.filter_length, self.sampling_rate, self.hop_length, self.win_length
         )
-        spec = torch.squeeze(spec, 0)
         return spec, audio_norm
 
     def get_sid(self, sid):
@@ -288,11 +332,17 @@ class TextAudioSpeakerLoaderV3(torch.utils.data.Dataset):
         self.path2 = "%s/2-name2text.txt" % exp_dir
         self.path4 = "%s/4-cnhubert" % exp_dir
         self.path5 = "%s/5-wav32k" % exp_dir
+        self.packed = PackedShards.open(exp_dir)
         assert os.path.exists(self.path2)
-        assert os.path.exists(self.path4)
-        assert os.path.exists(self.path5)
-        names4 = set([name[:-3] for name in list(os.listdir(self.path4))])  # 去除.pt后缀
-        names5 = set(os.listdir(self.path5))
+        if self.packed is None:
+            assert os.path.exists(self.path4)
+            assert os.path.exists(self.path5)
+        if self.packed is not None:
+            names4 = self.packed.names("ssl")
+            names5 = self.packed.names("wav_%s" % hparams.sampling_rate)
+        else:
+            names4 = set([name[:-3] for name in list(os.listdir(self.path4))])  # 去除.pt后缀
+            names5 = set(os.listdir(self.path5))
         self.phoneme_data = {}
         with open(self.path2, "r", encoding="utf8") as f:
             lines = f.read().strip("\n").split("\n")
@@ -339,7 +389,7 @@ class TextAudioSpeakerLoaderV3(torch.utils.data.Dataset):
                 skipped_phone += 1
                 continue
 
-            size = os.path.getsize("%s/%s" % (self.path5, audiopath))
+            size = wav_nbytes(self.packed, self.path5, audiopath, self.sampling_rate)
             duration = size / self.sampling_rate / 2
 
             if duration == 0:
@@ -378,7 +428,7 @@ class TextAudioSpeakerLoaderV3(torch.utils.data.Dataset):
         try:
             spec, mel = self.get_audio("%s/%s" % (self.path5, audiopath))
             with torch.no_grad():
-                ssl = torch.load("%s/%s.pt" % (self.path4, audiopath), map_location="cpu")
+                ssl = load_feature(self.packed, "ssl", self.path4, audiopath)
                 if ssl.shape[-1] != spec.shape[-1]:
                     typee = ssl.dtype
                     ssl = F.pad(ssl.float(), (0, 1), mode="replicate").to(typee)
@@ -394,21 +444,16 @@ class TextAudioSpeakerLoaderV3(torch.utils.data.Dataset):
         return (ssl, spec, mel, text)
 
     def get_audio(self, filename):
-        audio_array = load_audio(filename, self.sampling_rate)  # load_audio的方法是已经归一化到-1~1之间的，不用再/32768
-        audio = torch.FloatTensor(audio_array)  # /32768
+        audio = load_wav(self.packed, filename, self.sampling_rate)  # 已经归一化到-1~1之间的，不用再/32768
         audio_norm = audio
         audio_norm = audio_norm.unsqueeze(0)
-        audio_array24 = load_audio(
-            filename, 24000
-        )  # load_audio的方法是已经归一化到-1~1之间的，不用再/32768######这里可以用GPU重采样加速
-        audio24 = torch.FloatTensor(audio_array24)  # /32768
+        audio24 = load_wav(self.packed, filename, 24000)  # 已经归一化到-1~1之间的，不用再/32768######这里可以用GPU重采样加速
         audio_norm24 = audio24
         audio_norm24 = audio_norm24.unsqueeze(0)
 
-        spec = spectrogram_torch(
-            audio_norm, self.filter_length, self.sampling_rate, self.hop_length, self.win_length, center=False
+        spec = load_spec(
+            self.packed, filename, audio_norm, self.filter_length, self.sampling_rate, self.hop_length, self.win_length
         )
-        spec = torch.squeeze(spec, 0)
 
         spec1 = spectrogram_torch(
             audio_norm24,
@@ -526,11 +571,17 @@ class TextAudioSpeakerLoaderV4(torch.utils.data.Dataset):
         self.path2 = "%s/2-name2text.txt" % exp_dir
         self.path4 = "%s/4-cnhubert" % exp_dir
         self.path5 = "%s/5-wav32k" % exp_dir
+        self.packed = PackedShards.open(exp_dir)
         assert os.path.exists(self.path2)
-        assert os.path.exists(self.path4)
-        assert os.path.exists(self.path5)
-        names4 = set([name[:-3] for name in list(os.listdir(self.path4))])  # 去除.pt后缀
-        names5 = set(os.listdir(self.path5))
+        if self.packed is None:
+            assert os.path.exists(self.path4)
+            assert os.path.exists(self.path5)
+        if self.packed is not None:
+            names4 = self.packed.names("ssl")
+            names5 = self.packed.names("wav_%s" % hparams.sampling_rate)
+        else:
+            names4 = set([name[:-3] for name in list(os.listdir(self.path4))])  # 去除.pt后缀
+            names5 = set(os.listdir(self.path5))
         self.phoneme_data = {}
         with open(self.path2, "r", encoding="utf8") as f:
             lines = f.read().strip("\n").split("\n")
@@ -577,7 +628,7 @@ class TextAudioSpeakerLoaderV4(torch.utils.data.Dataset):
                 skipped_phone += 1
                 continue
 
-            size = os.path.getsize("%s/%s" % (self.path5, audiopath))
+            size = wav_nbytes(self.packed, self.path5, audiopath, self.sampling_rate)
             duration = size / self.sampling_rate / 2
 
             if duration == 0:
@@ -616,7 +667,7 @@ class TextAudioSpeakerLoaderV4(torch.utils.data.Dataset):
         try:
             spec, mel = self.get_audio("%s/%s" % (self.path5, audiopath))
             with torch.no_grad():
-                ssl = torch.load("%s/%s.pt" % (self.path4, audiopath), map_location="cpu")
+                ssl = load_feature(self.packed, "ssl", self.path4, audiopath)
                 if ssl.shape[-1] != spec.shape[-1]:
                     typee = ssl.dtype
                     ssl = F.pad(ssl.float(), (0, 1), mode="replicate").to(typee)
@@ -632,14 +683,12 @@ class TextAudioSpeakerLoaderV4(torch.utils.data.Dataset):
         return (ssl, spec, mel, text)
 
     def get_audio(self, filename):
-        audio_array = load_audio(filename, self.sampling_rate)  # load_audio的方法是已经归一化到-1~1之间的，不用再/32768
-        audio = torch.FloatTensor(audio_array)  # /32768
+        audio = load_wav(self.packed, filename, self.sampling_rate)  # 已经归一化到-1~1之间的，不用再/32768
         audio_norm = audio
         audio_norm = audio_norm.unsqueeze(0)
-        spec = spectrogram_torch(
-            audio_norm, self.filter_length, self.sampling_rate, self.hop_length, self.win_length, center=False
+        spec = load_spec(
+            self.packed, filename, audio_norm, self.filter_length, self.sampling_rate, self.hop_length, self.win_length
         )
-        spec = torch.squeeze(spec, 0)
         spec1 = spectrogram_torch(audio_norm, 1280, 32000, 320, 1280, center=False)
         mel = spec_to_mel_torch(spec1, 1280, 100, 32000, 0, None)
         mel = self.norm_spec(torch.squeeze(mel, 0))
@@ -737,11 +786,17 @@ class TextAudioSpeakerLoaderV3b(torch.utils.data.Dataset):
         self.path2 = "%s/2-name2text.txt" % exp_dir
         self.path4 = "%s/4-cnhubert" % exp_dir
         self.path5 = "%s/5-wav32k" % exp_dir
+        self.packed = PackedShards.open(exp_dir)
         assert os.path.exists(self.path2)
-        assert os.path.exists(self.path4)
-        assert os.path.exists(self.path5)
-        names4 = set([name[:-3] for name in list(os.listdir(self.path4))])  # 去除.pt后缀
-        names5 = set(os.listdir(self.path5))
+        if self.packed is None:
+            assert os.path.exists(self.path4)
+            assert os.path.exists(self.path5)
+        if self.packed is not None:
+            names4 = self.packed.names("ssl")
+            names5 = self.packed.names("wav_%s" % hparams.sampling_rate)
+        else:
+            names4 = set([name[:-3] for name in list(os.listdir(self.path4))])  # 去除.pt后缀
+            names5 = set(os.listdir(self.path5))
         self.phoneme_data = {}
         with open(self.path2, "r", encoding="utf8") as f:
             lines = f.read().strip("\n").split("\n")
@@ -788,7 +843,7 @@ class TextAudioSpeakerLoaderV3b(torch.utils.data.Dataset):
                 skipped_phone += 1
                 continue
 
-            size = os.path.getsize("%s/%s" % (self.path5, audiopath))
+            size = wav_nbytes(self.packed, self.path5, audiopath, self.sampling_rate)
             duration = size / self.sampling_rate / 2
 
             if duration == 0:
@@ -827,7 +882,7 @@ class TextAudioSpeakerLoaderV3b(torch.utils.data.Dataset):
         try:
             spec, mel, wav = self.get_audio("%s/%s" % (self.path5, audiopath))
             with torch.no_grad():
-                ssl = torch.load("%s/%s.pt" % (self.path4, audiopath), map_location="cpu")
+                ssl = load_feature(self.packed, "ssl", self.path4, audiopath)
                 if ssl.shape[-1] != spec.shape[-1]:
                     typee = ssl.dtype
                     ssl = F.pad(ssl.float(), (0, 1), mode="replicate").to(typee)
@@ -843,21 +898,16 @@ class TextAudioSpeakerLoaderV3b(torch.utils.data.Dataset):
         return (ssl, spec, wav, mel, text)
 
     def get_audio(self, filename):
-        audio_array = load_audio(filename, self.sampling_rate)  # load_audio的方法是已经归一化到-1~1之间的，不用再/32768
-        audio = torch.FloatTensor(audio_array)  # /32768
+        audio = load_wav(self.packed, filename, self.sampling_rate)  # 已经归一化到-1~1之间的，不用再/32768
         audio_norm = audio
         audio_norm = audio_norm.unsqueeze(0)
-        audio_array24 = load_audio(
-            filename, 24000
-        )  # load_audio的方法是已经归一化到-1~1之间的，不用再/32768######这里可以用GPU重采样加速
-        audio24 = torch.FloatTensor(audio_array24)  # /32768
+        audio24 = load_wav(self.packed, filename, 24000)  # 已经归一化到-1~1之间的，不用再/32768######这里可以用GPU重采样加速
         audio_norm24 = audio24
         audio_norm24 = audio_norm24.unsqueeze(0)
 
-        spec = spectrogram_torch(
-            audio_norm, self.filter_length, self.sampling_rate, self.hop_length, self.win_length, center=False
+        spec = load_spec(
+            self.packed, filename, audio_norm, self.filter_length, self.sampling_rate, self.hop_length, self.win_length
         )
-        spec = torch.squeeze(spec, 0)
 
         spec1 = spectrogram_torch(
             audio_norm24,
@@ -223,13 +223,32 @@ class TextEncoder(nn.Module):
         text = self.encoder_text(text * text_mask, text_mask)
         y = self.mrte(y, y_mask, text, text_mask, ge)
         y = self.encoder2(y * y_mask, y_mask)
-        if speed != 1:
+        if isinstance(speed, (list, tuple)):
+            y, y_mask = self.stretch_batched(y, y_lengths, speed)
+        elif speed != 1:
             y = F.interpolate(y, size=int(y.shape[-1] / speed) + 1, mode="linear")
             y_mask = F.interpolate(y_mask, size=y.shape[-1], mode="nearest")
         stats = self.proj(y) * y_mask
         m, logs = torch.split(stats, self.out_channels, dim=1)
         return y, m, logs, y_mask
 
+    def stretch_batched(self, y, y_lengths, speed):
+        """
+        Per-item version of the speed interpolation in forward: every item is stretched over its own valid frames only,
+        exactly as if it had been decoded alone, then the batch is padded again.
+        """
+        ys = []
+        for i, (length, _speed) in enumerate(zip(y_lengths.tolist(), speed)):
+            _y = y[i : i + 1, :, :length]
+            if _speed != 1:
+                _y = F.interpolate(_y, size=int(length / _speed) + 1, mode="linear")
+            ys.append(_y)
+        lengths = torch.LongTensor([_y.shape[-1] for _y in ys]).to(y.device)
+        max_len = int(lengths.max())
+        y = torch.cat([F.pad(_y, (0, max_len - _y.shape[-1])) for _y in ys], 0)
+        y_mask = torch.unsqueeze(commons.sequence_mask(lengths, max_len), 1).to(y.dtype)
+        return y, y_mask
+
     def extract_latent(self, x):
         x = self.ssl_proj(x)
         quantized, codes, commit_loss, quantized_list = self.quantizer(x)
@@ -449,20 +468,28 @@ class Generator(torch.nn.Module):
         if gin_channels != 0:
             self.cond = nn.Conv1d(gin_channels, upsample_initial_channel, 1)
 
-    def forward(self, x, g=None):
+    def forward(self, x, g=None, x_mask=None):
+        """
+        x_mask (B, 1, T) is only needed for padded batches: it keeps the padding at zero in front of every conv,
+        so that each item's valid output is the same as decoding it alone.
+        """
         x = self.conv_pre(x)
         if g is not None:
             x = x + self.cond(g)
 
         for i in range(self.num_upsamples):
             x = F.leaky_relu(x, modules.LRELU_SLOPE)
+            if x_mask is not None:
+                x = x * x_mask
             x = self.ups[i](x)
+            if x_mask is not None:
+                x_mask = torch.repeat_interleave(x_mask, self.ups[i].stride[0], dim=-1)[..., : x.shape[-1]]
             xs = None
             for j in range(self.num_kernels):
                 if xs is None:
-                    xs = self.resblocks[i * self.num_kernels + j](x)
+                    xs = self.resblocks[i * self.num_kernels + j](x, x_mask)
                 else:
-                    xs += self.resblocks[i * self.num_kernels + j](x)
+                    xs += self.resblocks[i * self.num_kernels + j](x, x_mask)
             x = xs / self.num_kernels
         x = F.leaky_relu(x)
         x = self.conv_post(x)
@@ -957,9 +984,13 @@ class SynthesizerTrn(nn.Module):
         o = self.dec((z * y_mask)[:, :, :], g=ge)
         return o, y_mask, (z, z_p, m_p, logs_p)
 
-    @torch.no_grad()
-    def decode(self, codes, text, refer, noise_scale=0.5, speed=1, sv_emb=None):
-        def get_ge(refer, sv_emb):
+    def get_ge(self, refer, sv_emb=None):
+        """
+        Global (speaker) embedding of one reference spec, or the mean over a list of them.
+        It only depends on the references, so callers can compute it once and pass it to decode / batched_decode as ge.
+        """
+
+        def _get_ge(refer, sv_emb):
             ge = None
             if refer is not None:
                 refer_lengths = torch.LongTensor([refer.size(2)]).to(refer.device)
@@ -977,11 +1008,15 @@ class SynthesizerTrn(nn.Module):
         if type(refer) == list:
             ges = []
             for idx, _refer in enumerate(refer):
-                ge = get_ge(_refer, sv_emb[idx] if self.is_v2pro else None)
+                ge = _get_ge(_refer, sv_emb[idx] if self.is_v2pro else None)
                 ges.append(ge)
-            ge = torch.stack(ges, 0).mean(0)
-        else:
-            ge = get_ge(refer, sv_emb)
+            return torch.stack(ges, 0).mean(0)
+        return _get_ge(refer, sv_emb)
+
+    @torch.no_grad()
+    def decode(self, codes, text, refer, noise_scale=0.5, speed=1, sv_emb=None, ge=None, generator=None):
+        if ge is None:
+            ge = self.get_ge(refer, sv_emb)
 
         y_lengths = torch.LongTensor([codes.size(2) * 2]).to(codes.device)
         text_lengths = torch.LongTensor([text.size(-1)]).to(text.device)
@@ -997,19 +1032,96 @@ class SynthesizerTrn(nn.Module):
             self.ge_to512(ge.transpose(2, 1)).transpose(2, 1) if self.is_v2pro else ge,
             speed,
         )
-        z_p = m_p + torch.randn_like(m_p) * torch.exp(logs_p) * noise_scale
+        noise = torch.randn(m_p.shape, generator=generator, device=m_p.device, dtype=m_p.dtype)
+        z_p = m_p + noise * torch.exp(logs_p) * noise_scale
 
         z = self.flow(z_p, y_mask, g=ge, reverse=True)
 
         o = self.dec((z * y_mask)[:, :, :], g=ge)
         return o
 
+    @torch.no_grad()
+    def batched_decode(
+        self,
+        codes,
+        codes_lengths,
+        text,
+        text_lengths,
+        refer,
+        noise_scale=0.5,
+        speed=1,
+        sv_emb=None,
+        ge=None,
+        generator=None,
+    ):
+        """
+        Padded batch version of decode: all utterances share the reference and go through one forward pass.
+
+        Args:
+            codes: (1, B, T) right-padded semantic tokens, codes_lengths: (B,)
+            text: (B, L) right-padded phoneme ids, text_lengths: (B,)
+            speed: a number, or one speed per utterance
+            ge: precomputed get_ge(refer, sv_emb), refer and sv_emb are ignored when it is given
+            generator: torch.Generator for the prior noise, None uses the global generator
+        Returns:
+            List of B waveforms (1, 1, n_i), each with the exact length decode would return for that utterance.
+        """
+        if ge is None:
+            ge = self.get_ge(refer, sv_emb)
+        batch_size = codes.size(1)
+        if ge is not None:
+            ge = ge.expand(batch_size, -1, -1)
+        if not isinstance(speed, (list, tuple)):
+            speed = [speed] * batch_size
+
+        y_lengths = codes_lengths * 2
+
+        quantized = self.quantizer.decode(codes)
+        if self.semantic_frame_rate == "25hz":
+            quantized = F.interpolate(quantized, size=int(quantized.shape[-1] * 2), mode="nearest")
+        x, m_p, logs_p, y_mask = self.enc_p(
+            quantized,
+            y_lengths,
+            text,
+            text_lengths,
+            self.ge_to512(ge.transpose(2, 1)).transpose(2, 1) if self.is_v2pro else ge,
+            list(speed),
+        )
+        noise = torch.randn(m_p.shape, generator=generator, device=m_p.device, dtype=m_p.dtype)
+        z_p = m_p + noise * torch.exp(logs_p) * noise_scale
+
+        z = self.flow(z_p, y_mask, g=ge, reverse=True)
+
+        o = self.dec(z * y_mask, g=ge, x_mask=y_mask)
+        upsample_rate = math.prod(self.upsample_rates)
+        frame_lengths = y_mask[:, 0].float().sum(-1).long().tolist()
+        return [o[i : i + 1, :, : frame_lengths[i] * upsample_rate] for i in range(batch_size)]
+
     def extract_latent(self, x):
         ssl = self.ssl_proj(x)
         quantized, codes, commit_loss, quantized_list = self.quantizer(ssl)
         return codes.transpose(0, 1)
 
 
+# 每步调用estimator的次数(不含CFG)
+CFM_SOLVERS = {"euler": 1, "midpoint": 2, "heun": 2, "rk4": 4}
+
+
+def cfm_timesteps(n_timesteps, schedule="uniform", sway_coef=-1.0):
+    """
+    n_timesteps + 1 increasing times from 0 to 1.
+    "sway": t = u + s * (cos(pi / 2 * u) - 1 + u), with s = -1 the steps are densest near t = 0,
+    where the flow is furthest from straight.
+    """
+    ts = [j / n_timesteps for j in range(n_timesteps + 1)]
+    if schedule == "sway":
+        ts = [u + sway_coef * (math.cos(math.pi / 2 * u) - 1 + u) for u in ts]
+    elif schedule != "uniform":
+        raise ValueError("unknown cfm schedule: %s" % schedule)
+    ts[-1] = 1.0
+    return ts
+
+
 class CFM(torch.nn.Module):
     def __init__(self, in_channels, dit):
         super().__init__()
@@ -1024,23 +1136,59 @@ class CFM(torch.nn.Module):
         self.use_conditioner_cache = True
 
     @torch.inference_mode()
-    def inference(self, mu, x_lens, prompt, n_timesteps, temperature=1.0, inference_cfg_rate=0):
-        """Forward diffusion"""
+    def inference(
+        self,
+        mu,
+        x_lens,
+        prompt,
+        n_timesteps,
+        temperature=1.0,
+        inference_cfg_rate=0,
+        solver="euler",
+        schedule="uniform",
+        prompt_lens=None,
+        generator=None,
+    ):
+        """
+        Forward diffusion
+
+        solver: one of CFM_SOLVERS. "euler" conditions the estimator on the step size (the shortcut velocity over the
+            whole step, as trained with d > 0); the multi-stage solvers ask for the instantaneous velocity (d = 0)
+            at every stage and combine them.
+        schedule: "uniform", or "sway" to put more of the steps near t = 0 (sway sampling from F5-TTS).
+        prompt_lens: (B,) per-row prompt lengths when the rows of `prompt` are right padded (rows batched across
+            sentences, see TTS_infer_pack/CFMScheduler.py); None means every row uses the whole prompt.
+        generator: torch.Generator for the initial noise, or one per row (rows of different requests);
+            None uses the global generator.
+        """
+        assert solver in CFM_SOLVERS, solver
         B, T = mu.size(0), mu.size(1)
-        x = torch.randn([B, self.in_channels, T], device=mu.device, dtype=mu.dtype) * temperature
+        if generator is None or isinstance(generator, torch.Generator):
+            x = torch.randn([B, self.in_channels, T], device=mu.device, dtype=mu.dtype, generator=generator)
+        else:
+            shape = [1, self.in_channels, T]
+            x = torch.cat([torch.randn(shape, device=mu.device, dtype=mu.dtype, generator=g) for g in generator], 0)
+        x = x * temperature
         prompt_len = prompt.size(-1)
         prompt_x = torch.zeros_like(x, dtype=mu.dtype)
         prompt_x[..., :prompt_len] = prompt[..., :prompt_len]
-        x[..., :prompt_len] = 0
+        if prompt_lens is None:
+            prompt_mask = None
+            x[..., :prompt_len] = 0
+        else:
+            prompt_mask = (torch.arange(T, device=mu.device).unsqueeze(0) < prompt_lens.unsqueeze(1)).unsqueeze(1)
+            prompt_x = prompt_x.masked_fill(~prompt_mask, 0)
+            x = x.masked_fill(prompt_mask, 0)
         mu = mu.transpose(2, 1)
-        t = 0
-        d = 1 / n_timesteps
         text_cache = None
         text_cfg_cache = None
-        dt_cache = None
-        d_tensor = torch.ones(x.shape[0], device=x.device, dtype=mu.dtype) * d
-        for j in range(n_timesteps):
+        dt_caches = {}  # 步长嵌入只取决于步长, 非均匀步长时按取值缓存
+
+        def velocity(x, t, d):
+            nonlocal text_cache, text_cfg_cache
             t_tensor = torch.ones(x.shape[0], device=x.device, dtype=mu.dtype) * t
+            d_tensor = torch.ones(x.shape[0], device=x.device, dtype=mu.dtype) * d
+            dt_cache = dt_caches.get(d)
             # v_pred = model(x, t_tensor, d_tensor, **extra_args)
             v_pred, text_emb, dt = self.estimator(
                 x,
@@ -1059,7 +1207,7 @@ class CFM(torch.nn.Module):
             v_pred = v_pred.transpose(2, 1)
             if self.use_conditioner_cache:
                 text_cache = text_emb
-                dt_cache = dt
+                dt_caches[d] = dt
             if inference_cfg_rate > 1e-5:
                 neg, text_cfg_emb, _ = self.estimator(
                     x,
@@ -1073,15 +1221,42 @@ class CFM(torch.nn.Module):
                     drop_text=True,
                     infer=True,
                     text_cache=text_cfg_cache,
-                    dt_cache=dt_cache,
+                    dt_cache=dt_caches.get(d),
                 )
                 neg = neg.transpose(2, 1)
                 if self.use_conditioner_cache:
                     text_cfg_cache = text_cfg_emb
                 v_pred = v_pred + (v_pred - neg) * inference_cfg_rate
-            x = x + d * v_pred
-            t = t + d
-            x[:, :, :prompt_len] = 0
+            return v_pred
+
+        def step(x, v, h):
+            x = x + h * v
+            if prompt_mask is None:
+                x[:, :, :prompt_len] = 0
+            else:
+                x = x.masked_fill(prompt_mask, 0)
+            return x
+
+        timesteps = cfm_timesteps(n_timesteps, schedule)
+        for j in range(n_timesteps):
+            t = timesteps[j]
+            h = timesteps[j + 1] - t
+            if solver == "euler":
+                v = velocity(x, t, h)
+            elif solver == "midpoint":
+                k1 = velocity(x, t, 0)
+                v = velocity(step(x, k1, h / 2), t + h / 2, 0)
+            elif solver == "heun":
+                k1 = velocity(x, t, 0)
+                k2 = velocity(step(x, k1, h), t + h, 0)
+                v = (k1 + k2) / 2
+            else:  # rk4
+                k1 = velocity(x, t, 0)
+                k2 = velocity(step(x, k1, h / 2), t + h / 2, 0)
+                k3 = velocity(step(x, k2, h / 2), t + h / 2, 0)
+                k4 = velocity(step(x, k3, h), t + h, 0)
+                v = (k1 + 2 * k2 + 2 * k3 + k4) / 6
+            x = step(x, v, h)
         return x
 
     def forward(self, x1, x_lens, prompt_lens, mu, use_grad_ckpt):
@@ -1241,14 +1416,18 @@ class SynthesizerTrnV3(nn.Module):
         cfm_loss = self.cfm(mel, mel_lengths, prompt_len, fea, use_grad_ckpt)
         return cfm_loss
 
+    @torch.no_grad()
+    def get_ge(self, refer):
+        refer_lengths = torch.LongTensor([refer.size(2)]).to(refer.device)
+        refer_mask = torch.unsqueeze(commons.sequence_mask(refer_lengths, refer.size(2)), 1).to(refer.dtype)
+        return self.ref_enc(refer[:, :704] * refer_mask, refer_mask)
+
     @torch.no_grad()
     def decode_encp(self, codes, text, refer, ge=None, speed=1):
         # print(2333333,refer.shape)
         # ge=None
         if ge == None:
-            refer_lengths = torch.LongTensor([refer.size(2)]).to(refer.device)
-            refer_mask = torch.unsqueeze(commons.sequence_mask(refer_lengths, refer.size(2)), 1).to(refer.dtype)
-            ge = self.ref_enc(refer[:, :704] * refer_mask, refer_mask)
+            ge = self.get_ge(refer)
         y_lengths = torch.LongTensor([int(codes.size(2) * 2)]).to(codes.device)
         if speed == 1:
             sizee = int(codes.size(2) * (3.875 if self.version == "v3" else 4))
@@ -1405,14 +1584,18 @@ class SynthesizerTrnV3b(nn.Module):
             quantized,
         )
 
+    @torch.no_grad()
+    def get_ge(self, refer):
+        refer_lengths = torch.LongTensor([refer.size(2)]).to(refer.device)
+        refer_mask = torch.unsqueeze(commons.sequence_mask(refer_lengths, refer.size(2)), 1).to(refer.dtype)
+        return self.ref_enc(refer[:, :704] * refer_mask, refer_mask)
+
     @torch.no_grad()
     def decode_encp(self, codes, text, refer, ge=None):
         # print(2333333,refer.shape)
         # ge=None
         if ge == None:
-            refer_lengths = torch.LongTensor([refer.size(2)]).to(refer.device)
-            refer_mask = torch.unsqueeze(commons.sequence_mask(refer_lengths, refer.size(2)), 1).to(refer.dtype)
-            ge = self.ref_enc(refer[:, :704] * refer_mask, refer_mask)
+            ge = self.get_ge(refer)
         y_lengths = torch.LongTensor([int(codes.size(2) * 2)]).to(codes.device)
         y_lengths1 = torch.LongTensor([int(codes.size(2) * 2.5 * 1.5)]).to(codes.device)
         text_lengths = torch.LongTensor([text.size(-1)]).to(text.device)
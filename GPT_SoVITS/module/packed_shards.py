@@ -0,0 +1,164 @@
+import json
+import os
+import shutil
+from typing import Dict, List, Optional, Set
+
+import numpy as np
+import torch
+
+SHARD_DIR = "8-s2-shards"
+INDEX_NAME = "index.json"
+ALIGN = 64
+# 索引格式版本, 格式变化后旧shard自动失效
+FORMAT_VERSION = 1
+# shard内容来源的预处理目录
+SOURCE_DIRS = ["4-cnhubert", "5-wav32k", "7-sv_cn"]
+
+
+def source_signature(exp_dir: str) -> List[list]:
+    """
+    [dir, file count, total size, latest mtime] of every source directory, used to detect stale shards
+    after the dataset is prepared again.
+    """
+    signature = []
+    for name in SOURCE_DIRS:
+        path = os.path.join(exp_dir, name)
+        if not os.path.isdir(path):
+            continue
+        count = size = mtime = 0
+        for entry in os.scandir(path):
+            stat = entry.stat()
+            count += 1
+            size += stat.st_size
+            mtime = max(mtime, int(stat.st_mtime))
+        signature.append([name, count, size, mtime])
+    return signature
+
+
+def _to_numpy(value) -> np.ndarray:
+    if isinstance(value, torch.Tensor):
+        value = value.detach().cpu()
+        if value.dtype == torch.bfloat16:
+            value = value.float()
+        value = value.numpy()
+    return np.ascontiguousarray(value)
+
+
+class PackedShardWriter:
+    """
+    Appends per-item arrays (wav, spec, ssl, sv_emb, ...) to a few large shard files
+    and records (shard, offset, dtype, shape) of every array in a json index.
+    """
+
+    def __init__(self, root: str, shard_size: int = 1 << 30, meta: Optional[Dict] = None):
+        self.root = root
+        self.shard_size = shard_size
+        self.meta = meta or {}
+        self.items: Dict[str, Dict[str, list]] = {}
+        self.fields: Set[str] = set()
+        self.shard_id = -1
+        self.offset = 0
+        self.file = None
+        os.makedirs(self.root, exist_ok=True)
+
+    def _open_next_shard(self):
+        if self.file is not None:
+            self.file.close()
+        self.shard_id += 1
+        self.offset = 0
+        self.file = open(os.path.join(self.root, "shard_%04d.bin" % self.shard_id), "wb")
+
+    def add(self, name: str, fields: Dict[str, object]):
+        arrays = {field: _to_numpy(value) for field, value in fields.items() if value is not None}
+        nbytes = sum(array.nbytes + ALIGN for array in arrays.values())
+        if self.file is None or (self.offset > 0 and self.offset + nbytes > self.shard_size):
+            self._open_next_shard()
+
+        entry = {}
+        for field, array in arrays.items():
+            pad = -self.offset % ALIGN
+            if pad:
+                self.file.write(b"\0" * pad)
+                self.offset += pad
+            self.file.write(array.tobytes())
+            entry[field] = [self.shard_id, self.offset, array.dtype.str, list(array.shape)]
+            self.offset += array.nbytes
+            self.fields.add(field)
+        self.items[name] = entry
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        index = {
+            "num_shards": self.shard_id + 1,
+            "fields": sorted(self.fields),
+            "meta": self.meta,
+            "items": self.items,
+        }
+        ### 先写临时文件再移动, 中途中断时不会留下不完整的索引
+        tmp_path = os.path.join(self.root, INDEX_NAME + ".tmp")
+        with open(tmp_path, "w", encoding="utf8") as f:
+            json.dump(index, f, ensure_ascii=False)
+        shutil.move(tmp_path, os.path.join(self.root, INDEX_NAME))
+
+
+class PackedShards:
+    """
+    Read side of `PackedShardWriter`. Shards are memory-mapped lazily (after DataLoader workers fork),
+    and `get` returns zero-copy tensors viewing the mapped file.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        with open(os.path.join(root, INDEX_NAME), "r", encoding="utf8") as f:
+            index = json.load(f)
+        self.num_shards: int = index["num_shards"]
+        self.fields: Set[str] = set(index["fields"])
+        self.meta: Dict = index["meta"]
+        self.items: Dict[str, Dict[str, list]] = index["items"]
+        self._maps: Dict[int, np.memmap] = {}
+
+    @classmethod
+    def open(cls, exp_dir: str) -> Optional["PackedShards"]:
+        root = "%s/%s" % (exp_dir, SHARD_DIR)
+        if not os.path.exists(os.path.join(root, INDEX_NAME)):
+            return None
+        shards = cls(root)
+        if shards.meta.get("format") != FORMAT_VERSION or shards.meta.get("sources") != source_signature(exp_dir):
+            print("packed s2 shards %s are stale (format or source files changed), ignored" % root)
+            return None
+        print("using packed s2 shards:", root)
+        return shards
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_maps"] = {}
+        return state
+
+    def _map(self, shard_id: int) -> np.memmap:
+        mm = self._maps.get(shard_id)
+        if mm is None:
+            ### mode="c": 写时复制, 返回的tensor可写但不会改动shard文件
+            mm = np.memmap(os.path.join(self.root, "shard_%04d.bin" % shard_id), dtype=np.uint8, mode="c")
+            self._maps[shard_id] = mm
+        return mm
+
+    def has(self, field: str) -> bool:
+        return field in self.fields
+
+    def names(self, field: str) -> Set[str]:
+        return set(name for name, entry in self.items.items() if field in entry)
+
+    def shape(self, name: str, field: str) -> list:
+        return self.items[name][field][3]
+
+    def get(self, name: str, field: str) -> Optional[torch.Tensor]:
+        entry = self.items.get(name, {}).get(field)
+        if entry is None:
+            return None
+        shard_id, offset, dtype, shape = entry
+        dtype = np.dtype(dtype)
+        count = int(np.prod(shape)) if len(shape) > 0 else 1
+        array = self._map(shard_id)[offset : offset + count * dtype.itemsize].view(dtype).reshape(shape)
+        return torch.from_numpy(array)
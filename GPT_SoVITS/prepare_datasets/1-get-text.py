@@ -88,8 +88,20 @@ if os.path.exists(txt_path) == False:
 
         return phone_level_feature.T
 
+    g2pw_prefetch_size = int(os.environ.get("g2pw_prefetch_size", "256"))
+
+    def g2pw_prefetch(data):
+        ### 每攒一批中文文本批量跑一次g2pW, 之后逐条clean_text直接命中多音字缓存
+        zh_texts = [text.replace("%", "-").replace("￥", ",") for name, text, lan in data if lan == "zh"]
+        if version != "v1" and len(zh_texts) > 1:
+            from text import chinese2
+
+            chinese2.g2pw_prefetch(zh_texts)
+
     def process(data, res):
-        for name, text, lan in data:
+        for i, (name, text, lan) in enumerate(data):
+            if i % g2pw_prefetch_size == 0:
+                g2pw_prefetch(data[i : i + g2pw_prefetch_size])
             try:
                 name = clean_path(name)
                 name = os.path.basename(name)
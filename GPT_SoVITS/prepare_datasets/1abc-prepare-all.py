@@ -0,0 +1,429 @@
+# -*- coding: utf-8 -*-
+### 一键三连的单进程版本: 每条音频依次走 文本清洗->BERT->读音频->CNHuBERT->语义token,
+### 三个模型只加载一次, ssl直接在显存里送进vq_model, 不再由3-get-semantic重新torch.load;
+### 读音频/重采样在线程池中预取; 中文BERT按长度分批推理; 每条处理完追加写入manifest,
+### 重跑时跳过已完成且文本/语言/版本/底模均未改变的条目。
+### 输出与1-get-text/2-get-hubert-wav32k/3-get-semantic一致
+### (3-bert, 4-cnhubert, 5-wav32k, 2-name2text-*, 6-name2semantic-*)
+
+import os
+import sys
+
+inp_text = os.environ.get("inp_text")
+inp_wav_dir = os.environ.get("inp_wav_dir")
+exp_name = os.environ.get("exp_name")
+i_part = os.environ.get("i_part")
+all_parts = os.environ.get("all_parts")
+if "_CUDA_VISIBLE_DEVICES" in os.environ:
+    os.environ["CUDA_VISIBLE_DEVICES"] = os.environ["_CUDA_VISIBLE_DEVICES"]
+opt_dir = os.environ.get("opt_dir")
+bert_pretrained_dir = os.environ.get("bert_pretrained_dir")
+pretrained_s2G = os.environ.get("pretrained_s2G")
+s2config_path = os.environ.get("s2config_path")
+num_workers = int(os.environ.get("prepare_num_workers", "4"))  # 预取音频的线程数
+# >0时开启批量提取(见2-get-hubert-wav32k.py): 每批padding后的总时长上限(秒), 即显存上限
+hubert_batch_seconds = float(os.environ.get("hubert_batch_seconds", "0"))
+hubert_batch_size = int(os.environ.get("hubert_batch_size", "32"))
+max_pad_ratio = float(os.environ.get("max_pad_ratio", "0.05"))
+bucket_window = int(os.environ.get("bucket_window", "128"))  # 攒够多少条音频分一次桶, 即内存上限
+g2pw_prefetch_size = int(os.environ.get("g2pw_prefetch_size", "256"))  # 每多少条文本批量跑一次g2pW和BERT
+bert_batch_size = int(os.environ.get("bert_batch_size", "16"))  # 每批送进BERT的句子数
+from feature_extractor import cnhubert
+
+cnhubert.cnhubert_base_path = os.environ.get("cnhubert_base_dir")
+import torch
+import torch_musa
+
+# 检查是否使用MUSA GPU，如果是则强制使用float32（不支持half）
+use_musa = torch_musa.is_available()
+is_half = eval(os.environ.get("is_half", "True")) and torch.cuda.is_available() and not use_musa
+version = os.environ.get("version", None)
+
+import hashlib
+import json
+import traceback
+import shutil
+import numpy as np
+import librosa
+from concurrent.futures import ThreadPoolExecutor
+from scipy.io import wavfile
+from time import time as ttime
+
+now_dir = os.getcwd()
+sys.path.append(now_dir)
+import utils
+from text.cleaner import clean_text
+from transformers import AutoModelForMaskedLM, AutoTokenizer
+from tools.my_utils import load_audio, clean_path
+from feature_extractor.batching import extract_latent_batched, get_content_batched, make_buckets
+
+for path in [bert_pretrained_dir, pretrained_s2G]:
+    if not os.path.exists(path):
+        raise FileNotFoundError(path)
+# 与3-get-semantic.py相同, 底模版本按文件大小判断
+size = os.path.getsize(pretrained_s2G)
+if size < 82978 * 1024:
+    s2_version = "v1"
+elif size < 100 * 1024 * 1024:
+    s2_version = "v2"
+elif size < 103520 * 1024:
+    s2_version = "v1"
+elif size < 700 * 1024 * 1024:
+    s2_version = "v2"
+else:
+    s2_version = "v3"
+if s2_version != "v3":
+    from module.models import SynthesizerTrn
+else:
+    from module.models import SynthesizerTrnV3 as SynthesizerTrn
+
+
+def my_save(fea, path):  #####fix issue: torch.save doesn't support chinese path
+    dir = os.path.dirname(path)
+    name = os.path.basename(path)
+    tmp_path = "%s%s.pth" % (ttime(), i_part)
+    torch.save(fea, tmp_path)
+    shutil.move(tmp_path, "%s/%s" % (dir, name))
+
+
+bert_dir = "%s/3-bert" % (opt_dir)
+hubert_dir = "%s/4-cnhubert" % (opt_dir)
+wav32dir = "%s/5-wav32k" % (opt_dir)
+txt_path = "%s/2-name2text-%s.txt" % (opt_dir, i_part)
+semantic_path = "%s/6-name2semantic-%s.tsv" % (opt_dir, i_part)
+manifest_path = "%s/prepare-manifest-%s.jsonl" % (opt_dir, i_part)
+for dir in [opt_dir, bert_dir, hubert_dir, wav32dir]:
+    os.makedirs(dir, exist_ok=True)
+
+if torch.cuda.is_available():
+    device = "cuda:0"
+    hubert_device = "cuda:0"
+elif torch_musa.is_available():
+    device = "cpu"
+    hubert_device = "musa:0"
+else:
+    device = "cpu"
+    hubert_device = "cpu"
+
+tokenizer = AutoTokenizer.from_pretrained(bert_pretrained_dir)
+bert_model = AutoModelForMaskedLM.from_pretrained(bert_pretrained_dir)
+hubert_model = cnhubert.get_model()
+hps = utils.get_hparams_from_file(s2config_path)
+vq_model = SynthesizerTrn(
+    hps.data.filter_length // 2 + 1,
+    hps.train.segment_size // hps.data.hop_length,
+    n_speakers=hps.data.n_speakers,
+    version=s2_version,
+    **hps.model,
+)
+print(
+    vq_model.load_state_dict(torch.load(pretrained_s2G, map_location="cpu", weights_only=False)["weight"], strict=False)
+)
+if is_half == True:
+    bert_model = bert_model.half()
+    hubert_model = hubert_model.half()
+    vq_model = vq_model.half()
+bert_model = bert_model.to(device)
+hubert_model = hubert_model.to(hubert_device)
+vq_model = vq_model.to(device)
+vq_model.eval()
+
+maxx = 0.95
+alpha = 0.5
+language_v1_to_language_v2 = {
+    "ZH": "zh",
+    "zh": "zh",
+    "JP": "ja",
+    "jp": "ja",
+    "JA": "ja",
+    "ja": "ja",
+    "EN": "en",
+    "en": "en",
+    "En": "en",
+    "KO": "ko",
+    "Ko": "ko",
+    "ko": "ko",
+    "yue": "yue",
+    "YUE": "yue",
+    "Yue": "yue",
+}
+
+
+def item_signature(text, lan):
+    ### 文本、语言、版本或底模(及BERT)改变后, manifest中的条目需要重做
+    h = hashlib.blake2b(digest_size=16)
+    h.update(json.dumps([text, lan, version, pretrained_s2G, bert_pretrained_dir], ensure_ascii=False).encode("utf8"))
+    return h.hexdigest()
+
+
+def get_bert_feature_batch(texts, word2phs):
+    ### 右侧padding, 各句只取自己的token, 与逐句推理一致
+    with torch.no_grad():
+        inputs = tokenizer(texts, return_tensors="pt", padding=True)
+        for i in inputs:
+            inputs[i] = inputs[i].to(device)
+        res = bert_model(**inputs, output_hidden_states=True)
+        res = torch.cat(res["hidden_states"][-3:-2], -1).cpu()
+    phone_level_features = []
+    for i, (text, word2ph) in enumerate(zip(texts, word2phs)):
+        assert len(word2ph) == len(text)
+        phone_level_feature = torch.repeat_interleave(res[i, 1 : 1 + len(word2ph)], torch.tensor(word2ph), dim=0)
+        phone_level_features.append(phone_level_feature.T)
+    return phone_level_features
+
+
+def get_bert_features(segments):
+    """
+    segments为[(norm_text, word2ph)], 按长度排序后每bert_batch_size句一次前向.
+    出错的批次逐句重试, 仍出错的句子返回None
+    """
+    features = [None] * len(segments)
+    order = sorted(range(len(segments)), key=lambda i: len(segments[i][0]))
+    for start in range(0, len(order), max(1, bert_batch_size)):
+        index = order[start : start + max(1, bert_batch_size)]
+        try:
+            batch = get_bert_feature_batch([segments[i][0] for i in index], [segments[i][1] for i in index])
+        except:
+            print(traceback.format_exc())
+            batch = []
+            for i in index:
+                try:
+                    batch.extend(get_bert_feature_batch([segments[i][0]], [segments[i][1]]))
+                except:
+                    print(segments[i][0], traceback.format_exc())
+                    batch.append(None)
+        for i, feature in zip(index, batch):
+            features[i] = feature
+    return features
+
+
+def get_texts(data):
+    """
+    data为todo中的若干条, 逐条清洗文本, 中文的BERT特征分批提取.
+    返回{wav_name: [name, phones, word2ph, norm_text]}, 出错的条目不在其中
+    """
+    texts = {}
+    zh_items = []
+    for wav_name, _, lan, text, _ in data:
+        try:
+            phones, word2ph, norm_text = clean_text(text.replace("%", "-").replace("￥", ","), lan, version)
+        except:
+            print(wav_name, text, traceback.format_exc())
+            continue
+        texts[wav_name] = [wav_name, " ".join(phones), str(word2ph), norm_text]
+        path_bert = "%s/%s.pt" % (bert_dir, wav_name)
+        if lan == "zh":
+            zh_items.append((wav_name, phones, word2ph, norm_text))
+        elif os.path.exists(path_bert):
+            ### 重做的条目改成了非中文, 删掉旧的BERT特征
+            os.remove(path_bert)
+    features = get_bert_features([(norm_text, word2ph) for _, _, word2ph, norm_text in zh_items])
+    for (wav_name, phones, _, _), feature in zip(zh_items, features):
+        if feature is None or feature.shape[-1] != len(phones):
+            print("%s: bert feature failed" % wav_name)
+            texts.pop(wav_name)
+            continue
+        my_save(feature, "%s/%s.pt" % (bert_dir, wav_name))
+    return texts
+
+
+def g2pw_prefetch(data):
+    ### 批量跑g2pW填充多音字缓存, 之后get_texts中逐条clean_text直接命中
+    zh_texts = [text.replace("%", "-").replace("￥", ",") for _, _, lan, text, _ in data if lan == "zh"]
+    if version != "v1" and len(zh_texts) > 1:
+        from text import chinese2
+
+        chinese2.g2pw_prefetch(zh_texts)
+
+
+def load_wav(wav_path):
+    """在线程池中执行: ffmpeg解码+响度处理+重采样, 不涉及模型"""
+    tmp_audio = load_audio(wav_path, 32000)
+    tmp_max = np.abs(tmp_audio).max()
+    if tmp_max > 2.2:
+        return None, tmp_max
+    tmp_audio32 = (tmp_audio / tmp_max * (maxx * alpha * 32768)) + ((1 - alpha) * 32768) * tmp_audio
+    tmp_audio32b = (tmp_audio / tmp_max * (maxx * alpha * 1145.14)) + ((1 - alpha) * 1145.14) * tmp_audio
+    tmp_audio16 = librosa.resample(tmp_audio32b, orig_sr=32000, target_sr=16000)  # 不是重采样问题
+    return (tmp_audio32, tmp_audio16), tmp_max
+
+
+def get_semantics(items):
+    """
+    items为[(wav_name, audio)], 同一桶内一次跑hubert和vq_model, 单条时与逐条推理一致.
+    返回对应的语义token字符串; 出现nan的条目返回None, 留给fp32重试
+    """
+    wavs16 = []
+    for _, (tmp_audio32, tmp_audio16) in items:
+        tensor_wav16 = torch.from_numpy(tmp_audio16)
+        tensor_wav16 = tensor_wav16.half() if is_half == True else tensor_wav16.float()
+        wavs16.append(tensor_wav16.to(hubert_device))
+    semantics = [None] * len(items)
+    with torch.no_grad():
+        if len(items) == 1:
+            ssls = [hubert_model.model(wavs16[0].unsqueeze(0))["last_hidden_state"].transpose(1, 2)]
+        else:
+            ssls = get_content_batched(hubert_model, wavs16)
+        valid = []
+        for i, ((wav_name, (tmp_audio32, _)), ssl) in enumerate(zip(items, ssls)):
+            if torch.isnan(ssl).any():
+                continue
+            wavfile.write("%s/%s" % (wav32dir, wav_name), 32000, tmp_audio32.astype("int16"))
+            my_save(ssl.cpu(), "%s/%s.pt" % (hubert_dir, wav_name))
+            valid.append(i)
+        if len(valid) > 0:
+            codes = extract_latent_batched(vq_model, [ssls[i].to(device) for i in valid])
+            for i, code in zip(valid, codes):
+                semantics[i] = " ".join([str(j) for j in code.tolist()])
+    return semantics
+
+
+done = {}
+if os.path.exists(manifest_path):
+    with open(manifest_path, "r", encoding="utf8") as f:
+        content = f.read()
+    for line in content.strip("\n").split("\n"):
+        try:
+            item = json.loads(line)
+            done[item["name"]] = item
+        except:
+            pass  # 上次中断时写了一半的行
+    if content != "" and not content.endswith("\n"):
+        with open(manifest_path, "a", encoding="utf8") as f:
+            f.write("\n")
+    print("manifest: %s items already done" % len(done))
+
+todo = []
+with open(inp_text, "r", encoding="utf8") as f:
+    lines = f.read().strip("\n").split("\n")
+for line in lines[int(i_part) :: int(all_parts)]:
+    try:
+        wav_name, spk_name, language, text = line.split("|")
+        wav_name = clean_path(wav_name)
+        if inp_wav_dir != "" and inp_wav_dir != None:
+            wav_name = os.path.basename(wav_name)
+            wav_path = "%s/%s" % (inp_wav_dir, wav_name)
+        else:
+            wav_path = wav_name
+            wav_name = os.path.basename(wav_name)
+        if language not in language_v1_to_language_v2.keys():
+            print(f"\033[33m[Waring] The {language = } of {wav_name} is not supported for training.\033[0m")
+            continue
+        lan = language_v1_to_language_v2[language]
+        sig = item_signature(text, lan)
+        if done.get(wav_name, {}).get("sig") != sig:
+            todo.append([wav_name, wav_path, lan, text, sig])
+    except:
+        print(line, traceback.format_exc())
+
+nan_fails = []
+failed = []
+with open(manifest_path, "a", encoding="utf8") as manifest, ThreadPoolExecutor(max(1, num_workers)) as executor:
+
+    def commit(item):
+        ### 所有产物落盘后才写manifest, 中断时未完成的条目会在下次重跑
+        ### 文本或语义token失败的条目只计入本次输出, 不写manifest, 下次重跑时重试(幅度过滤的音频是确定的, 不必重试)
+        done[item["name"]] = item
+        if item["text"] is None or (item["semantic"] is None and not item.get("filtered", False)):
+            failed.append(item["name"])
+            return
+        manifest.write(json.dumps(item, ensure_ascii=False) + "\n")
+        manifest.flush()
+
+    def flush(pending):
+        ### 批量模式下按16k音频长度分桶, 否则逐条
+        if hubert_batch_seconds > 0:
+            buckets = make_buckets(
+                [audio[1].shape[-1] for _, audio in pending],
+                int(hubert_batch_seconds * 16000),
+                hubert_batch_size,
+                max_pad_ratio,
+            )
+        else:
+            buckets = [[i] for i in range(len(pending))]
+        for bucket in buckets:
+            try:
+                semantics = get_semantics([(pending[i][0]["name"], pending[i][1]) for i in bucket])
+            except:
+                print(traceback.format_exc())
+                semantics = [None] * len(bucket)
+                for j, i in enumerate(bucket):
+                    try:
+                        semantics[j] = get_semantics([(pending[i][0]["name"], pending[i][1])])[0]
+                    except:
+                        print(pending[i][0]["name"], traceback.format_exc())
+                        commit(pending[i][0])
+                        bucket[j] = None
+            for i, semantic in zip(bucket, semantics):
+                if i is None:
+                    continue
+                item, audio = pending[i]
+                if semantic is None:
+                    print("nan filtered:%s" % item["name"])
+                    nan_fails.append((item, audio))
+                    continue
+                item["semantic"] = semantic
+                commit(item)
+
+    window = 2 * max(1, num_workers)
+    futures = [executor.submit(load_wav, todo[i][1]) for i in range(min(window, len(todo)))]
+    pending = []
+    texts = {}
+    for i, (wav_name, wav_path, lan, text, sig) in enumerate(todo):
+        future = futures[i]
+        if i + window < len(todo):
+            futures.append(executor.submit(load_wav, todo[i + window][1]))
+        futures[i] = None
+        if i % g2pw_prefetch_size == 0:
+            g2pw_prefetch(todo[i : i + g2pw_prefetch_size])
+            texts = get_texts(todo[i : i + g2pw_prefetch_size])
+        print(wav_name)
+        item = {"name": wav_name, "sig": sig, "text": texts.get(wav_name), "semantic": None}
+        try:
+            audio, tmp_max = future.result()
+            if audio is None:
+                print("%s-filtered,%s" % (wav_name, tmp_max))
+                item["filtered"] = True
+            else:
+                pending.append((item, audio))
+                if hubert_batch_seconds <= 0 or len(pending) >= bucket_window:
+                    flush(pending)
+                    pending = []
+                continue
+        except:
+            print(wav_name, traceback.format_exc())
+        commit(item)
+    flush(pending)
+
+    if len(nan_fails) > 0 and is_half == True:
+        is_half = False
+        hubert_model = hubert_model.float()
+        vq_model = vq_model.float()
+    for item, audio in nan_fails:
+        try:
+            item["semantic"] = get_semantics([(item["name"], audio)])[0]
+        except:
+            print(item["name"], traceback.format_exc())
+        commit(item)
+if len(failed) > 0:
+    print("%s items failed and will be retried on the next run: %s" % (len(failed), ", ".join(failed)))
+
+### 按输入顺序汇总, 交给webui合并
+text_lines = []
+semantic_lines = []
+for line in lines[int(i_part) :: int(all_parts)]:
+    try:
+        wav_name = os.path.basename(clean_path(line.split("|")[0]))
+    except:
+        continue
+    item = done.get(wav_name)
+    if item is None:
+        continue
+    if item["text"] is not None:
+        text_lines.append("%s\t%s\t%s\t%s" % tuple(item["text"]))
+    if item["semantic"] is not None:
+        semantic_lines.append("%s\t%s" % (wav_name, item["semantic"]))
+with open(txt_path, "w", encoding="utf8") as f:
+    f.write("\n".join(text_lines) + "\n")
+with open(semantic_path, "w", encoding="utf8") as f:
+    f.write("\n".join(semantic_lines))
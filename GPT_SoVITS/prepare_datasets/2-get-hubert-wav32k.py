@@ -14,6 +14,11 @@ from feature_extractor import cnhubert
 
 opt_dir = os.environ.get("opt_dir")
 cnhubert.cnhubert_base_path = os.environ.get("cnhubert_base_dir")
+# >0时开启批量提取: 每批padding后的总时长上限(秒), 即显存上限
+hubert_batch_seconds = float(os.environ.get("hubert_batch_seconds", "0"))
+hubert_batch_size = int(os.environ.get("hubert_batch_size", "32"))
+max_pad_ratio = float(os.environ.get("max_pad_ratio", "0.05"))  # 桶内每条最多padding的比例
+bucket_window = int(os.environ.get("bucket_window", "256"))  # 每读入多少条音频分一次桶, 即内存上限
 import torch
 import torch_musa
 
@@ -29,6 +34,7 @@ import librosa
 now_dir = os.getcwd()
 sys.path.append(now_dir)
 from tools.my_utils import load_audio, clean_path
+from feature_extractor.batching import get_content_batched, make_buckets
 
 # from config import cnhubert_base_path
 # cnhubert.cnhubert_base_path=cnhubert_base_path
@@ -80,15 +86,15 @@ else:
 nan_fails = []
 
 
-def name2go(wav_name, wav_path):
+def prepare(wav_name, wav_path):
     hubert_path = "%s/%s.pt" % (hubert_dir, wav_name)
     if os.path.exists(hubert_path):
-        return
+        return None
     tmp_audio = load_audio(wav_path, 32000)
     tmp_max = np.abs(tmp_audio).max()
     if tmp_max > 2.2:
         print("%s-filtered,%s" % (wav_name, tmp_max))
-        return
+        return None
     tmp_audio32 = (tmp_audio / tmp_max * (maxx * alpha * 32768)) + ((1 - alpha) * 32768) * tmp_audio
     tmp_audio32b = (tmp_audio / tmp_max * (maxx * alpha * 1145.14)) + ((1 - alpha) * 1145.14) * tmp_audio
     tmp_audio = librosa.resample(tmp_audio32b, orig_sr=32000, target_sr=16000)  # 不是重采样问题
@@ -97,8 +103,12 @@ def name2go(wav_name, wav_path):
         tensor_wav16 = tensor_wav16.half().to(device)
     else:
         tensor_wav16 = tensor_wav16.to(device)
-    ssl = model.model(tensor_wav16.unsqueeze(0))["last_hidden_state"].transpose(1, 2).cpu()  # torch.Size([1, 768, 215])
-    if np.isnan(ssl.detach().numpy()).sum() != 0:
+    return tmp_audio32, tensor_wav16
+
+
+def save(wav_name, wav_path, tmp_audio32, ssl):
+    ssl = ssl.cpu()
+    if np.isnan(ssl.detach().float().numpy()).sum() != 0:
         nan_fails.append((wav_name, wav_path))
         print("nan filtered:%s" % wav_name)
         return
@@ -107,12 +117,48 @@ def name2go(wav_name, wav_path):
         32000,
         tmp_audio32.astype("int16"),
     )
-    my_save(ssl, hubert_path)
+    my_save(ssl, "%s/%s.pt" % (hubert_dir, wav_name))
+
+
+def name2go(wav_name, wav_path):
+    res = prepare(wav_name, wav_path)
+    if res is None:
+        return
+    tmp_audio32, tensor_wav16 = res
+    ssl = model.model(tensor_wav16.unsqueeze(0))["last_hidden_state"].transpose(1, 2)  # torch.Size([1, 768, 215])
+    save(wav_name, wav_path, tmp_audio32, ssl)
+
+
+def names2go(items):
+    """批量版本: 读入一窗音频, 按时长分桶后每桶跑一次hubert"""
+    prepared = []
+    for wav_name, wav_path in items:
+        try:
+            res = prepare(wav_name, wav_path)
+            if res is not None:
+                prepared.append((wav_name, wav_path) + res)
+        except:
+            print(wav_name, traceback.format_exc())
+    buckets = make_buckets(
+        [item[3].shape[-1] for item in prepared], int(hubert_batch_seconds * 16000), hubert_batch_size, max_pad_ratio
+    )
+    for bucket in buckets:
+        try:
+            ssls = get_content_batched(model, [prepared[i][3] for i in bucket])
+        except:
+            ### 例如显存不足, 这一桶退回逐条处理
+            print(traceback.format_exc())
+            for i in bucket:
+                name2go(prepared[i][0], prepared[i][1])
+            continue
+        for i, ssl in zip(bucket, ssls):
+            save(prepared[i][0], prepared[i][1], prepared[i][2], ssl)
 
 
 with open(inp_text, "r", encoding="utf8") as f:
     lines = f.read().strip("\n").split("\n")
 
+window = []
 for line in lines[int(i_part) :: int(all_parts)]:
     try:
         # wav_name,text=line.split("\t")
@@ -125,9 +171,19 @@ for line in lines[int(i_part) :: int(all_parts)]:
         else:
             wav_path = wav_name
             wav_name = os.path.basename(wav_name)
-        name2go(wav_name, wav_path)
+        if hubert_batch_seconds > 0:
+            window.append((wav_name, wav_path))
+            if len(window) >= bucket_window:
+                with torch.no_grad():
+                    names2go(window)
+                window = []
+        else:
+            name2go(wav_name, wav_path)
     except:
         print(line, traceback.format_exc())
+if len(window) > 0:
+    with torch.no_grad():
+        names2go(window)
 
 if len(nan_fails) > 0 and is_half == True:
     is_half = False
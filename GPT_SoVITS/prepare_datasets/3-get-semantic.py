@@ -9,6 +9,10 @@ if "_CUDA_VISIBLE_DEVICES" in os.environ:
 opt_dir = os.environ.get("opt_dir")
 pretrained_s2G = os.environ.get("pretrained_s2G")
 s2config_path = os.environ.get("s2config_path")
+# >0时开启批量提取: 每批padding后的ssl总时长上限(秒); 逐帧量化, 批量结果与逐条一致
+semantic_batch_seconds = float(os.environ.get("semantic_batch_seconds", "300"))
+semantic_batch_size = int(os.environ.get("semantic_batch_size", "64"))
+bucket_window = int(os.environ.get("bucket_window", "256"))  # 每读入多少条ssl分一次桶
 
 if os.path.exists(pretrained_s2G):
     ...
@@ -42,6 +46,7 @@ if version != "v3":
 else:
     from module.models import SynthesizerTrnV3 as SynthesizerTrn
 from tools.my_utils import clean_path
+from feature_extractor.batching import extract_latent_batched, make_buckets
 
 logging.getLogger("numba").setLevel(logging.WARNING)
 # from config import pretrained_s2G
@@ -99,10 +104,43 @@ if os.path.exists(semantic_path) == False:
         semantic = " ".join([str(i) for i in codes[0, 0, :].tolist()])
         lines.append("%s\t%s" % (wav_name, semantic))
 
+    def names2go(wav_names, lines):
+        """批量版本: 按ssl长度分桶, 每桶一次extract_latent, 输出保持输入顺序"""
+        ssls = []
+        for wav_name in wav_names:
+            hubert_path = "%s/%s.pt" % (hubert_dir, wav_name)
+            if os.path.exists(hubert_path) == False:
+                continue
+            try:
+                ssl_content = torch.load(hubert_path, map_location="cpu")
+            except:
+                print(wav_name, traceback.format_exc())
+                continue
+            ssl_content = ssl_content.half() if is_half == True else ssl_content.float()
+            ssls.append((wav_name, ssl_content.to(device)))
+        ### 50hz的ssl, 1秒50帧; 量化逐帧进行, 不限制padding比例
+        buckets = make_buckets(
+            [ssl.shape[-1] for _, ssl in ssls], int(semantic_batch_seconds * 50), semantic_batch_size, 1.0
+        )
+        semantics = {}
+        with torch.no_grad():
+            for bucket in buckets:
+                try:
+                    codes = extract_latent_batched(vq_model, [ssls[i][1] for i in bucket])
+                except:
+                    ### 例如显存不足, 这一桶退回逐条处理
+                    print(traceback.format_exc())
+                    codes = [vq_model.extract_latent(ssls[i][1])[0, 0] for i in bucket]
+                for i, code in zip(bucket, codes):
+                    semantics[i] = " ".join([str(j) for j in code.tolist()])
+        for i, (wav_name, _) in enumerate(ssls):
+            lines.append("%s\t%s" % (wav_name, semantics[i]))
+
     with open(inp_text, "r", encoding="utf8") as f:
         lines = f.read().strip("\n").split("\n")
 
     lines1 = []
+    window = []
     for line in lines[int(i_part) :: int(all_parts)]:
         # print(line)
         try:
@@ -111,8 +149,16 @@ if os.path.exists(semantic_path) == False:
             wav_name = clean_path(wav_name)
             wav_name = os.path.basename(wav_name)
             # name2go(name,lines1)
-            name2go(wav_name, lines1)
+            if semantic_batch_seconds > 0:
+                window.append(wav_name)
+                if len(window) >= bucket_window:
+                    names2go(window, lines1)
+                    window = []
+            else:
+                name2go(wav_name, lines1)
         except:
             print(line, traceback.format_exc())
+    if len(window) > 0:
+        names2go(window, lines1)
     with open(semantic_path, "w", encoding="utf8") as f:
         f.write("\n".join(lines1))
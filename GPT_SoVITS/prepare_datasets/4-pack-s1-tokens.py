@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+### 把2-name2text.txt/6-name2semantic.tsv/3-bert打包成token store(9-s1-tokens),
+### s1训练时Text2SemanticDataset不再解析tsv和逐条torch.load bert, 直接mmap读取
+### webui一键三连结束后自动调用; 单独分步预处理时可手动运行. store未过期时直接跳过
+
+import os
+import sys
+
+opt_dir = os.environ.get("opt_dir")
+version = os.environ.get("version", None)
+
+now_dir = os.getcwd()
+sys.path.append(now_dir)
+sys.path.append("%s/GPT_SoVITS" % (now_dir))
+
+import traceback
+import torch
+from tqdm import tqdm
+
+from text import cleaned_text_to_sequence
+from AR.data.token_store import TOKEN_STORE_DIR, TokenStore, TokenStoreWriter, source_signature
+
+path2 = "%s/2-name2text.txt" % (opt_dir)
+path3 = "%s/3-bert" % (opt_dir)
+path6 = "%s/6-name2semantic.tsv" % (opt_dir)
+sources = [path2, path6, path3]
+
+if TokenStore.open(opt_dir, version, sources) is not None:
+    print("token store is up to date")
+    sys.exit(0)
+
+phoneme_data = {}
+with open(path2, "r", encoding="utf8") as f:
+    for line in f.read().strip("\n").split("\n"):
+        tmp = line.split("\t")
+        if len(tmp) != 4:
+            continue
+        phoneme_data[tmp[0]] = tmp[1]
+
+with open(path6, "r", encoding="utf8") as f:
+    lines = f.read().strip("\n").split("\n")[1:]  # 第一行是表头
+
+writer = TokenStoreWriter(
+    "%s/%s" % (opt_dir, TOKEN_STORE_DIR),
+    {"version": version, "sources": source_signature(sources)},
+)
+num_skipped = 0
+for line in tqdm(lines):
+    try:
+        item_name, semantic_str = line.split("\t")
+        semantic_ids = [int(idx) for idx in semantic_str.split(" ")]
+        phoneme_ids = cleaned_text_to_sequence(phoneme_data[item_name].split(" "), version)
+        path_bert = "%s/%s.pt" % (path3, item_name)
+        bert = torch.load(path_bert, map_location="cpu") if os.path.exists(path_bert) else None
+        writer.add(item_name, semantic_ids, phoneme_ids, bert)
+    except:
+        print(line[:100], traceback.format_exc())
+        num_skipped += 1
+writer.close()
+print("packed %s items, skipped %s" % (len(writer.names), num_skipped))
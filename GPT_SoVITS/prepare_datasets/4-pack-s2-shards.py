@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+### 可选步骤: 把5-wav32k/4-cnhubert/7-sv_cn打包进少量大shard文件(8-s2-shards),
+### s2训练时用mmap零拷贝读取, 不再每个epoch调用ffmpeg/torch.load小文件
+
+import os
+import sys
+import json
+
+opt_dir = os.environ.get("opt_dir")
+s2config_path = os.environ.get("s2config_path", "GPT_SoVITS/configs/s2.json")
+with_spec = eval(os.environ.get("with_spec", "False"))  # 预存线性谱(fp16), 体积约为wav的16倍
+with_wav24 = eval(os.environ.get("with_wav24", "False"))  # v3/v3b训练需要24k音频计算mel
+shard_size_mb = int(os.environ.get("shard_size_mb", "1024"))
+
+now_dir = os.getcwd()
+sys.path.append(now_dir)
+sys.path.append("%s/GPT_SoVITS" % (now_dir))
+
+import traceback
+import numpy as np
+import torch
+from scipy.io import wavfile
+from tqdm import tqdm
+
+from module.mel_processing import spectrogram_torch
+from module.packed_shards import FORMAT_VERSION, SHARD_DIR, PackedShardWriter, source_signature
+from tools.my_utils import load_audio
+
+with open(s2config_path, "r", encoding="utf8") as f:
+    data_config = json.load(f)["data"]
+sampling_rate = data_config["sampling_rate"]
+spec_params = [data_config["filter_length"], sampling_rate, data_config["hop_length"], data_config["win_length"]]
+
+path4 = "%s/4-cnhubert" % (opt_dir)
+path5 = "%s/5-wav32k" % (opt_dir)
+path7 = "%s/7-sv_cn" % (opt_dir)
+
+names = sorted(os.listdir(path5))
+### 打包前记录来源目录的签名, 之后重新预处理数据集会使shard失效
+meta = {"format": FORMAT_VERSION, "sources": source_signature(opt_dir), "sampling_rate": sampling_rate}
+if with_spec:
+    meta["spec"] = spec_params
+writer = PackedShardWriter("%s/%s" % (opt_dir, SHARD_DIR), shard_size_mb << 20, meta)
+
+for name in tqdm(names):
+    try:
+        sr, audio = wavfile.read("%s/%s" % (path5, name))
+        assert sr == sampling_rate and audio.dtype == np.int16, (name, sr, audio.dtype)
+        fields = {"wav_%s" % sampling_rate: audio}
+        if with_wav24:
+            audio24 = load_audio("%s/%s" % (path5, name), 24000)
+            fields["wav_24000"] = (np.clip(audio24, -1, 32767 / 32768) * 32768).astype(np.int16)
+        if with_spec:
+            audio_norm = torch.FloatTensor(audio.astype(np.float32) / 32768).unsqueeze(0)
+            spec = spectrogram_torch(audio_norm, *spec_params, center=False)
+            fields["spec"] = torch.squeeze(spec, 0).half()
+        if os.path.exists("%s/%s.pt" % (path4, name)):
+            fields["ssl"] = torch.load("%s/%s.pt" % (path4, name), map_location="cpu")
+        if os.path.exists("%s/%s.pt" % (path7, name)):
+            fields["sv_emb"] = torch.load("%s/%s.pt" % (path7, name), map_location="cpu")
+        writer.add(name, fields)
+    except:
+        print(name, traceback.format_exc())
+writer.close()
+print("packed %s items into %s shards" % (len(writer.items), writer.shard_id + 1))
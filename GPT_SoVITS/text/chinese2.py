@@ -36,6 +36,8 @@ if is_g2pw:
         model_source=os.environ.get("bert_path", "GPT_SoVITS/pretrained_models/chinese-roberta-wwm-ext-large"),
         v_to_u=False,
         neutral_tone_with_five=True,
+        batch_size=int(os.environ.get("g2pw_batch_size", "256")),
+        cache_size=int(os.environ.get("g2pw_cache_size", "100000")),
     )
 
 rep_map = {
@@ -77,6 +79,32 @@ def g2p(text):
     return phones, word2ph
 
 
+g2pw_prefetch_failed = False
+
+
+def g2pw_prefetch(texts):
+    """
+    对一批(未正则化的)中文文本预先批量跑g2pW, 之后逐条clean_text时g2pW结果直接命中缓存.
+    切句与去英文的方式须与g2p/_g2p保持一致, 否则只是缓存未命中, 不影响结果
+    """
+    if not is_g2pw:
+        return
+    pattern = r"(?<=[{0}])\s*".format("".join(punctuation))
+    segments = []
+    for text in texts:
+        for seg in re.split(pattern, text_normalize(text)):
+            if seg.strip() != "":
+                segments.append(re.sub("[a-zA-Z]+", "", seg))
+    global g2pw_prefetch_failed
+    try:
+        g2pw.prefetch(segments)
+    except Exception:
+        ### 预取失败不影响之后的逐句推理(只是缓存不命中), 只报告第一次, 避免刷屏
+        if not g2pw_prefetch_failed:
+            g2pw_prefetch_failed = True
+            logging.exception("g2pW prefetch failed, falling back to per-sentence prediction")
+
+
 def _get_initials_finals(word):
     initials = []
     finals = []
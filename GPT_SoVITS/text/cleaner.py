@@ -18,15 +18,25 @@ special = [
 ]
 
 
+def get_language_module_map(version):
+    if version == "v1":
+        return {"zh": "chinese", "ja": "japanese", "en": "english"}
+    return {"zh": "chinese2", "ja": "japanese", "en": "english", "ko": "korean", "yue": "cantonese"}
+
+
+def load_language_module(language, version=None):
+    ### 各语言前端(jieba/g2pW/CMU词典等)在第一次用到时才导入, 也可提前在后台线程调用以预热
+    if version is None:
+        version = os.environ.get("version", "v2")
+    module_name = get_language_module_map(version)[language]
+    return __import__("text." + module_name, fromlist=[module_name])
+
+
 def clean_text(text, language, version=None):
     if version is None:
         version = os.environ.get("version", "v2")
-    if version == "v1":
-        symbols = symbols_v1.symbols
-        language_module_map = {"zh": "chinese", "ja": "japanese", "en": "english"}
-    else:
-        symbols = symbols_v2.symbols
-        language_module_map = {"zh": "chinese2", "ja": "japanese", "en": "english", "ko": "korean", "yue": "cantonese"}
+    symbols = symbols_v1.symbols if version == "v1" else symbols_v2.symbols
+    language_module_map = get_language_module_map(version)
 
     if language not in language_module_map:
         language = "en"
@@ -34,7 +44,7 @@ def clean_text(text, language, version=None):
     for special_s, special_l, target_symbol in special:
         if special_s in text and language == special_l:
             return clean_special(text, language, special_s, target_symbol, version)
-    language_module = __import__("text." + language_module_map[language], fromlist=[language_module_map[language]])
+    language_module = load_language_module(language, version)
     if hasattr(language_module, "text_normalize"):
         norm_text = language_module.text_normalize(text)
     else:
@@ -58,18 +68,14 @@ def clean_text(text, language, version=None):
 def clean_special(text, language, special_s, target_symbol, version=None):
     if version is None:
         version = os.environ.get("version", "v2")
-    if version == "v1":
-        symbols = symbols_v1.symbols
-        language_module_map = {"zh": "chinese", "ja": "japanese", "en": "english"}
-    else:
-        symbols = symbols_v2.symbols
-        language_module_map = {"zh": "chinese2", "ja": "japanese", "en": "english", "ko": "korean", "yue": "cantonese"}
+    symbols = symbols_v1.symbols if version == "v1" else symbols_v2.symbols
+    language_module_map = get_language_module_map(version)
 
     """
     特殊静音段sp符号处理
     """
     text = text.replace(special_s, ",")
-    language_module = __import__("text." + language_module_map[language], fromlist=[language_module_map[language]])
+    language_module = load_language_module(language, version)
     norm_text = language_module.text_normalize(text)
     phones = language_module.g2p(norm_text)
     new_ph = []
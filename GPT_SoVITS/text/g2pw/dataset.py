@@ -48,16 +48,20 @@ def prepare_onnx_input(
     phoneme_masks = []
     char_ids = []
     position_ids = []
+    # 同一句中的多个多音字共用一次分词结果
+    tokenized = {}
 
     for idx in range(len(texts)):
         text = (truncated_texts if window_size else texts)[idx].lower()
         query_id = (truncated_query_ids if window_size else query_ids)[idx]
 
-        try:
-            tokens, text2token, token2text = tokenize_and_map(tokenizer=tokenizer, text=text)
-        except Exception:
-            print(f'warning: text "{text}" is invalid')
-            return {}
+        if text not in tokenized:
+            try:
+                tokenized[text] = tokenize_and_map(tokenizer=tokenizer, text=text)
+            except Exception:
+                print(f'warning: text "{text}" is invalid')
+                return {}
+        tokens, text2token, token2text = tokenized[text]
 
         text, query_id, tokens, text2token, token2text = _truncate(
             max_len=max_len, text=text, query_id=query_id, tokens=tokens, text2token=text2token, token2text=token2text
@@ -83,6 +87,12 @@ def prepare_onnx_input(
         char_ids.append(char_id)
         position_ids.append(position_id)
 
+    # 不同句子长度不同, 补齐到batch内最长(attention_mask为0, 不影响结果)
+    max_len = max(len(input_id) for input_id in input_ids)
+    for seqs in (input_ids, token_type_ids, attention_masks):
+        for seq in seqs:
+            seq.extend([0] * (max_len - len(seq)))
+
     outputs = {
         "input_ids": np.array(input_ids).astype(np.int64),
         "token_type_ids": np.array(token_type_ids).astype(np.int64),
@@ -25,6 +25,8 @@ class G2PWPinyin(Pinyin):
         v_to_u=False,
         neutral_tone_with_five=False,
         tone_sandhi=False,
+        batch_size=256,
+        cache_size=100000,
         **kwargs,
     ):
         self._g2pw = G2PWOnnxConverter(
@@ -32,6 +34,8 @@ class G2PWPinyin(Pinyin):
             style="pinyin",
             model_source=model_source,
             enable_non_tradional_chinese=enable_non_tradional_chinese,
+            batch_size=batch_size,
+            cache_size=cache_size,
         )
         self._converter = Converter(
             self._g2pw,
@@ -43,6 +47,15 @@ class G2PWPinyin(Pinyin):
     def get_seg(self, **kwargs):
         return simple_seg
 
+    def prefetch(self, texts):
+        """
+        把多段文本中所有的汉字片段一次性送进g2pW(按batch_size分批), 结果写入缓存,
+        之后对这些文本逐句调用lazy_pinyin时直接命中缓存, 不再逐句跑onnx
+        """
+        hans = [words for text in texts for words in simple_seg(text) if RE_HANS.match(words)]
+        if len(hans) > 0:
+            self._g2pw(hans)
+
 
 class Converter(UltimateConverter):
     def __init__(self, g2pw_instance, v_to_u=False, neutral_tone_with_five=False, tone_sandhi=False, **kwargs):
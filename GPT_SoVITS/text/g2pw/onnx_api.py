@@ -3,8 +3,10 @@
 
 import json
 import os
+import threading
 import warnings
 import zipfile
+from collections import OrderedDict
 from typing import Any, Dict, List, Tuple
 
 import numpy as np
@@ -31,8 +33,6 @@ model_version = "1.1"
 
 
 def predict(session, onnx_input: Dict[str, Any], labels: List[str]) -> Tuple[List[str], List[float]]:
-    all_preds = []
-    all_confidences = []
     probs = session.run(
         [],
         {
@@ -45,14 +45,10 @@ def predict(session, onnx_input: Dict[str, Any], labels: List[str]) -> Tuple[Lis
         },
     )[0]
 
-    preds = np.argmax(probs, axis=1).tolist()
-    max_probs = []
-    for index, arr in zip(preds, probs.tolist()):
-        max_probs.append(arr[index])
-    all_preds += [labels[pred] for pred in preds]
-    all_confidences += max_probs
+    preds = np.argmax(probs, axis=1)
+    max_probs = probs[np.arange(len(preds)), preds]
 
-    return all_preds, all_confidences
+    return [labels[pred] for pred in preds.tolist()], max_probs.tolist()
 
 
 def download_and_decompress(model_dir: str = "G2PWModel/"):
@@ -86,8 +82,16 @@ class G2PWOnnxConverter:
         style: str = "bopomofo",
         model_source: str = None,
         enable_non_tradional_chinese: bool = False,
+        batch_size: int = 256,
+        cache_size: int = 100000,
     ):
         uncompress_path = download_and_decompress(model_dir)
+        # 每次送进onnx的多音字(行)数上限
+        self.batch_size = max(1, batch_size)
+        # (句子, 多音字位置) -> 预测结果 的LRU缓存, cache_size <= 0 时关闭
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[Tuple[str, int], str]" = OrderedDict()
+        self._cache_lock = threading.Lock()
 
         sess_options = onnxruntime.SessionOptions()
         sess_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
@@ -202,27 +206,64 @@ class G2PWOnnxConverter:
             # sentences no polyphonic words
             return partial_results
 
-        onnx_input = prepare_onnx_input(
-            tokenizer=self.tokenizer,
-            labels=self.labels,
-            char2phonemes=self.char2phonemes,
-            chars=self.chars,
-            texts=texts,
-            query_ids=query_ids,
-            use_mask=self.config.use_mask,
-            window_size=None,
-        )
-
-        preds, confidences = predict(session=self.session_g2pW, onnx_input=onnx_input, labels=self.labels)
-        if self.config.use_char_phoneme:
-            preds = [pred.split(" ")[1] for pred in preds]
+        keys = list(zip(texts, query_ids))
+        preds = self._predict_cached(keys)
 
         results = partial_results
-        for sent_id, query_id, pred in zip(sent_ids, query_ids, preds):
-            results[sent_id][query_id] = self.style_convert_func(pred)
+        for sent_id, query_id, key in zip(sent_ids, query_ids, keys):
+            results[sent_id][query_id] = preds[key]
 
         return results
 
+    def _predict_cached(self, keys: List[Tuple[str, int]]) -> Dict[Tuple[str, int], str]:
+        """
+        Predict every (sentence, polyphonic char position) in keys. Cached entries are reused and
+        the misses of all sentences go through onnx together, in batches of at most batch_size rows.
+        """
+        preds = {}
+        misses = []
+        with self._cache_lock:
+            for key in keys:
+                if key in preds:
+                    continue
+                if key in self._cache:
+                    self._cache.move_to_end(key)
+                    preds[key] = self._cache[key]
+                else:
+                    preds[key] = None
+                    misses.append(key)
+        if len(misses) == 0:
+            return preds
+
+        # 按句长排序, 减少batch内的padding
+        misses.sort(key=lambda key: len(key[0]))
+        for start in range(0, len(misses), self.batch_size):
+            batch = misses[start : start + self.batch_size]
+            onnx_input = prepare_onnx_input(
+                tokenizer=self.tokenizer,
+                labels=self.labels,
+                char2phonemes=self.char2phonemes,
+                chars=self.chars,
+                texts=[text for text, _ in batch],
+                query_ids=[query_id for _, query_id in batch],
+                use_mask=self.config.use_mask,
+                window_size=None,
+            )
+            batch_preds, confidences = predict(session=self.session_g2pW, onnx_input=onnx_input, labels=self.labels)
+            if self.config.use_char_phoneme:
+                batch_preds = [pred.split(" ")[1] for pred in batch_preds]
+            for key, pred in zip(batch, batch_preds):
+                preds[key] = self.style_convert_func(pred)
+
+        if self.cache_size > 0:
+            with self._cache_lock:
+                for key in misses:
+                    self._cache[key] = preds[key]
+                    self._cache.move_to_end(key)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return preds
+
     def _prepare_data(self, sentences: List[str]) -> Tuple[List[str], List[int], List[int], List[List[str]]]:
         texts, query_ids, sent_ids, partial_results = [], [], [], []
         for sent_id, sent in enumerate(sentences):
@@ -163,6 +163,7 @@ from transformers import AutoModelForMaskedLM, AutoTokenizer
 import numpy as np
 from feature_extractor import cnhubert
 from io import BytesIO
+from tools.stream_encoder import StreamingAudioEncoder
 from module.models import Generator, SynthesizerTrn, SynthesizerTrnV3
 from peft import LoraConfig, get_peft_model
 from AR.models.t2s_lightning_module import Text2SemanticLightningModule
@@ -375,7 +376,7 @@ class Sovits:
         self.hps = hps
 
 
-from process_ckpt import get_sovits_version_from_path_fast, load_sovits_new
+from process_ckpt import get_sovits_version_from_path_fast, load_gpt_weights, load_sovits_new
 
 
 def get_sovits_weights(sovits_path):
@@ -475,7 +476,7 @@ hz = 50
 
 
 def get_gpt_weights(gpt_path):
-    dict_s1 = torch.load(gpt_path, map_location="cpu", weights_only=False)
+    dict_s1 = load_gpt_weights(gpt_path)
     config = dict_s1["config"]
     max_sec = config["data"]["max_sec"]
     t2s_model = Text2SemanticLightningModule(config, "****", is_train=False)
@@ -905,6 +906,8 @@ def get_tts_wav(
                 refers = [refers]
                 if is_v2pro:
                     sv_emb = [sv_cn_model.compute_embedding3(audio_tensor)]
+            ### 说话人全局条件ge只与参考有关, 每个请求只算一次, 各行复用
+            ge = vq_model.get_ge(refers, sv_emb if is_v2pro else None)
         else:
             refer, audio_tensor = get_spepc(hps, ref_wav_path, dtype, device)
 
@@ -915,6 +918,8 @@ def get_tts_wav(
     phones1, bert1, norm_text1 = get_phones_and_bert(prompt_text, prompt_language, version)
     texts = text.split("\n")
     audio_bytes = BytesIO()
+    ### ogg/aac在整个请求内共用一个编码器(一个容器/一个ffmpeg进程), 首句产出后按采样率创建
+    encoder = None
 
     for text in texts:
         # 简单防止纯符号引发参考音频泄露
@@ -947,28 +952,14 @@ def get_tts_wav(
         t3 = ttime()
 
         if version not in {"v3", "v4"}:
-            if is_v2pro:
-                audio = (
-                    vq_model.decode(
-                        pred_semantic,
-                        torch.LongTensor(phones2).to(device).unsqueeze(0),
-                        refers,
-                        speed=speed,
-                        sv_emb=sv_emb,
-                    )
-                    .detach()
-                    .cpu()
-                    .numpy()[0, 0]
-                )
-            else:
-                audio = (
-                    vq_model.decode(
-                        pred_semantic, torch.LongTensor(phones2).to(device).unsqueeze(0), refers, speed=speed
-                    )
-                    .detach()
-                    .cpu()
-                    .numpy()[0, 0]
+            audio = (
+                vq_model.decode(
+                    pred_semantic, torch.LongTensor(phones2).to(device).unsqueeze(0), refers, speed=speed, ge=ge
                 )
+                .detach()
+                .cpu()
+                .numpy()[0, 0]
+            )
         else:
             phoneme_ids0 = torch.LongTensor(phones1).to(device).unsqueeze(0)
             phoneme_ids1 = torch.LongTensor(phones2).to(device).unsqueeze(0)
@@ -1048,14 +1039,26 @@ def get_tts_wav(
             sr = 48000
 
         if is_int32:
-            audio_bytes = pack_audio(audio_bytes, (audio_opt * 2147483647).astype(np.int32), sr)
+            audio_opt = (audio_opt * 2147483647).astype(np.int32)
+        else:
+            audio_opt = (audio_opt * 32768).astype(np.int16)
+        if media_type in ["ogg", "aac"]:
+            if encoder is None:
+                encoder = StreamingAudioEncoder(media_type, sr, aac_bit_rate="256k" if is_int32 else "128k")
+            audio_bytes.write(encoder.feed(audio_opt))
         else:
-            audio_bytes = pack_audio(audio_bytes, (audio_opt * 32768).astype(np.int16), sr)
+            audio_bytes = pack_audio(audio_bytes, audio_opt, sr)
         # logger.info("%.3f\t%.3f\t%.3f\t%.3f" % (t1 - t0, t2 - t1, t3 - t2, t4 - t3))
         if stream_mode == "normal":
             audio_bytes, audio_chunk = read_clean_buffer(audio_bytes)
             yield audio_chunk
 
+    if encoder is not None:
+        audio_bytes.write(encoder.close())
+        if stream_mode == "normal":
+            audio_bytes, audio_chunk = read_clean_buffer(audio_bytes)
+            yield audio_chunk
+
     if not stream_mode == "normal":
         if media_type == "wav":
             if version in {"v1", "v2", "v2Pro", "v2ProPlus"}:
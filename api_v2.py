@@ -7,6 +7,8 @@
     `-a` - `绑定地址, 默认"127.0.0.1"`
     `-p` - `绑定端口, 默认9880`
     `-c` - `TTS配置文件路径, 默认"GPT_SoVITS/configs/tts_infer.yaml"`
+    `-w` - `推理线程数, 每个线程持有独立的TTS实例(开启continuous_batching时共享同一实例), 默认1`
+    `-q` - `最大排队请求数, 队列已满时返回503, 默认16`
 
 ## 调用:
 
@@ -40,13 +42,19 @@ POST:
     "parallel_infer": True,       # bool. whether to use parallel inference.
     "repetition_penalty": 1.35,   # float. repetition penalty for T2S model.
     "sample_steps": 32,           # int. number of sampling steps for VITS model V3.
-    "super_sampling": False       # bool. whether to use super-sampling for audio when using VITS model V3.
+    "super_sampling": False,      # bool. whether to use super-sampling for audio when using VITS model V3.
+    "token_streaming": False,     # bool. vocode semantic tokens while T2S is still decoding, implies streaming_mode.
+    "min_chunk_length": 16,       # int. number of semantic tokens per chunk in token streaming mode.
+    "overlap_length": 2,          # int. number of semantic tokens shared by adjacent chunks in token streaming mode.
+    "t2s_weights_path": None,     # str.(optional) GPT weights to use for this request, resident models are switched without reloading.
+    "vits_weights_path": None     # str.(optional) SoVITS weights to use for this request, resident models are switched without reloading.
 }
 ```
 
 RESP:
 成功: 直接返回 wav 音频流， http code 200
 失败: 返回包含错误信息的 json, http code 400
+排队请求过多: 返回包含错误信息的 json, http code 503
 
 ### 命令控制
 
@@ -98,10 +106,13 @@ RESP:
 
 """
 
+import asyncio
 import os
 import sys
+import threading
 import traceback
-from typing import Generator
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
 
 now_dir = os.getcwd()
 sys.path.append(now_dir)
@@ -114,11 +125,13 @@ import signal
 import numpy as np
 import soundfile as sf
 from fastapi import FastAPI, Response
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import StreamingResponse, JSONResponse
 import uvicorn
 from io import BytesIO
 from tools.i18n.i18n import I18nAuto
-from GPT_SoVITS.TTS_infer_pack.TTS import TTS, TTS_Config
+from tools.stream_encoder import StreamingAudioEncoder
+from GPT_SoVITS.TTS_infer_pack.TTS import TTS, RequestContext, TTS_Config
 from GPT_SoVITS.TTS_infer_pack.text_segmentation_method import get_method_names as get_cut_method_names
 from pydantic import BaseModel
 
@@ -137,6 +150,8 @@ parser = argparse.ArgumentParser(description="GPT-SoVITS api")
 parser.add_argument("-c", "--tts_config", type=str, default="GPT_SoVITS/configs/tts_infer.yaml", help="tts_infer路径")
 parser.add_argument("-a", "--bind_addr", type=str, default="0.0.0.0", help="default: 0.0.0.0")
 parser.add_argument("-p", "--port", type=int, default="9880", help="default: 9880")
+parser.add_argument("-w", "--workers", type=int, default=1, help="推理线程数, default: 1")
+parser.add_argument("-q", "--max_queue_size", type=int, default=16, help="最大排队请求数, default: 16")
 args = parser.parse_args()
 config_path = args.tts_config
 # device = args.device
@@ -197,9 +212,116 @@ tts_config = TTS_Config(config_path)
 print(tts_config)
 tts_pipeline = TTS(tts_config)
 
+_JOB_END = object()
+
+
+class TTSJob:
+    """
+    One /tts request, queued or running on a worker thread.
+    Results are handed from the worker thread to the event loop through an asyncio.Queue.
+    """
+
+    def __init__(self, req: dict, loop: asyncio.AbstractEventLoop):
+        self.req = req
+        self.loop = loop
+        self.results: asyncio.Queue = asyncio.Queue()
+        self.cancelled = threading.Event()
+        ### 只停止本请求, 共用TTS实例(连续批处理)时也会撤下本请求在调度器中的行
+        self.context = RequestContext()
+
+    def push(self, item):
+        self.loop.call_soon_threadsafe(self.results.put_nowait, item)
+
+    def cancel(self):
+        self.cancelled.set()
+        self.context.stop()
+
+    async def stream(self):
+        """
+        Async iterator over the (sr, audio) chunks of the job. Closing it cancels the job.
+        """
+        try:
+            while True:
+                item = await self.results.get()
+                if item is _JOB_END:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            self.cancel()
+
+
+class TTSWorkerPool:
+    """
+    Runs `TTS.run` on dedicated worker threads so that inference never blocks the event loop.
+    Waiting jobs are kept in a bounded asyncio.Queue, `submit` raises asyncio.QueueFull when it is full.
+    """
+
+    def __init__(self, pipelines: List[TTS], num_workers: int = 1, max_queue_size: int = 16):
+        self.pipelines = pipelines
+        self.num_workers = max(1, num_workers)
+        self.max_queue_size = max(1, max_queue_size)
+        self.executor = ThreadPoolExecutor(max_workers=self.num_workers, thread_name_prefix="tts_worker")
+        self.jobs: asyncio.Queue = None
+        self.tasks = []
+
+    def start(self):
+        self.jobs = asyncio.Queue(maxsize=self.max_queue_size)
+        for i in range(self.num_workers):
+            self.tasks.append(asyncio.create_task(self._worker(self.pipelines[i % len(self.pipelines)])))
+
+    def submit(self, req: dict) -> TTSJob:
+        job = TTSJob(req, asyncio.get_running_loop())
+        self.jobs.put_nowait(job)
+        return job
+
+    async def _worker(self, pipeline: TTS):
+        loop = asyncio.get_running_loop()
+        while True:
+            job = await self.jobs.get()
+            try:
+                if not job.cancelled.is_set():
+                    await loop.run_in_executor(self.executor, self._run, pipeline, job)
+                else:
+                    job.push(_JOB_END)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                self.jobs.task_done()
+
+    def _run(self, pipeline: TTS, job: TTSJob):
+        tts_generator = pipeline.run(job.req, job.context)
+        try:
+            for item in tts_generator:
+                if job.cancelled.is_set():
+                    break
+                job.push(item)
+        except Exception as e:
+            job.push(e)
+        finally:
+            tts_generator.close()
+            job.push(_JOB_END)
+
+
+if tts_config.continuous_batching:
+    ### 连续批处理需要所有请求共用同一个T2S调度器
+    tts_pipelines = [tts_pipeline]
+else:
+    tts_pipelines = [tts_pipeline] + [TTS(TTS_Config(config_path)) for _ in range(max(1, args.workers) - 1)]
+    ### 各worker共用一个CFM调度器, 不同请求的v3/v4合成块才能合并进同一批(按权重路径分组, 各worker的模型副本权重相同)
+    for pipeline in tts_pipelines[1:]:
+        pipeline.cfm_scheduler = tts_pipeline.cfm_scheduler
+tts_pool = TTSWorkerPool(tts_pipelines, num_workers=args.workers, max_queue_size=args.max_queue_size)
+
 APP = FastAPI()
 
 
+@APP.on_event("startup")
+async def start_tts_pool():
+    tts_pool.start()
+
+
 class TTS_Request(BaseModel):
     text: str = None
     text_lang: str = None
@@ -223,6 +345,11 @@ class TTS_Request(BaseModel):
     repetition_penalty: float = 1.35
     sample_steps: int = 32
     super_sampling: bool = False
+    token_streaming: bool = False
+    min_chunk_length: int = 16
+    overlap_length: int = 2
+    t2s_weights_path: str = None
+    vits_weights_path: str = None
 
 
 ### modify from https://github.com/RVC-Boss/GPT-SoVITS/pull/894/files
@@ -375,6 +502,11 @@ def check_params(req: dict):
             status_code=400, content={"message": f"text_split_method:{text_split_method} is not supported"}
         )
 
+    for key in ["t2s_weights_path", "vits_weights_path"]:
+        weights_path = req.get(key, None)
+        if weights_path not in [None, ""] and not os.path.exists(weights_path):
+            return JSONResponse(status_code=400, content={"message": f"{key}: {weights_path} not exists"})
+
     return None
 
 
@@ -407,11 +539,18 @@ async def tts_handle(req: dict):
                 "repetition_penalty": 1.35    # float.(optional) repetition penalty for T2S model.
                 "sample_steps": 32,           # int. number of sampling steps for VITS model V3.
                 "super_sampling": False,       # bool. whether to use super-sampling for audio when using VITS model V3.
+                "token_streaming": False,     # bool. vocode semantic tokens while T2S is still decoding, implies streaming_mode.
+                "min_chunk_length": 16,       # int. number of semantic tokens per chunk in token streaming mode.
+                "overlap_length": 2,          # int. number of semantic tokens shared by adjacent chunks in token streaming mode.
+                "t2s_weights_path": None,     # str.(optional) GPT weights to use for this request.
+                "vits_weights_path": None,    # str.(optional) SoVITS weights to use for this request.
             }
     returns:
         StreamingResponse: audio stream response.
     """
 
+    if req.get("token_streaming", False):
+        req["streaming_mode"] = True
     streaming_mode = req.get("streaming_mode", False)
     return_fragment = req.get("return_fragment", False)
     media_type = req.get("media_type", "wav")
@@ -424,33 +563,50 @@ async def tts_handle(req: dict):
         req["return_fragment"] = True
 
     try:
-        tts_generator = tts_pipeline.run(req)
+        job = tts_pool.submit(req)
+    except asyncio.QueueFull:
+        return JSONResponse(status_code=503, content={"message": "server is busy, please try again later"})
 
+    try:
         if streaming_mode:
 
-            def streaming_generator(tts_generator: Generator, media_type: str):
-                if_frist_chunk = True
-                for sr, chunk in tts_generator:
-                    if if_frist_chunk and media_type == "wav":
-                        yield wave_header_chunk(sample_rate=sr)
-                        media_type = "raw"
-                        if_frist_chunk = False
-                    yield pack_audio(BytesIO(), chunk, sr, media_type).getvalue()
+            async def streaming_generator(job: TTSJob, media_type: str):
+                ### 整个响应共用一个编码器: ogg/aac输出为单个合法的流, aac也不必每个分片都启动一次ffmpeg
+                encoder = None
+                try:
+                    async for sr, chunk in job.stream():
+                        if encoder is None:
+                            encoder = StreamingAudioEncoder(media_type, sr)
+                        data = await run_in_threadpool(encoder.feed, chunk)
+                        if data:
+                            yield data
+                    if encoder is not None:
+                        data = await run_in_threadpool(encoder.close)
+                        if data:
+                            yield data
+                finally:
+                    if encoder is not None:
+                        encoder.abort()
 
             # _media_type = f"audio/{media_type}" if not (streaming_mode and media_type in ["wav", "raw"]) else f"audio/x-{media_type}"
             return StreamingResponse(
                 streaming_generator(
-                    tts_generator,
+                    job,
                     media_type,
                 ),
                 media_type=f"audio/{media_type}",
             )
 
         else:
-            sr, audio_data = next(tts_generator)
-            audio_data = pack_audio(BytesIO(), audio_data, sr, media_type).getvalue()
+            results = job.stream()
+            try:
+                sr, audio_data = await results.__anext__()
+            finally:
+                await results.aclose()
+            audio_data = (await run_in_threadpool(pack_audio, BytesIO(), audio_data, sr, media_type)).getvalue()
             return Response(audio_data, media_type=f"audio/{media_type}")
     except Exception as e:
+        job.cancel()
         return JSONResponse(status_code=400, content={"message": "tts failed", "Exception": str(e)})
 
 
@@ -485,6 +641,11 @@ async def tts_get_endpoint(
     repetition_penalty: float = 1.35,
     sample_steps: int = 32,
     super_sampling: bool = False,
+    token_streaming: bool = False,
+    min_chunk_length: int = 16,
+    overlap_length: int = 2,
+    t2s_weights_path: str = None,
+    vits_weights_path: str = None,
 ):
     req = {
         "text": text,
@@ -509,6 +670,11 @@ async def tts_get_endpoint(
         "repetition_penalty": float(repetition_penalty),
         "sample_steps": int(sample_steps),
         "super_sampling": super_sampling,
+        "token_streaming": token_streaming,
+        "min_chunk_length": int(min_chunk_length),
+        "overlap_length": int(overlap_length),
+        "t2s_weights_path": t2s_weights_path,
+        "vits_weights_path": vits_weights_path,
     }
     return await tts_handle(req)
 
@@ -522,7 +688,8 @@ async def tts_post_endpoint(request: TTS_Request):
 @APP.get("/set_refer_audio")
 async def set_refer_aduio(refer_audio_path: str = None):
     try:
-        tts_pipeline.set_ref_audio(refer_audio_path)
+        for pipeline in tts_pipelines:
+            await run_in_threadpool(pipeline.set_ref_audio, refer_audio_path)
     except Exception as e:
         return JSONResponse(status_code=400, content={"message": "set refer audio failed", "Exception": str(e)})
     return JSONResponse(status_code=200, content={"message": "success"})
@@ -552,7 +719,8 @@ async def set_gpt_weights(weights_path: str = None):
     try:
         if weights_path in ["", None]:
             return JSONResponse(status_code=400, content={"message": "gpt weight path is required"})
-        tts_pipeline.init_t2s_weights(weights_path)
+        for pipeline in tts_pipelines:
+            await run_in_threadpool(pipeline.set_active_models, t2s_weights_path=weights_path)
     except Exception as e:
         return JSONResponse(status_code=400, content={"message": "change gpt weight failed", "Exception": str(e)})
 
@@ -564,7 +732,8 @@ async def set_sovits_weights(weights_path: str = None):
     try:
         if weights_path in ["", None]:
             return JSONResponse(status_code=400, content={"message": "sovits weight path is required"})
-        tts_pipeline.init_vits_weights(weights_path)
+        for pipeline in tts_pipelines:
+            await run_in_threadpool(pipeline.set_active_models, vits_weights_path=weights_path)
     except Exception as e:
         return JSONResponse(status_code=400, content={"message": "change sovits weight failed", "Exception": str(e)})
     return JSONResponse(status_code=200, content={"message": "success"})
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+测试.safetensors格式的GPT权重
+由.ckpt转换得到的.safetensors经TTS._load_t2s_weights加载后, T2S推理路径(t2s_transformer)的logits应与.ckpt一致
+"""
+
+import os
+import sys
+import tempfile
+from types import SimpleNamespace
+
+now_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(now_dir)
+sys.path.append("%s/GPT_SoVITS" % (now_dir))
+
+import torch
+
+from AR.models.t2s_lightning_module import Text2SemanticLightningModule
+from process_ckpt import MMAP_SUFFIX, save_mmap_checkpoint
+from TTS_infer_pack.TTS import TTS
+
+config = {
+    "data": {"max_sec": 54},
+    "model": {
+        "vocab_size": 1025,
+        "phoneme_vocab_size": 732,
+        "embedding_dim": 64,
+        "hidden_dim": 64,
+        "head": 4,
+        "linear_units": 256,
+        "n_layer": 2,
+        "dropout": 0,
+        "EOS": 1024,
+    },
+}
+
+
+def load_t2s(weights_path):
+    fake_tts = SimpleNamespace(
+        configs=SimpleNamespace(device="cpu", is_half=False, int8_tolerance=0.0),
+        use_cpu_fast=False,
+    )
+    return TTS._load_t2s_weights(fake_tts, weights_path)["t2s_model"].model
+
+
+def t2s_logits(model, x):
+    seq_len = x.shape[1]
+    attn_mask = torch.triu(torch.ones(seq_len, seq_len, dtype=torch.bool), diagonal=1)[None, None]
+    with torch.no_grad():
+        xy_dec, _, _ = model.t2s_transformer.process_prompt(x, attn_mask, None)
+        return model.ar_predict_layer(xy_dec)
+
+
+def test_gpt_mmap_weights():
+    torch.manual_seed(0)
+    source = Text2SemanticLightningModule(config, "****", is_train=False)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        ckpt_path = os.path.join(tmp_dir, "gpt.ckpt")
+        mmap_path = os.path.join(tmp_dir, "gpt" + MMAP_SUFFIX)
+        ckpt = {"weight": source.state_dict(), "config": config, "info": "test"}
+        torch.save(ckpt, ckpt_path)
+        save_mmap_checkpoint(ckpt, mmap_path, {"kind": "gpt"})
+
+        # 两次加载之间打乱随机数, 确保比较的是加载的权重而不是相同的随机初始化
+        torch.manual_seed(1)
+        ckpt_model = load_t2s(ckpt_path)
+        torch.manual_seed(2)
+        mmap_model = load_t2s(mmap_path)
+
+    x = torch.randn(1, 12, config["model"]["hidden_dim"])
+    expected = t2s_logits(ckpt_model, x)
+    logits = t2s_logits(mmap_model, x)
+    assert torch.equal(logits, expected), (logits - expected).abs().max()
+    print("[Success] .safetensors GPT weights match .ckpt")
+
+
+if __name__ == "__main__":
+    test_gpt_mmap_weights()
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""
+测试批量语义token提取
+extract_latent_batched的结果应与逐条vq_model.extract_latent(...)[0, 0]完全一致
+"""
+
+import os
+import sys
+
+now_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(now_dir)
+sys.path.append("%s/GPT_SoVITS" % (now_dir))
+
+import torch
+from torch import nn
+
+from feature_extractor.batching import extract_latent_batched
+from module.models import SynthesizerTrn
+from module.quantize import ResidualVectorQuantizer
+
+
+class VQModel(nn.Module):
+    """只保留SynthesizerTrn.extract_latent用到的ssl_proj与quantizer"""
+
+    extract_latent = SynthesizerTrn.extract_latent
+
+    def __init__(self, semantic_frame_rate):
+        super().__init__()
+        if semantic_frame_rate == "25hz":
+            self.ssl_proj = nn.Conv1d(768, 768, 2, stride=2)
+        else:
+            self.ssl_proj = nn.Conv1d(768, 768, 1, stride=1)
+        self.quantizer = ResidualVectorQuantizer(dimension=768, n_q=1, bins=1024, kmeans_init=False)
+
+
+def test_extract_latent_batched():
+    torch.manual_seed(0)
+    for semantic_frame_rate in ["25hz", "50hz"]:
+        vq_model = VQModel(semantic_frame_rate).eval()
+        ssl_list = [torch.randn(1, 768, length) for length in [101, 100, 87, 64, 3]]
+        codes = extract_latent_batched(vq_model, ssl_list)
+        assert len(codes) == len(ssl_list)
+        with torch.no_grad():
+            for ssl, code in zip(ssl_list, codes):
+                expected = vq_model.extract_latent(ssl)[0, 0]
+                assert code.shape == expected.shape, (semantic_frame_rate, code.shape, expected.shape)
+                assert torch.equal(code, expected), semantic_frame_rate
+        print(f"[Success] extract_latent_batched {semantic_frame_rate}")
+
+
+if __name__ == "__main__":
+    test_extract_latent_batched()
@@ -0,0 +1,170 @@
+### 流式响应用的持久编码器: 整个响应只建一个ogg容器/一个ffmpeg进程, 逐句喂PCM, 随时取出已编码的字节
+import subprocess
+import threading
+import time
+import wave
+from io import BytesIO
+
+import numpy as np
+import soundfile as sf
+
+OGG_BLOCK_FRAMES = 32768
+AAC_SETTLE_SECONDS = 0.05
+AAC_MAX_WAIT_SECONDS = 0.5
+
+
+def wave_header(channels=1, sample_width=2, sample_rate=32000):
+    ### 帧数为0的wav头, 后面直接接raw PCM(长度未知的流式wav)
+    wav_buf = BytesIO()
+    with wave.open(wav_buf, "wb") as vfout:
+        vfout.setnchannels(channels)
+        vfout.setsampwidth(sample_width)
+        vfout.setframerate(sample_rate)
+        vfout.writeframes(b"")
+    return wav_buf.getvalue()
+
+
+def _drain_pipe(stdout, pending: list, cond: threading.Condition):
+    while True:
+        data = stdout.read1(65536)
+        if not data:
+            break
+        with cond:
+            pending.append(data)
+            cond.notify_all()
+
+
+class StreamingAudioEncoder:
+    """
+    Encoder that lives for a whole (streamed) response.
+
+    feed(pcm) returns the bytes that are ready so far, close() flushes the encoder and returns the rest;
+    the concatenation of all returned bytes is one valid ogg/aac/wav stream.
+    media_type: ogg (libsndfile vorbis, in process), aac (one ffmpeg pipe, ADTS), wav (header + raw PCM), raw.
+    pcm must be int16 or int32 mono.
+    """
+
+    def __init__(self, media_type: str, rate: int, aac_bit_rate: str = "192k"):
+        self.media_type = media_type
+        self.rate = rate
+        self.aac_bit_rate = aac_bit_rate
+        self.closed = False
+        self.header_sent = False
+
+        self.sound_file = None
+        self.ogg_buffer = None
+        self.ogg_sent = 0
+
+        self.process = None
+        self.reader = None
+        self.pending = []
+        self.cond = threading.Condition()
+
+    def _open_ogg(self):
+        ### ogg页只会追加写, 已发出的字节不会被libsndfile回写, 因此只需记录发送位置
+        self.ogg_buffer = BytesIO()
+        self.sound_file = sf.SoundFile(self.ogg_buffer, mode="w", samplerate=self.rate, channels=1, format="ogg")
+
+    def _open_aac(self, dtype):
+        pcm = "s32le" if dtype == np.int32 else "s16le"
+        self.process = subprocess.Popen(
+            [
+                "ffmpeg",
+                "-loglevel",
+                "error",
+                "-f",
+                pcm,  # 输入有符号小端整数PCM
+                "-ar",
+                str(self.rate),  # 设置采样率
+                "-ac",
+                "1",  # 单声道
+                "-i",
+                "pipe:0",  # 从管道读取输入
+                "-c:a",
+                "aac",  # 音频编码器为AAC
+                "-b:a",
+                self.aac_bit_rate,  # 比特率
+                "-vn",  # 不包含视频
+                "-flush_packets",
+                "1",  # 每个包编码完立即写出, 不在ffmpeg内攒缓冲
+                "-f",
+                "adts",  # 输出AAC数据流格式
+                "pipe:1",  # 将输出写入管道
+            ],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+        ### 后台线程持续读stdout, 避免管道写满后ffmpeg阻塞、进而卡住stdin的写入
+        ### 线程不持有self, 响应被丢弃时__del__仍能触发并结束ffmpeg
+        self.reader = threading.Thread(
+            target=_drain_pipe, args=(self.process.stdout, self.pending, self.cond), daemon=True
+        )
+        self.reader.start()
+
+    def _take_aac(self, settle: float) -> bytes:
+        ### 等ffmpeg把刚喂入的数据编码完(一段时间内没有新输出), 避免这一句的音频拖到下一句才发出
+        with self.cond:
+            deadline = time.perf_counter() + AAC_MAX_WAIT_SECONDS
+            n = -1
+            while settle > 0 and n != len(self.pending) and time.perf_counter() < deadline:
+                n = len(self.pending)
+                self.cond.wait(settle)
+            out = b"".join(self.pending)
+            self.pending.clear()
+        return out
+
+    def _take_ogg(self) -> bytes:
+        out = self.ogg_buffer.getbuffer()[self.ogg_sent :].tobytes()
+        self.ogg_sent += len(out)
+        return out
+
+    def feed(self, data: np.ndarray) -> bytes:
+        if self.closed:
+            raise RuntimeError("encoder already closed")
+        if self.media_type == "ogg":
+            if self.sound_file is None:
+                self._open_ogg()
+            ### 分块写入: 一次写入过长的音频可能触发libsndfile的栈溢出(见api.py中pack_ogg的说明)
+            for i in range(0, len(data), OGG_BLOCK_FRAMES):
+                self.sound_file.write(data[i : i + OGG_BLOCK_FRAMES])
+            return self._take_ogg()
+        if self.media_type == "aac":
+            if self.process is None:
+                self._open_aac(data.dtype)
+            self.process.stdin.write(data.tobytes())
+            self.process.stdin.flush()
+            return self._take_aac(AAC_SETTLE_SECONDS)
+        if self.media_type == "wav" and not self.header_sent:
+            self.header_sent = True
+            return wave_header(sample_width=data.dtype.itemsize, sample_rate=self.rate) + data.tobytes()
+        return data.tobytes()
+
+    def close(self) -> bytes:
+        """Flush the encoder and return the remaining bytes (container trailer / encoder delay)."""
+        if self.closed:
+            return b""
+        self.closed = True
+        if self.sound_file is not None:
+            self.sound_file.close()
+            return self._take_ogg()
+        if self.process is not None:
+            self.process.stdin.close()
+            self.reader.join()
+            self.process.wait()
+            return self._take_aac(0)
+        return b""
+
+    def abort(self):
+        """Release the encoder without flushing, e.g. when the client disconnected."""
+        if self.closed:
+            return
+        self.closed = True
+        if self.sound_file is not None:
+            self.sound_file.close()
+        if self.process is not None:
+            self.process.kill()
+            self.process.wait()
+
+    def __del__(self):
+        self.abort()
@@ -1076,18 +1076,30 @@ def open1abc(
     if ps1abc == []:
         opt_dir = "%s/%s" % (exp_root, exp_name)
         try:
-            #############################1a
+            #############################1abc
+            ### 单进程流水线: 文本/BERT/CNHuBERT/语义token一次走完, 有manifest可断点续跑
             path_text = "%s/2-name2text.txt" % opt_dir
-            if os.path.exists(path_text) == False or (
-                os.path.exists(path_text) == True
-                and len(open(path_text, "r", encoding="utf8").read().strip("\n").split("\n")) < 2
+            path_semantic = "%s/6-name2semantic.tsv" % opt_dir
+            if (
+                os.path.exists(path_text) == False
+                or len(open(path_text, "r", encoding="utf8").read().strip("\n").split("\n")) < 2
+                or os.path.exists(path_semantic) == False
+                or os.path.getsize(path_semantic) < 31
             ):
+                config_file = (
+                    "GPT_SoVITS/configs/s2.json"
+                    if version not in {"v2Pro", "v2ProPlus"}
+                    else f"GPT_SoVITS/configs/s2{version}.json"
+                )
                 config = {
                     "inp_text": inp_text,
                     "inp_wav_dir": inp_wav_dir,
                     "exp_name": exp_name,
                     "opt_dir": opt_dir,
                     "bert_pretrained_dir": bert_pretrained_dir,
+                    "cnhubert_base_dir": ssl_pretrained_dir,
+                    "pretrained_s2G": pretrained_s2G_path,
+                    "s2config_path": config_file,
                     "is_half": str(is_half),
                 }
                 gpu_names = gpu_numbers1a.split("-")
@@ -1101,20 +1113,21 @@ def open1abc(
                         }
                     )
                     os.environ.update(config)
-                    cmd = '"%s" -s GPT_SoVITS/prepare_datasets/1-get-text.py' % python_exec
+                    cmd = '"%s" -s GPT_SoVITS/prepare_datasets/1abc-prepare-all.py' % python_exec
                     print(cmd)
                     p = Popen(cmd, shell=True)
                     ps1abc.append(p)
                 yield (
-                    i18n("进度") + ": 1A-Doing",
+                    i18n("进度") + ": 1A-Doing, 1B-Doing, 1C-Doing",
                     {"__type__": "update", "visible": False},
                     {"__type__": "update", "visible": True},
                 )
                 for p in ps1abc:
                     p.wait()
+                ps1abc = []
 
                 opt = []
-                for i_part in range(all_parts):  # txt_path="%s/2-name2text-%s.txt"%(opt_dir,i_part)
+                for i_part in range(all_parts):
                     txt_path = "%s/2-name2text-%s.txt" % (opt_dir, i_part)
                     with open(txt_path, "r", encoding="utf8") as f:
                         opt += f.read().strip("\n").split("\n")
@@ -1122,84 +1135,37 @@ def open1abc(
                 with open(path_text, "w", encoding="utf8") as f:
                     f.write("\n".join(opt) + "\n")
                 assert len("".join(opt)) > 0, process_info(process_name_1a, "failed")
-            yield (
-                i18n("进度") + ": 1A-Done",
-                {"__type__": "update", "visible": False},
-                {"__type__": "update", "visible": True},
-            )
+
+                opt = ["item_name\tsemantic_audio"]
+                for i_part in range(all_parts):
+                    semantic_path = "%s/6-name2semantic-%s.tsv" % (opt_dir, i_part)
+                    with open(semantic_path, "r", encoding="utf8") as f:
+                        opt += f.read().strip("\n").split("\n")
+                    os.remove(semantic_path)
+                with open(path_semantic, "w", encoding="utf8") as f:
+                    f.write("\n".join(opt) + "\n")
+            ### 打包s1训练用的token store(未过期时跳过); 失败不影响训练, 会退回读取tsv
+            os.environ.update({"opt_dir": opt_dir, "version": version})
+            cmd = '"%s" -s GPT_SoVITS/prepare_datasets/4-pack-s1-tokens.py' % python_exec
+            print(cmd)
+            p = Popen(cmd, shell=True)
+            ps1abc.append(p)
+            p.wait()
             ps1abc = []
-            #############################1b
-            config = {
-                "inp_text": inp_text,
-                "inp_wav_dir": inp_wav_dir,
-                "exp_name": exp_name,
-                "opt_dir": opt_dir,
-                "cnhubert_base_dir": ssl_pretrained_dir,
-                "sv_path": sv_path,
-            }
-            gpu_names = gpu_numbers1Ba.split("-")
-            all_parts = len(gpu_names)
-            for i_part in range(all_parts):
-                config.update(
-                    {
-                        "i_part": str(i_part),
-                        "all_parts": str(all_parts),
-                        "_CUDA_VISIBLE_DEVICES": fix_gpu_number(gpu_names[i_part]),
-                    }
-                )
-                os.environ.update(config)
-                cmd = '"%s" -s GPT_SoVITS/prepare_datasets/2-get-hubert-wav32k.py' % python_exec
-                print(cmd)
-                p = Popen(cmd, shell=True)
-                ps1abc.append(p)
             yield (
-                i18n("进度") + ": 1A-Done, 1B-Doing",
+                i18n("进度") + ": 1A-Done, 1B-Done, 1C-Done",
                 {"__type__": "update", "visible": False},
                 {"__type__": "update", "visible": True},
             )
-            for p in ps1abc:
-                p.wait()
-            ps1abc = []
             if "Pro" in version:
-                for i_part in range(all_parts):
-                    config.update(
-                        {
-                            "i_part": str(i_part),
-                            "all_parts": str(all_parts),
-                            "_CUDA_VISIBLE_DEVICES": fix_gpu_number(gpu_names[i_part]),
-                        }
-                    )
-                    os.environ.update(config)
-                    cmd = '"%s" -s GPT_SoVITS/prepare_datasets/2-get-sv.py' % python_exec
-                    print(cmd)
-                    p = Popen(cmd, shell=True)
-                    ps1abc.append(p)
-                for p in ps1abc:
-                    p.wait()
-                ps1abc = []
-            yield (
-                i18n("进度") + ": 1A-Done, 1B-Done",
-                {"__type__": "update", "visible": False},
-                {"__type__": "update", "visible": True},
-            )
-            #############################1c
-            path_semantic = "%s/6-name2semantic.tsv" % opt_dir
-            if os.path.exists(path_semantic) == False or (
-                os.path.exists(path_semantic) == True and os.path.getsize(path_semantic) < 31
-            ):
-                config_file = (
-                    "GPT_SoVITS/configs/s2.json"
-                    if version not in {"v2Pro", "v2ProPlus"}
-                    else f"GPT_SoVITS/configs/s2{version}.json"
-                )
                 config = {
                     "inp_text": inp_text,
+                    "inp_wav_dir": inp_wav_dir,
                     "exp_name": exp_name,
                     "opt_dir": opt_dir,
-                    "pretrained_s2G": pretrained_s2G_path,
-                    "s2config_path": config_file,
+                    "sv_path": sv_path,
                 }
-                gpu_names = gpu_numbers1c.split("-")
+                gpu_names = gpu_numbers1Ba.split("-")
                 all_parts = len(gpu_names)
                 for i_part in range(all_parts):
                     config.update(
@@ -1210,31 +1176,13 @@ def open1abc(
                         }
                     )
                     os.environ.update(config)
-                    cmd = '"%s" -s GPT_SoVITS/prepare_datasets/3-get-semantic.py' % python_exec
+                    cmd = '"%s" -s GPT_SoVITS/prepare_datasets/2-get-sv.py' % python_exec
                     print(cmd)
                     p = Popen(cmd, shell=True)
                     ps1abc.append(p)
-                yield (
-                    i18n("进度") + ": 1A-Done, 1B-Done, 1C-Doing",
-                    {"__type__": "update", "visible": False},
-                    {"__type__": "update", "visible": True},
-                )
                 for p in ps1abc:
                     p.wait()
-
-                opt = ["item_name\tsemantic_audio"]
-                for i_part in range(all_parts):
-                    semantic_path = "%s/6-name2semantic-%s.tsv" % (opt_dir, i_part)
-                    with open(semantic_path, "r", encoding="utf8") as f:
-                        opt += f.read().strip("\n").split("\n")
-                    os.remove(semantic_path)
-                with open(path_semantic, "w", encoding="utf8") as f:
-                    f.write("\n".join(opt) + "\n")
-                yield (
-                    i18n("进度") + ": 1A-Done, 1B-Done, 1C-Done",
-                    {"__type__": "update", "visible": False},
-                    {"__type__": "update", "visible": True},
-                )
+                ps1abc = []
             ps1abc = []
             yield (
                 process_info(process_name_1abc, "finish"),